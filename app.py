@@ -3,25 +3,39 @@ SpotiRec - Flask Backend Server
 Music recommendation system using Spotify API and MongoDB
 """
 
+from startup import startup  # imported first so startup timing covers the other imports
 import os
 import base64
+import hmac
+import math
+import threading
+import time
 from datetime import timedelta
-from flask import Flask, request, redirect, jsonify, session, send_from_directory, send_file
+from flask import (
+    Flask, Response, request, redirect, jsonify, session, send_from_directory, send_file, g, has_request_context,
+    stream_with_context
+)
 from flask_cors import CORS
 from pymongo import MongoClient
+from cache import TTLCache
+import metrics
+from result_store import compact_record, create_result_store, new_key
+from precompute import Precomputer
+from artist_metadata import ArtistMetadata, genre_weights
+from taste_profile import TasteProfiles
+from spotify_gateway import SpotifyAuthError, SpotifyError, UserToken
+from catalog_queries import ensure_indexes, song_projection
 from dotenv import load_dotenv
-import requests
 from urllib.parse import urlencode
-import matplotlib
-matplotlib.use('Agg')  # Use non-GUI backend
-import matplotlib.pyplot as plt
-import numpy as np
-from io import BytesIO
-import base64 as b64
 
 # Load environment variables
 load_dotenv()
 
+# These modules read their settings from the environment loaded above
+import spotify_client
+import charts
+from charts import CHART_FORMATS, chart_key, get_analysis_chart
+
 app = Flask(__name__, static_folder='public', static_url_path='')
 app.secret_key = os.getenv('SESSION_SECRET', 'default-secret-key')
 app.config['SESSION_COOKIE_SECURE'] = False  # Set to True if using HTTPS
@@ -31,34 +45,323 @@ app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
 
 CORS(app)
 
+# Recommendation tuning
+# Number of nearest songs (by audio features) scored per request; 0 scores the whole catalog
+RECOMMENDATION_CANDIDATES = int(os.getenv('RECOMMENDATION_CANDIDATES', 500))
+# Approximation factor for the nearest-neighbour search (0 = exact)
+KNN_EPS = float(os.getenv('KNN_EPS', 0))
+
+# Each computation ranks this many songs once; later pages and the NDJSON stream
+# read from the cached ranking instead of scoring again
+RECOMMENDATION_DEPTH = int(os.getenv('RECOMMENDATION_DEPTH', 200))
+RECOMMENDATION_PAGE_SIZE = 20
+RECOMMENDATION_MAX_PAGE_SIZE = 100
+RANKING_TTL = int(os.getenv('RANKING_TTL', 1800))  # seconds a cursor stays valid
+# Diversity re-ranking: the best DIVERSITY_POOL scored songs are reordered by maximal marginal
+# relevance with at most DIVERSITY_ARTIST_CAP songs per artist (0 = no cap) before the rest;
+# DIVERSITY_RELEVANCE_WEIGHT trades variety (0) for relevance (1)
+DIVERSITY = os.getenv('DIVERSITY', 'true').lower() == 'true'
+DIVERSITY_POOL = int(os.getenv('DIVERSITY_POOL', 500))
+DIVERSITY_RELEVANCE_WEIGHT = float(os.getenv('DIVERSITY_RELEVANCE_WEIGHT', 0.7))
+DIVERSITY_ARTIST_CAP = int(os.getenv('DIVERSITY_ARTIST_CAP', 3))
+RANKING_CACHE_SIZE = int(os.getenv('RANKING_CACHE_SIZE', 5000))
+ranking_cache = TTLCache(maxsize=RANKING_CACHE_SIZE, ttl=RANKING_TTL)
+
+# Batch recommendations for offline jobs; the endpoint is disabled unless a key is set
+BATCH_API_KEY = os.getenv('BATCH_API_KEY')
+BATCH_MAX_PROFILES = int(os.getenv('BATCH_MAX_PROFILES', 10000))
+
+# Per-user cache of Spotify data and derived preferences
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 600))  # seconds
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 1000))
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Spotify artist genres, shared by every user; artists rarely change genres
+ARTIST_CACHE_TTL = int(os.getenv('ARTIST_CACHE_TTL', 7 * 86400))  # seconds
+ARTIST_CACHE_SIZE = int(os.getenv('ARTIST_CACHE_SIZE', 50000))
+artist_metadata = ArtistMetadata(spotify_client.get_artists, ttl=ARTIST_CACHE_TTL, maxsize=ARTIST_CACHE_SIZE)
+
+# Time-decayed taste profile per user, updated from recently played tracks instead of
+# being derived from top tracks on every computation
+TASTE_PROFILES = os.getenv('TASTE_PROFILES', 'true').lower() == 'true'
+TASTE_PROFILE_HALF_LIFE = float(os.getenv('TASTE_PROFILE_HALF_LIFE', 14 * 86400))  # seconds until a play counts half
+TASTE_PROFILE_ARTISTS = int(os.getenv('TASTE_PROFILE_ARTISTS', 25))  # most listened artists used for matching
+# 'memory' (per process) or 'sqlite:///path/to/profiles.db' (shared by workers on one host)
+TASTE_PROFILE_STORE = os.getenv('TASTE_PROFILE_STORE', 'memory')
+TASTE_PROFILE_TTL = int(os.getenv('TASTE_PROFILE_TTL', 90 * 86400))  # seconds a profile survives without updates
+taste_profiles = TasteProfiles(
+    create_result_store(TASTE_PROFILE_STORE, ttl=TASTE_PROFILE_TTL), half_life=TASTE_PROFILE_HALF_LIFE
+)
+
+# Server-side store for the latest recommendations of each session
+# 'memory' (per process) or 'sqlite:///path/to/results.db' (shared by workers on one host)
+RESULT_STORE = os.getenv('RESULT_STORE', 'memory')
+RESULT_STORE_TTL = int(os.getenv('RESULT_STORE_TTL', 86400))  # seconds
+result_store = create_result_store(RESULT_STORE, ttl=RESULT_STORE_TTL)
+
+# Load the catalog on a background thread so the server can bind its port right away
+BACKGROUND_STARTUP = os.getenv('BACKGROUND_STARTUP', 'false').lower() == 'true'
+
+# Random picks for users without listening history come from a stratified pool of this many songs
+COLD_START_POOL_SIZE = int(os.getenv('COLD_START_POOL_SIZE', 2000))
+COLD_START_REFRESH = int(os.getenv('COLD_START_REFRESH', 3600))  # seconds between reshuffles
+
+# Recompute recommendations for recently active users in the background
+PRECOMPUTE = os.getenv('PRECOMPUTE', 'false').lower() == 'true'
+PRECOMPUTE_INTERVAL = int(os.getenv('PRECOMPUTE_INTERVAL', 900))  # seconds between refreshes per user
+PRECOMPUTE_ACTIVE_WINDOW = int(os.getenv('PRECOMPUTE_ACTIVE_WINDOW', 86400))  # seconds since last visit
+PRECOMPUTE_WORKERS = int(os.getenv('PRECOMPUTE_WORKERS', 4))
+
+# Create the indexes the songs collection queries need at startup
+MANAGE_INDEXES = os.getenv('MANAGE_INDEXES', 'true').lower() == 'true'
+
+# Memory-map the catalog from a snapshot written by `python catalog_snapshot.py export <path>`
+# instead of fetching it from MongoDB; workers then share one copy and boot in milliseconds
+CATALOG_SNAPSHOT = os.getenv('CATALOG_SNAPSHOT')
+
+# "More like this" lists precomputed by `python similar_tracks.py build <path>`;
+# without them /api/similar computes a song's neighbours on demand
+SIMILAR_INDEX = os.getenv('SIMILAR_INDEX')
+
+# Follow inserts, updates and deletes in the songs collection without reloading it
+CATALOG_SYNC = os.getenv('CATALOG_SYNC', 'false').lower() == 'true'
+# 'auto' uses a change stream when the server supports one and polls CATALOG_SYNC_FIELD otherwise
+CATALOG_SYNC_MODE = os.getenv('CATALOG_SYNC_MODE', 'auto')
+CATALOG_SYNC_FIELD = os.getenv('CATALOG_SYNC_FIELD', 'updated_at')
+CATALOG_SYNC_BATCH = int(os.getenv('CATALOG_SYNC_BATCH', 500))
+CATALOG_SYNC_POLL_INTERVAL = int(os.getenv('CATALOG_SYNC_POLL_INTERVAL', 30))  # seconds
+CATALOG_SYNC_RESYNC_INTERVAL = int(os.getenv('CATALOG_SYNC_RESYNC_INTERVAL', 86400))  # seconds, polling mode only
+
+# Add a Server-Timing header with the per-stage breakdown to every response
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() == 'true'
+
 # MongoDB Connection
 db = None
 songs_collection = None
+catalog = None
+catalog_sync = None
+cold_start_pool = None
+similar_tracks = None
 
-def connect_to_mongodb():
-    """Connect to MongoDB Atlas"""
+def connect_to_mongodb(background=False):
+    """Connect to MongoDB Atlas and load the song catalog
+    
+    In background mode the catalog is loaded on a separate thread and
+    /api/ready reports when it's done.
+    """
     global db, songs_collection
+    if CATALOG_SNAPSHOT and not os.getenv('MONGODB_URI'):
+        print('📦 No MONGODB_URI set, serving from the catalog snapshot only')
+        if not load_catalog():
+            exit(1)
+        return
+    
     try:
-        client = MongoClient(os.getenv('MONGODB_URI'))
-        db = client['recommender']  # Your database name
-        songs_collection = db['cleaned_copy3']  # Your collection name
-        
-        # Log connection details
-        print('✅ Connected to MongoDB Atlas')
-        print('📊 Database: recommender')
-        print('📁 Collection: cleaned_copy3')
+        with startup.phase('mongodb_connect'):
+            client = MongoClient(os.getenv('MONGODB_URI'))
+            db = client['recommender']  # Your database name
+            songs_collection = db['cleaned_copy3']  # Your collection name
+            
+            # Log connection details
+            print('✅ Connected to MongoDB Atlas')
+            print('📊 Database: recommender')
+            print('📁 Collection: cleaned_copy3')
+            
+            # Check if collection has documents (from collection metadata, no scan)
+            count = songs_collection.estimated_document_count()
+            print(f'🎵 Found {count} songs in collection')
         
-        # Check if collection has documents
-        count = songs_collection.count_documents({})
-        print(f'🎵 Found {count} songs in collection')
+        if MANAGE_INDEXES:
+            with startup.phase('mongodb_indexes'):
+                ensure_indexes(songs_collection, sync_watermark_field())
     except Exception as error:
         print(f'❌ MongoDB connection error: {error}')
         exit(1)
+    
+    if background:
+        threading.Thread(target=load_catalog, name='catalog-bootstrap', daemon=True).start()
+    elif not load_catalog():
+        exit(1)
+
+def load_catalog():
+    """Load the catalog into memory and build its indexes, so recommendations don't query MongoDB"""
+    global catalog, catalog_sync, cold_start_pool, similar_tracks
+    try:
+        with startup.phase('numerical_imports'):
+            from catalog import Catalog
+            from cold_start import ColdStartPool
+        # Resolved once, so sync and the mapping agree on the version if an export swaps it meanwhile
+        snapshot_path = os.path.realpath(CATALOG_SNAPSHOT) if CATALOG_SNAPSHOT else None
+        if CATALOG_SYNC and songs_collection is not None:
+            from catalog_sync import CatalogSync
+            # Start following changes before the fetch so none are missed while it runs
+            catalog_sync = CatalogSync(
+                songs_collection, lambda: catalog, publish_catalog, mode=CATALOG_SYNC_MODE,
+                watermark_field=CATALOG_SYNC_FIELD, batch_size=CATALOG_SYNC_BATCH,
+                poll_interval=CATALOG_SYNC_POLL_INTERVAL, resync_interval=CATALOG_SYNC_RESYNC_INTERVAL
+            )
+            if CATALOG_SNAPSHOT:
+                from catalog_snapshot import read_manifest
+                # The snapshot was read from the collection at export; follow changes from there
+                catalog_sync.open(since=read_manifest(snapshot_path).get('since', {}))
+            else:
+                catalog_sync.open()
+        # Build everything into locals and publish the catalog last, so a request that sees
+        # the catalog also finds the cold-start pool and similar tracks that go with it
+        if CATALOG_SNAPSHOT:
+            with startup.phase('catalog_map'):
+                from catalog_snapshot import load_snapshot
+                loaded = load_snapshot(snapshot_path, knn_eps=KNN_EPS)
+            print(f'🗺️  Mapped {len(loaded)} songs from the catalog snapshot at {CATALOG_SNAPSHOT}')
+            if RECOMMENDATION_CANDIDATES:
+                # Build the nearest-neighbour index off the startup path
+                threading.Thread(target=lambda: loaded.feature_index, name='feature-index', daemon=True).start()
+        else:
+            with startup.phase('catalog_fetch'):
+                documents = list(songs_collection.find({}, song_projection(sync_watermark_field())))
+            with startup.phase('catalog_index'):
+                loaded = Catalog(documents, knn_eps=KNN_EPS)
+            print(f'🧮 Loaded {len(loaded)} songs into the in-memory catalog')
+        with startup.phase('cold_start_pool'):
+            pool = ColdStartPool(size=COLD_START_POOL_SIZE, refresh_interval=COLD_START_REFRESH)
+            pool.rebuild(loaded)
+        with startup.phase('similar_index'):
+            similar = load_similar_tracks()
+        
+        previous_pool = cold_start_pool
+        cold_start_pool, similar_tracks = pool, similar
+        catalog = loaded
+        if previous_pool is not None:
+            previous_pool.stop()
+        cold_start_pool.start(lambda: catalog)
+        if catalog_sync:
+            catalog_sync.start()
+            print(f'🔁 Following catalog changes ({catalog_sync.mode})')
+        
+        startup.mark_ready()
+        print(f'⏱️  Startup: {startup.summary()}')
+        return True
+    except Exception as error:
+        print(f'❌ Catalog loading error: {error}')
+        startup.fail(error)
+        return False
+
+def load_similar_tracks():
+    """The similar tracks index at SIMILAR_INDEX, or on-demand lookups without one"""
+    from similar_tracks import SimilarTracks, load_index
+    if SIMILAR_INDEX:
+        try:
+            index = load_index(SIMILAR_INDEX)
+            print(f'🧭 Mapped similar tracks for {len(index.neighbours)} songs from {SIMILAR_INDEX}')
+            return index
+        except Exception as error:
+            print(f'⚠️  Could not load the similar tracks index, computing on demand: {error}')
+    return SimilarTracks()
+
+def sync_watermark_field():
+    """Field the catalog sync may poll on, which must be loaded and indexed"""
+    return CATALOG_SYNC_FIELD if CATALOG_SYNC else None
+
+def sample_songs(size, exclude_ids=()):
+    """Random songs for users without enough matches, drawn from the cold-start pool"""
+    return cold_start_pool.draw(size, exclude_ids)
+
+def publish_catalog(snapshot):
+    """Swap in a new catalog snapshot; requests that already hold the old one finish with it"""
+    global catalog
+    catalog = snapshot
+    cold_start_pool.rebuild(snapshot)
+
+def catalog_sync_metrics():
+    """Catalog sync statistics for /metrics"""
+    if catalog_sync is None:
+        return
+    stats = catalog_sync.stats()
+    yield ('spotirec_catalog_sync_changes_total', 'counter', 'Catalog changes applied', ['operation'],
+           [((operation,), count) for operation, count in stats['changes'].items()])
+    yield ('spotirec_catalog_sync_batches_total', 'counter', 'Catalog snapshots published', [], [((), stats['batches'])])
+    yield ('spotirec_catalog_rebuilds_total', 'counter', 'Full catalog rebuilds and compactions', [], [((), stats['rebuilds'])])
+    yield ('spotirec_catalog_sync_errors_total', 'counter', 'Catalog sync errors', [], [((), stats['errors'])])
+    yield ('spotirec_catalog_sync_lag_seconds', 'gauge', 'Age of the oldest change in the last applied batch', [], [((), stats['lag_seconds'])])
+
+metrics.registry.add_collector(catalog_sync_metrics)
+
+def cold_start_metrics():
+    """Cold-start pool statistics for /metrics"""
+    if cold_start_pool is None:
+        return
+    stats = cold_start_pool.stats()
+    yield ('spotirec_cold_start_pool_size', 'gauge', 'Songs in the cold-start pool', [], [((), stats['size'])])
+    yield ('spotirec_cold_start_pool_rebuilds_total', 'counter', 'Cold-start pool rebuilds', [], [((), stats['rebuilds'])])
+    yield ('spotirec_cold_start_draws_total', 'counter', 'Random picks drawn from the cold-start pool', [], [((), stats['draws'])])
+
+metrics.registry.add_collector(cold_start_metrics)
 
 # Spotify API Configuration
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
 SPOTIFY_REDIRECT_URI = os.getenv('SPOTIFY_REDIRECT_URI')
+# Request all top-track time ranges at once instead of one after another
+SPOTIFY_PARALLEL_TOP_TRACKS = os.getenv('SPOTIFY_PARALLEL_TOP_TRACKS', 'true').lower() == 'true'
+
+# Instrumentation
+
+def stage(name):
+    """Time a stage of the current request for /metrics and the Server-Timing header"""
+    if not has_request_context():
+        current = metrics.current_request.get()
+        if current is not None:
+            return metrics.timed(current[0], name, current[1])
+        return metrics.timed('precompute', name)
+    return metrics.timed(request.endpoint, name, g.setdefault('timings', []))
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    """Record request latency and attach the Server-Timing header"""
+    elapsed = time.perf_counter() - g.pop('request_started', time.perf_counter())
+    metrics.REQUEST_SECONDS.observe(request.endpoint or 'unknown', str(response.status_code), value=elapsed)
+    if SERVER_TIMING:
+        timings = g.get('timings', []) + [('total', elapsed)]
+        response.headers['Server-Timing'] = metrics.server_timing_header(timings)
+    save_renewed_token(session, g.get('spotify_token'))
+    return response
+
+def cache_metrics():
+    """Cache statistics for /metrics"""
+    caches = [('user', user_cache.stats()), ('chart', charts.chart_cache.stats()), ('artist', artist_metadata.stats())]
+    if similar_tracks is not None:
+        caches.append(('similar', similar_tracks.stats()))
+    for field, kind in [('hits', 'counter'), ('misses', 'counter'), ('size', 'gauge')]:
+        yield (
+            f'spotirec_cache_{field}' + ('_total' if kind == 'counter' else ''),
+            kind, f'Cache {field}', ['cache'],
+            [((name,), stats[field]) for name, stats in caches]
+        )
+
+metrics.registry.add_collector(cache_metrics)
+
+def spotify_gateway_metrics():
+    """Spotify gateway counters for /metrics"""
+    stats = spotify_client.gateway.stats()
+    for field, description in [
+        ('requests', 'Requests sent to Spotify'),
+        ('throttled', 'Spotify 429 responses'),
+        ('coalesced', 'Calls served by an identical call already in flight'),
+        ('refreshes', 'Access tokens renewed'),
+        ('stale_served', 'Calls answered with a cached response'),
+        ('unavailable', 'Calls that failed with Spotify unavailable'),
+        ('circuit_opens', 'Times the Spotify circuit breaker opened'),
+    ]:
+        yield f'spotirec_spotify_{field}_total', 'counter', description, [], [((), stats[field])]
+    yield 'spotirec_spotify_circuit_open', 'gauge', 'Whether the Spotify circuit breaker is open', [], [
+        ((), int(stats['circuit_state'] != 'closed'))
+    ]
+
+metrics.registry.add_collector(spotify_gateway_metrics)
 
 # Routes
 
@@ -90,21 +393,13 @@ def callback():
     
     try:
         # Exchange code for access token
-        auth_str = f'{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}'
-        auth_bytes = auth_str.encode('utf-8')
-        auth_base64 = base64.b64encode(auth_bytes).decode('utf-8')
-        
-        token_response = requests.post(
-            'https://accounts.spotify.com/api/token',
-            data={
+        token_response = spotify_client.request_token(
+            {
                 'grant_type': 'authorization_code',
                 'code': code,
                 'redirect_uri': SPOTIFY_REDIRECT_URI
             },
-            headers={
-                'Authorization': f'Basic {auth_base64}',
-                'Content-Type': 'application/x-www-form-urlencoded'
-            }
+            spotify_auth_header()
         )
         
         if token_response.status_code != 200:
@@ -114,13 +409,82 @@ def callback():
         token_data = token_response.json()
         session['access_token'] = token_data['access_token']
         session['refresh_token'] = token_data.get('refresh_token')
+        session['token_expires'] = time.time() + token_data.get('expires_in', 3600)
         session.permanent = True
         
+        # Remember the Spotify user id so per-user caches can be keyed on it
+        session.pop('user_id', None)
+        try:
+            fetch_user_profile(spotify_token())
+        except Exception as error:
+            print(f'⚠️  Could not fetch user profile: {error}')
+        
         return redirect('/?auth=success')
     except Exception as error:
         print(f'Error getting access token: {error}')
         return redirect('/?error=auth_failed')
 
+def spotify_auth_header():
+    """Base64 client credentials for the Spotify token endpoint"""
+    auth_str = f'{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}'
+    return base64.b64encode(auth_str.encode('utf-8')).decode('utf-8')
+
+def refresh_access_token(refresh_token):
+    """Exchange a stored refresh token for (access_token, expires_in, new refresh_token or None)"""
+    response = spotify_client.request_token(
+        {'grant_type': 'refresh_token', 'refresh_token': refresh_token},
+        spotify_auth_header()
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f'Token refresh failed with status {response.status_code}')
+    token_data = response.json()
+    return token_data['access_token'], token_data.get('expires_in', 3600), token_data.get('refresh_token')
+
+# Expired or rejected access tokens are renewed on the next Spotify call
+spotify_client.gateway.refresher = refresh_access_token
+
+def user_token(session):
+    """UserToken for a session's Spotify tokens"""
+    return UserToken(
+        session['access_token'], session.get('refresh_token'), session.get('token_expires'), session.get('user_id')
+    )
+
+def save_renewed_token(session, token):
+    """Write a token the gateway renewed back to the session"""
+    if token is not None and token.renewed:
+        session['access_token'] = token.access_token
+        session['refresh_token'] = token.refresh_token
+        session['token_expires'] = token.expires_at
+
+def spotify_token():
+    """The session's Spotify token, shared by every call in this request"""
+    if 'spotify_token' not in g:
+        g.spotify_token = user_token(session)
+    return g.spotify_token
+
+def spotify_error_response(error):
+    """(error, status, headers) for a Spotify call the gateway couldn't complete"""
+    if isinstance(error, SpotifyAuthError):
+        return {'error': 'Spotify session expired, please log in again'}, 401, {}
+    metrics.EVENTS.inc('spotify_unavailable')
+    return {'error': 'Spotify is unavailable, try again shortly'}, 503, {'Retry-After': str(math.ceil(error.retry_after))}
+
+def fetch_user_profile(access_token):
+    """Spotify profile for the session user, cached per user id"""
+    user_id = session.get('user_id')
+    profile = user_cache.get((user_id, 'profile')) if user_id else None
+    if profile is not None:
+        return profile
+    
+    response = spotify_client.get('/me', access_token)
+    if response.status_code != 200:
+        return None
+    
+    profile = response.json()
+    session['user_id'] = profile['id']
+    user_cache.set((profile['id'], 'profile'), profile)
+    return profile
+
 @app.route('/api/user')
 def get_user():
     """Get user profile"""
@@ -128,15 +492,14 @@ def get_user():
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        response = requests.get(
-            'https://api.spotify.com/v1/me',
-            headers={'Authorization': f'Bearer {session["access_token"]}'}
-        )
+        profile = fetch_user_profile(spotify_token())
         
-        if response.status_code != 200:
+        if profile is None:
             return jsonify({'error': 'Failed to fetch user profile'}), 500
         
-        return jsonify(response.json())
+        return jsonify(profile)
+    except SpotifyError as error:
+        return spotify_error_response(error)
     except Exception as error:
         print(f'Error fetching user profile: {error}')
         return jsonify({'error': 'Failed to fetch user profile'}), 500
@@ -148,250 +511,735 @@ def get_top_tracks():
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        response = requests.get(
-            'https://api.spotify.com/v1/me/top/tracks',
-            headers={'Authorization': f'Bearer {session["access_token"]}'},
-            params={'limit': 20, 'time_range': 'medium_term'}
-        )
+        user_id = session.get('user_id')
+        cache_key = (user_id, 'top_tracks', 'medium_term')
+        top_tracks = user_cache.get(cache_key) if user_id else None
         
-        if response.status_code != 200:
-            return jsonify({'error': 'Failed to fetch top tracks'}), 500
+        if top_tracks is None:
+            response = spotify_client.get(
+                '/me/top/tracks',
+                spotify_token(),
+                params={'limit': 20, 'time_range': 'medium_term'}
+            )
+            
+            if response.status_code != 200:
+                return jsonify({'error': 'Failed to fetch top tracks'}), 500
+            
+            top_tracks = response.json()
+            if user_id:
+                user_cache.set(cache_key, top_tracks)
         
-        return jsonify(response.json())
+        return jsonify(top_tracks)
+    except SpotifyError as error:
+        return spotify_error_response(error)
     except Exception as error:
         print(f'Error fetching top tracks: {error}')
         return jsonify({'error': 'Failed to fetch top tracks'}), 500
 
+def load_user_preferences(access_token, snapshot, user_id=None):
+    """Derive the user's taste profile from their Spotify listening
+    
+    With TASTE_PROFILES the user's stored profile is updated with their latest
+    plays; otherwise it is derived from their top tracks every time.
+    Returns None if the user has no listening history.
+    """
+    if TASTE_PROFILES and user_id:
+        return load_profile_preferences(access_token, snapshot, user_id)
+    
+    # Try different time ranges to get user's top tracks
+    # (short_term first, then medium_term, then long_term)
+    with stage('spotify_top_tracks'):
+        top_tracks, time_range_used = spotify_client.get_top_tracks_with_fallback(
+            access_token, limit=20, parallel=SPOTIFY_PARALLEL_TOP_TRACKS
+        )
+    
+    if not top_tracks:
+        return None
+    
+    artist_ids = top_track_artist_ids(top_tracks)
+    try:
+        with stage('spotify_artists'):
+            artists = artist_metadata.resolve(access_token, artist_ids)
+    except Exception as error:
+        print(f'⚠️  Could not resolve artist genres: {error}')
+        metrics.EVENTS.inc('artist_genres_failed')
+        artists = {}
+    
+    return preferences_from_top_tracks(top_tracks, time_range_used, artists, snapshot)
+
+def load_profile_preferences(access_token, snapshot, user_id):
+    """Preferences from the user's stored taste profile, updated with the plays since its last update"""
+    profile = taste_profiles.get(user_id)
+    top_tracks = []
+    if profile is None:
+        # A new profile starts from the user's top tracks
+        with stage('spotify_top_tracks'):
+            top_tracks, _ = spotify_client.get_top_tracks_with_fallback(
+                access_token, limit=20, parallel=SPOTIFY_PARALLEL_TOP_TRACKS
+            )
+    
+    with stage('spotify_recently_played'):
+        plays = spotify_client.get_recently_played(access_token, after=profile['cursor'] if profile else None)
+    
+    profile = update_taste_profile(user_id, snapshot, plays, top_tracks, profile)
+    if profile is None:
+        return None
+    
+    artist_ids = [artist_id for artist_id, _, _ in taste_profiles.top_artists(profile, TASTE_PROFILE_ARTISTS)]
+    try:
+        with stage('spotify_artists'):
+            artists = artist_metadata.resolve(access_token, artist_ids)
+    except Exception as error:
+        print(f'⚠️  Could not resolve artist genres: {error}')
+        metrics.EVENTS.inc('artist_genres_failed')
+        artists = {}
+    
+    return preferences_from_profile(profile, artists)
+
+def update_taste_profile(user_id, snapshot, plays, top_tracks, previous):
+    """Apply new plays (and top tracks, for a new profile) to the user's taste profile"""
+    with stage('taste_profile'):
+        profile = taste_profiles.update(user_id, snapshot, plays, top_tracks)
+    if profile is not None:
+        applied = profile['plays'] - (previous['plays'] if previous else 0)
+        metrics.EVENTS.inc('recent_plays_applied', amount=applied)
+        if previous is None:
+            metrics.EVENTS.inc('taste_profile_created')
+    return profile
+
+def preferences_from_profile(profile, artists):
+    """Taste preferences from a stored profile and its top artists' resolved {artist_id: {'name', 'genres'}}"""
+    top = taste_profiles.top_artists(profile, TASTE_PROFILE_ARTISTS)
+    top_artists = [name for _, name, _ in top]
+    print(f'🧬 Taste profile from {profile["plays"]} recent plays, top artists: {", ".join(top_artists[:5])}')
+    
+    # Weigh genres by how much each artist has been played lately
+    resolved = [(artists[artist_id], weight) for artist_id, _, weight in top if artist_id in artists]
+    weights = genre_weights([artist for artist, _ in resolved], [weight for _, weight in resolved])
+    top_genres = list(weights)
+    
+    if profile['weight'] <= 0:
+        metrics.EVENTS.inc('no_artist_matches')
+        print('⚠️  No matching artists in database, using default audio feature values')
+    avg_energy, avg_danceability, avg_valence = taste_profiles.vector(profile)
+    
+    return {
+        'top_artists': top_artists,
+        'top_genres': top_genres,
+        'genre_weights': weights,
+        'avg_energy': avg_energy,
+        'avg_danceability': avg_danceability,
+        'avg_valence': avg_valence
+    }
+
+def top_track_artist_ids(top_tracks):
+    """Spotify id of every artist appearance on the top tracks"""
+    return [artist['id'] for track in top_tracks for artist in track['artists'] if artist.get('id')]
+
+def preferences_from_top_tracks(top_tracks, time_range_used, artists, snapshot):
+    """Taste profile from top tracks and their resolved {artist_id: {'name', 'genres'}}"""
+    print(f'✅ Found {len(top_tracks)} top tracks using {time_range_used}')
+    sample_tracks = ', '.join([f'"{t["name"]}" by {t["artists"][0]["name"]}' for t in top_tracks[:3]])
+    print(f'🎵 Sample tracks: {sample_tracks}')
+    
+    # Extract artists from top tracks; the simplified artist objects there carry no genres
+    top_artists = list(set([artist['name'] for track in top_tracks for artist in track['artists']]))
+    
+    print(f'🎤 Your top artists: {", ".join(top_artists[:5])}')
+    
+    # Weigh genres by artist appearance, so artists on more top tracks count more
+    artist_ids = top_track_artist_ids(top_tracks)
+    weights = genre_weights([artists[artist_id] for artist_id in artist_ids if artist_id in artists])
+    top_genres = list(weights)
+    
+    if top_genres:
+        print(f'🎸 Your top genres: {", ".join(top_genres[:5])}')
+    
+    # Find matching songs by artist using the in-memory artist index
+    with stage('artist_lookup'):
+        artist_rows = snapshot.artist_rows(top_artists)
+    
+    print(f'📊 Found {len(artist_rows)} songs in database by your favorite artists')
+    
+    # Calculate average audio features from the artist matches in our database
+    avg_energy = 0.6  # default values
+    avg_danceability = 0.6
+    avg_valence = 0.6
+    
+    if len(artist_rows):
+        # Use the audio features from songs by artists you like
+        with stage('feature_means'):
+            avg_energy, avg_danceability, avg_valence = snapshot.feature_means(artist_rows, default=0.6)
+        
+        print(f'🎵 Calculated preferences from {len(artist_rows)} matching songs in database')
+    else:
+        metrics.EVENTS.inc('no_artist_matches')
+        print('⚠️  No matching artists in database, using default audio feature values')
+    
+    return {
+        'top_artists': top_artists,
+        'top_genres': top_genres,
+        'genre_weights': weights,
+        'avg_energy': avg_energy,
+        'avg_danceability': avg_danceability,
+        'avg_valence': avg_valence
+    }
+
+def cached_preferences(user_id):
+    """Taste profile from a recent visit, or None"""
+    preferences = user_cache.get((user_id, 'preferences')) if user_id else None
+    if preferences is None:
+        metrics.EVENTS.inc('preferences_cache_miss')
+    else:
+        metrics.EVENTS.inc('preferences_cache_hit')
+        print('⚡ Using cached listening preferences')
+    return preferences
+
+def rank_recommendations(access_token, user_id, use_cache=True):
+    """Rank the top RECOMMENDATION_DEPTH songs for a user and cache the ranking
+    
+    Returns (ranking_id, ranking), or None if the user has no listening history.
+    """
+    # Hold on to one catalog snapshot for the whole computation, in case sync swaps it
+    snapshot = catalog
+    
+    # Reuse the taste profile from a recent visit if we have one
+    preferences = cached_preferences(user_id) if use_cache else None
+    if preferences is None:
+        preferences = load_user_preferences(access_token, snapshot, user_id)
+        if preferences is not None and user_id:
+            user_cache.set((user_id, 'preferences'), preferences)
+    
+    # Check if user has any top tracks across all time ranges
+    if preferences is None:
+        return None
+    return rank_preferences(user_id, preferences, snapshot)
+
+def rank_preferences(user_id, preferences, snapshot):
+    """Rank songs in a catalog snapshot for a taste profile and cache the ranking"""
+    top_artists = preferences['top_artists']
+    avg_energy = preferences['avg_energy']
+    avg_danceability = preferences['avg_danceability']
+    avg_valence = preferences['avg_valence']
+    with stage('artist_lookup'):
+        artist_rows = snapshot.artist_rows(top_artists)
+    
+    # Songs by any known artist sharing the user's genres get a genre bonus
+    with stage('genre_affinity'):
+        genre_rows, genre_affinity = snapshot.artist_affinity(
+            artist_metadata.related_artists(preferences.get('genre_weights', {}))
+        )
+    
+    print(f'🎯 Generating recommendations with preferences:')
+    print(f'   - Top Artists: {", ".join(top_artists[:5])}')
+    print(f'   - Energy: {avg_energy:.2f}, Danceability: {avg_danceability:.2f}, Valence: {avg_valence:.2f}')
+    
+    # Score the nearest songs in the in-memory catalog (the old aggregation pipeline's weights plus genre)
+    pool = max(DIVERSITY_POOL, RECOMMENDATION_DEPTH) if DIVERSITY else RECOMMENDATION_DEPTH
+    candidates = max(RECOMMENDATION_CANDIDATES, pool) if RECOMMENDATION_CANDIDATES else None
+    with stage('scoring'):
+        rows, scores = snapshot.rank(
+            artist_rows, avg_energy, avg_danceability, avg_valence,
+            limit=pool, candidates=candidates,
+            genre_rows=genre_rows, genre_affinity=genre_affinity
+        )
+    
+    # Spread the ranking over more artists and sounds than the scores alone would
+    if DIVERSITY:
+        from diversity import diversify
+        with stage('diversity'):
+            rows, scores = diversify(
+                snapshot, rows, scores, RECOMMENDATION_DEPTH, DIVERSITY_RELEVANCE_WEIGHT, DIVERSITY_ARTIST_CAP
+            )
+    
+    print(f'✅ Found {len(rows)} personalized recommendations')
+    
+    # Cache the rows and their catalog generation rather than the snapshot, which a
+    # cached ranking would otherwise keep alive long after sync has replaced it
+    ranking = {
+        'generation': snapshot.generation,
+        'rows': rows,
+        'scores': scores,
+        'userPreferences': {
+            'topArtists': top_artists[:5],
+            'topGenres': preferences['top_genres'][:5],
+            'avgEnergy': avg_energy,
+            'avgDanceability': avg_danceability,
+            'avgValence': avg_valence
+        }
+    }
+    ranking_id = new_key()
+    ranking_cache.set((user_id, ranking_id), ranking)
+    return ranking_id, {**ranking, 'snapshot': snapshot}
+
+def cached_ranking(user_id, ranking_id):
+    """A cached ranking with the catalog snapshot its rows refer to
+    
+    Returns None if the ranking has expired, or if the catalog has been
+    rebuilt or compacted since and the rows now point at other songs.
+    """
+    ranking = ranking_cache.get((user_id, ranking_id))
+    snapshot = catalog
+    if ranking is None or snapshot is None or snapshot.generation != ranking['generation']:
+        return None
+    return {**ranking, 'snapshot': snapshot}
+
+def ranking_page(ranking, offset, limit):
+    """Documents for one page of a ranking from cached_ranking(), best first
+    
+    Songs deleted since the ranking was computed are left out. A ranking with
+    fewer than 10 songs is topped up with random songs on its first page, like
+    a full response always was.
+    """
+    snapshot, rows, scores = ranking['snapshot'], ranking['rows'], ranking['scores']
+    end = min(offset + limit, len(rows))
+    for row, score in zip(rows[offset:end].tolist(), scores[offset:end].tolist()):
+        if snapshot.artist_codes[row] < 0:
+            continue
+        doc = snapshot.document(row, score)
+        # Convert ObjectId to string for JSON serialization
+        doc['_id'] = str(doc['_id'])
+        yield doc
+    
+    # If we didn't find enough recommendations, supplement with random ones
+    if offset == 0 and len(rows) < 10:
+        print(f'⚠️  Only found {len(rows)} matches, adding random songs to reach {limit}')
+        metrics.EVENTS.inc('random_topup')
+        existing_ids = [snapshot.documents[row]['_id'] for row in rows.tolist()]
+        with stage('random_topup'):
+            additional_songs = sample_songs(limit - len(rows), existing_ids)
+        for doc in additional_songs:
+            doc['_id'] = str(doc['_id'])
+            yield doc
+
+def next_cursor(ranking_id, ranking, offset, limit):
+    """Opaque cursor for the page after [offset, offset + limit), or None at the end"""
+    end = offset + limit
+    return f'{ranking_id}.{end}' if end < len(ranking['rows']) else None
+
+def parse_cursor(cursor):
+    """(ranking_id, offset) from a cursor; raises ValueError if it is malformed"""
+    ranking_id, _, offset = cursor.rpartition('.')
+    if not ranking_id or not offset.isdigit():
+        raise ValueError('malformed cursor')
+    return ranking_id, int(offset)
+
+def page_limit(args):
+    """Page size from the limit query parameter; raises ValueError if it isn't a number"""
+    limit = int(args.get('limit', RECOMMENDATION_PAGE_SIZE))
+    return min(max(limit, 1), RECOMMENDATION_MAX_PAGE_SIZE)
+
+def first_page(ranked):
+    """First page of a (ranking_id, ranking) and the preferences behind it, or None"""
+    if ranked is None:
+        return None
+    ranking_id, ranking = ranked
+    
+    with stage('documents'):
+        recommendations = list(ranking_page(ranking, 0, RECOMMENDATION_PAGE_SIZE))
+    
+    if len(ranking['rows']):
+        top_rec = recommendations[0]
+        score = top_rec.get('score', 0)
+        print(f'🎵 Top recommendation: "{top_rec["Track"]}" by {top_rec["Artist"]} (score: {score:.1f})')
+        from catalog import artist_keys, normalize_artist
+        favorite_artists = {normalize_artist(a) for a in ranking['userPreferences']['topArtists']}
+        artist_match_count = sum(1 for r in recommendations if artist_keys(r.get('Artist')) & favorite_artists)
+        print(f'🎯 {artist_match_count} recommendations match your favorite artists')
+        if not artist_match_count:
+            metrics.EVENTS.inc('no_artist_recommendations')
+    
+    return {
+        'recommendations': recommendations,
+        'userPreferences': ranking['userPreferences'],
+        'rankingId': ranking_id
+    }
+
+def build_recommendations(access_token, user_id, use_cache=True):
+    """First page of personalized recommendations and the preferences behind them
+    
+    Returns None if the user has no listening history. Used by the request
+    path and by the background precomputation; the ranking behind the page is
+    cached under rankingId for the following pages.
+    """
+    return first_page(rank_recommendations(access_token, user_id, use_cache))
+
+def no_history_response():
+    """Random recommendations for a user without listening history"""
+    print('⚠️  User has NO listening history across all time ranges')
+    print('⚠️  Returning random recommendations - user needs to listen to music on Spotify first!')
+    metrics.EVENTS.inc('random_fallback')
+    with stage('random_fallback'):
+        random_recommendations = sample_songs(RECOMMENDATION_PAGE_SIZE)
+    
+    # Convert ObjectId to string for JSON serialization
+    with stage('objectid_conversion'):
+        for rec in random_recommendations:
+            rec['_id'] = str(rec['_id'])
+    
+    return {
+        'recommendations': random_recommendations,
+        'userPreferences': {
+            'topArtists': [],
+            'topGenres': [],
+            'avgEnergy': 0.5,
+            'avgDanceability': 0.5,
+            'avgValence': 0.5
+        },
+        'nextCursor': None,
+        'message': 'No listening history found. Please listen to music on Spotify to get personalized recommendations!'
+    }
+
+def precomputed_entry(user_id, refresh_token):
+    """Fresh precomputed recommendations entry for an active user, or None"""
+    if not precomputer or not user_id:
+        return None
+    if refresh_token:
+        precomputer.touch(user_id, refresh_token)
+    entry = precomputer.latest(user_id)
+    if entry is not None:
+        metrics.EVENTS.inc('precomputed_hit')
+        print(f'⚡ Serving precomputed recommendations (version {entry["version"]})')
+    return entry
+
+def result_entry(user_id, result):
+    """Entry for a freshly computed result, kept for the background refresh if it's enabled"""
+    if result is None:
+        return None
+    if precomputer and user_id:
+        return precomputer.store(user_id, result)
+    return {'version': None, 'computed_at': time.time(), 'result': result}
+
+def current_recommendations():
+    """Latest recommendations entry for the session user, computing it if needed
+    
+    Returns {'version', 'computed_at', 'result'}, or None if the user has no
+    listening history.
+    """
+    user_id = session.get('user_id')
+    entry = precomputed_entry(user_id, session.get('refresh_token'))
+    if entry is None:
+        entry = result_entry(user_id, build_recommendations(spotify_token(), user_id))
+    return entry
+
+def catalog_unavailable():
+    """(error, status) while the catalog isn't loaded, else None"""
+    if catalog is not None:
+        return None
+    if startup.error is None:
+        return {'error': 'Song catalog is still loading, try again shortly'}, 503
+    print('❌ Song catalog not loaded!')
+    return {'error': 'Database not connected'}, 500
+
+def resolve_cursor(cursor, user_id):
+    """(ranking_id, ranking, offset, (error, status) or None) for a pagination cursor"""
+    try:
+        ranking_id, offset = parse_cursor(cursor)
+    except ValueError:
+        return None, None, 0, ({'error': 'Invalid cursor'}, 400)
+    ranking = cached_ranking(user_id, ranking_id)
+    if ranking is None:
+        metrics.EVENTS.inc('cursor_expired')
+        return None, None, 0, ({'error': 'Cursor expired, request the first page again'}, 410)
+    return ranking_id, ranking, offset, None
+
+def cursor_page(ranking_id, ranking, offset, limit):
+    """Response body for a page after the first"""
+    with stage('documents'):
+        recommendations = list(ranking_page(ranking, offset, limit))
+    return {'recommendations': recommendations, 'nextCursor': next_cursor(ranking_id, ranking, offset, limit)}
+
+def recommendations_response(entry, user_id, limit, result_key):
+    """Response body for the first page of an entry
+    
+    Also stores a compact copy server-side under result_key for visualization.
+    """
+    result = dict(entry['result'])
+    ranking_id = result.pop('rankingId')
+    ranking = cached_ranking(user_id, ranking_id)
+    if ranking is not None and limit != RECOMMENDATION_PAGE_SIZE:
+        with stage('documents'):
+            result['recommendations'] = list(ranking_page(ranking, 0, limit))
+    
+    with stage('result_store'):
+        result_store.set(result_key, compact_record(result['recommendations'], result['userPreferences']))
+    
+    return {
+        **result,
+        'nextCursor': next_cursor(ranking_id, ranking, 0, limit) if ranking is not None else None,
+        'version': entry['version'],
+        'computedAt': entry['computed_at']
+    }
+
+def entry_ranking(entry, user_id):
+    """(ranking_id, ranking) behind an entry, or None if it has expired"""
+    ranking_id = entry['result']['rankingId']
+    ranking = cached_ranking(user_id, ranking_id)
+    return (ranking_id, ranking) if ranking is not None else None
+
+def ndjson_lines(header, ranking_id, ranking, offset, limit):
+    """NDJSON lines for one page of a ranking: the header, one per song, then the next cursor"""
+    yield app.json.dumps(header) + '\n'
+    for rec in ranking_page(ranking, offset, limit):
+        yield app.json.dumps({'type': 'recommendation', 'recommendation': rec}) + '\n'
+    yield app.json.dumps({'type': 'end', 'nextCursor': next_cursor(ranking_id, ranking, offset, limit)}) + '\n'
+
+def no_history_lines():
+    """NDJSON lines with random recommendations for a user without listening history"""
+    result = no_history_response()
+    lines = [{'type': 'preferences', 'userPreferences': result['userPreferences'], 'message': result['message']}]
+    lines += [{'type': 'recommendation', 'recommendation': rec} for rec in result['recommendations']]
+    lines.append({'type': 'end', 'nextCursor': None})
+    return [app.json.dumps(line) + '\n' for line in lines]
+
+def stream_header(ranking, entry=None):
+    """First NDJSON line of a stream"""
+    header = {'type': 'preferences', 'userPreferences': ranking['userPreferences']}
+    if entry is not None:
+        header.update({'version': entry['version'], 'computedAt': entry['computed_at']})
+    return header
+
 @app.route('/api/recommendations')
 def get_recommendations():
-    """Get recommendations from MongoDB based on user's listening pattern"""
+    """Get recommendations from MongoDB based on user's listening pattern
+    
+    Returns the first `limit` (default 20) songs of a ranking computed once per
+    refresh; pass the returned nextCursor as `cursor` for the following pages.
+    """
     if 'access_token' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        # Try different time ranges to get user's top tracks
-        top_tracks = []
-        time_range_used = ''
-        
-        # Try short_term first (last 4 weeks)
-        try:
-            short_term_response = requests.get(
-                'https://api.spotify.com/v1/me/top/tracks',
-                headers={'Authorization': f'Bearer {session["access_token"]}'},
-                params={'limit': 20, 'time_range': 'short_term'}
-            )
-            if short_term_response.status_code == 200:
-                data = short_term_response.json()
-                top_tracks = data.get('items', [])
-                time_range_used = 'short_term (last 4 weeks)'
-        except:
-            print('⚠️  No short_term data available')
-        
-        # If no short_term data, try medium_term (last 6 months)
-        if not top_tracks:
-            try:
-                medium_term_response = requests.get(
-                    'https://api.spotify.com/v1/me/top/tracks',
-                    headers={'Authorization': f'Bearer {session["access_token"]}'},
-                    params={'limit': 20, 'time_range': 'medium_term'}
-                )
-                if medium_term_response.status_code == 200:
-                    data = medium_term_response.json()
-                    top_tracks = data.get('items', [])
-                    time_range_used = 'medium_term (last 6 months)'
-            except:
-                print('⚠️  No medium_term data available')
-        
-        # If still no data, try long_term (several years)
-        if not top_tracks:
-            try:
-                long_term_response = requests.get(
-                    'https://api.spotify.com/v1/me/top/tracks',
-                    headers={'Authorization': f'Bearer {session["access_token"]}'},
-                    params={'limit': 20, 'time_range': 'long_term'}
-                )
-                if long_term_response.status_code == 200:
-                    data = long_term_response.json()
-                    top_tracks = data.get('items', [])
-                    time_range_used = 'long_term (all time)'
-            except:
-                print('⚠️  No long_term data available')
-        
-        # Check if user has any top tracks across all time ranges
-        if not top_tracks:
-            print('⚠️  User has NO listening history across all time ranges')
-            print('⚠️  Returning random recommendations - user needs to listen to music on Spotify first!')
-            random_recommendations = list(songs_collection.aggregate([
-                {'$sample': {'size': 20}}
-            ]))
-            
-            # Convert ObjectId to string for JSON serialization
-            for rec in random_recommendations:
-                rec['_id'] = str(rec['_id'])
-            
-            return jsonify({
-                'recommendations': random_recommendations,
-                'userPreferences': {
-                    'topArtists': [],
-                    'topGenres': [],
-                    'avgEnergy': 0.5,
-                    'avgDanceability': 0.5,
-                    'avgValence': 0.5
-                },
-                'message': 'No listening history found. Please listen to music on Spotify to get personalized recommendations!'
-            })
-        
-        print(f'✅ Found {len(top_tracks)} top tracks using {time_range_used}')
-        sample_tracks = ', '.join([f'"{t["name"]}" by {t["artists"][0]["name"]}' for t in top_tracks[:3]])
-        print(f'🎵 Sample tracks: {sample_tracks}')
-        
-        # Extract genres and artists from top tracks
-        top_artists = list(set([artist['name'] for track in top_tracks for artist in track['artists']]))
-        top_genres = list(set([genre for track in top_tracks for artist in track['artists'] for genre in artist.get('genres', [])]))
+        limit = page_limit(request.args)
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+    
+    try:
+        unavailable = catalog_unavailable()
+        if unavailable is not None:
+            return unavailable
         
-        print(f'🎤 Your top artists: {", ".join(top_artists[:5])}')
+        user_id = session.get('user_id')
+        cursor = request.args.get('cursor')
+        if cursor:
+            ranking_id, ranking, offset, error = resolve_cursor(cursor, user_id)
+            if error is not None:
+                return error
+            body = cursor_page(ranking_id, ranking, offset, limit)
+            with stage('json_serialization'):
+                return jsonify(body)
         
-        # Find matching songs in MongoDB by artist first
-        artist_matches = list(songs_collection.find(
-            {'Artist': {'$in': top_artists}}
-        ).limit(100))
+        entry = current_recommendations()
+        if entry is None:
+            with stage('json_serialization'):
+                return jsonify(no_history_response())
         
-        print(f'📊 Found {len(artist_matches)} songs in database by your favorite artists')
+        # Store a compact copy server-side for visualization; the cookie only keeps its key
+        result_key = session.get('result_key') or new_key()
+        body = recommendations_response(entry, user_id, limit, result_key)
+        session['result_key'] = result_key
         
-        # Calculate average audio features from the artist matches in our database
-        avg_energy = 0.6  # default values
-        avg_danceability = 0.6
-        avg_valence = 0.6
+        with stage('json_serialization'):
+            return jsonify(body)
+    except SpotifyError as error:
+        return spotify_error_response(error)
+    except Exception as error:
+        print(f'Error generating recommendations: {error}')
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': 'Failed to generate recommendations'}), 500
+
+@app.route('/api/recommendations/stream')
+def stream_recommendations():
+    """Recommendations as newline-delimited JSON, one line per song
+    
+    Takes the same `limit` and `cursor` parameters as /api/recommendations.
+    The first line carries the preferences, each following line one
+    recommendation, and the last line the cursor for the next page. The
+    ranking is complete before the first line is sent; each song's line is
+    written as its document is built.
+    """
+    if 'access_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    try:
+        limit = page_limit(request.args)
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+    
+    try:
+        unavailable = catalog_unavailable()
+        if unavailable is not None:
+            return unavailable
         
-        if artist_matches:
-            # Use the audio features from songs by artists you like
-            avg_energy = sum(s.get('Energy', 0.6) for s in artist_matches) / len(artist_matches)
-            avg_danceability = sum(s.get('Danceability', 0.6) for s in artist_matches) / len(artist_matches)
-            avg_valence = sum(s.get('Valence', 0.6) for s in artist_matches) / len(artist_matches)
-            
-            print(f'🎵 Calculated preferences from {len(artist_matches)} matching songs in database')
+        user_id = session.get('user_id')
+        cursor = request.args.get('cursor')
+        if cursor:
+            ranking_id, ranking, offset, error = resolve_cursor(cursor, user_id)
+            if error is not None:
+                return error
+            header = stream_header(ranking)
         else:
-            print('⚠️  No matching artists in database, using default audio feature values')
-        
-        # Query MongoDB for recommendations
-        print(f'🎯 Generating recommendations with preferences:')
-        print(f'   - Top Artists: {", ".join(top_artists[:5])}')
-        print(f'   - Energy: {avg_energy:.2f}, Danceability: {avg_danceability:.2f}, Valence: {avg_valence:.2f}')
-        
-        if songs_collection is None:
-            print('❌ MongoDB collection not initialized!')
-            return jsonify({'error': 'Database not connected'}), 500
-        
-        # Use aggregation pipeline for better matching and scoring
-        recommendations = list(songs_collection.aggregate([
-            {
-                '$match': {
-                    '$or': [
-                        # Priority 1: Match by artist (exact match)
-                        {'Artist': {'$in': top_artists}},
-                        # Priority 2: Match by similar audio features (wider range for better results)
-                        {
-                            '$and': [
-                                {'Energy': {'$gte': avg_energy - 0.3, '$lte': avg_energy + 0.3}},
-                                {'Danceability': {'$gte': avg_danceability - 0.3, '$lte': avg_danceability + 0.3}}
-                            ]
-                        },
-                        # Priority 3: Match by valence (mood)
-                        {'Valence': {'$gte': avg_valence - 0.3, '$lte': avg_valence + 0.3}}
-                    ]
-                }
-            },
-            {
-                # Add a score field to rank recommendations
-                '$addFields': {
-                    'score': {
-                        '$add': [
-                            # Artist match gets highest score (10 points)
-                            {'$cond': [{'$in': ['$Artist', top_artists]}, 10, 0]},
-                            # Energy similarity (up to 5 points)
-                            {
-                                '$multiply': [
-                                    5,
-                                    {
-                                        '$subtract': [
-                                            1,
-                                            {'$abs': {'$subtract': ['$Energy', avg_energy]}}
-                                        ]
-                                    }
-                                ]
-                            },
-                            # Danceability similarity (up to 5 points)
-                            {
-                                '$multiply': [
-                                    5,
-                                    {
-                                        '$subtract': [
-                                            1,
-                                            {'$abs': {'$subtract': ['$Danceability', avg_danceability]}}
-                                        ]
-                                    }
-                                ]
-                            },
-                            # Valence similarity (up to 3 points)
-                            {
-                                '$multiply': [
-                                    3,
-                                    {
-                                        '$subtract': [
-                                            1,
-                                            {'$abs': {'$subtract': ['$Valence', avg_valence]}}
-                                        ]
-                                    }
-                                ]
-                            }
-                        ]
-                    }
-                }
-            },
-            {'$sort': {'score': -1}},  # Sort by best matches first
-            {'$limit': 20}
-        ]))
-        
-        print(f'✅ Found {len(recommendations)} personalized recommendations')
+            entry = current_recommendations()
+            # Rank again if the precomputed ranking has expired
+            ranked = entry and (entry_ranking(entry, user_id) or rank_recommendations(spotify_token(), user_id))
+            if not ranked:
+                return Response(no_history_lines(), mimetype='application/x-ndjson')
+            ranking_id, ranking = ranked
+            offset = 0
+            header = stream_header(ranking, entry)
+    except SpotifyError as error:
+        return spotify_error_response(error)
+    except Exception as error:
+        print(f'Error generating recommendations: {error}')
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': 'Failed to generate recommendations'}), 500
+    
+    metrics.EVENTS.inc('recommendations_streamed')
+    return Response(
+        stream_with_context(ndjson_lines(header, ranking_id, ranking, offset, limit)),
+        mimetype='application/x-ndjson'
+    )
+
+@app.route('/api/similar')
+def get_similar():
+    """Songs most similar to one catalog song ("more like this")
+    
+    Takes the song's `id` as returned in recommendations and an optional
+    `limit`. Neighbours come from the precomputed similar tracks index.
+    """
+    if 'access_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    song_id = request.args.get('id')
+    if not song_id:
+        return jsonify({'error': 'id is required'}), 400
+    try:
+        limit = page_limit(request.args)
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+    
+    try:
+        unavailable = catalog_unavailable()
+        if unavailable is not None:
+            return unavailable
         
-        if recommendations:
-            top_rec = recommendations[0]
-            score = top_rec.get('score', 0)
-            print(f'🎵 Top recommendation: "{top_rec["Track"]}" by {top_rec["Artist"]} (score: {score:.1f})')
-            artist_match_count = sum(1 for r in recommendations if r['Artist'] in top_artists)
-            print(f'🎯 {artist_match_count} recommendations match your favorite artists')
+        snapshot, index = catalog, similar_tracks
+        if index is None:
+            return jsonify({'error': 'Song catalog is still loading, try again shortly'}), 503
+        with stage('similar_lookup'):
+            row = index.find(snapshot, song_id)
+            if row is None:
+                return jsonify({'error': 'Song not found'}), 404
+            rows, scores = index.similar(snapshot, row, limit)
         
-        # If we didn't find enough recommendations, supplement with random ones
-        if len(recommendations) < 10:
-            print(f'⚠️  Only found {len(recommendations)} matches, adding random songs to reach 20')
-            existing_ids = [r['_id'] for r in recommendations]
-            additional_songs = list(songs_collection.aggregate([
-                {'$match': {'_id': {'$nin': existing_ids}}},
-                {'$sample': {'size': 20 - len(recommendations)}}
-            ]))
-            recommendations.extend(additional_songs)
+        with stage('documents'):
+            track = snapshot.document(row)
+            track['_id'] = str(track['_id'])
+            similar = []
+            for neighbour, score in zip(rows, scores):
+                doc = snapshot.document(neighbour, score)
+                doc['_id'] = str(doc['_id'])
+                similar.append(doc)
         
-        # Convert ObjectId to string for JSON serialization
-        for rec in recommendations:
-            rec['_id'] = str(rec['_id'])
+        with stage('json_serialization'):
+            return jsonify({'track': track, 'similar': similar})
+    except Exception as error:
+        print(f'Error finding similar songs: {error}')
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': 'Failed to find similar songs'}), 500
+
+def batch_profile(snapshot, profile):
+    """Catalog scoring inputs for one batch profile
+    
+    Feature targets left out are derived from the artists' songs, the same
+    way load_user_preferences does for a session user.
+    """
+    artists = profile.get('artists') or []
+    if not isinstance(artists, list):
+        raise TypeError('artists must be a list')
+    artist_rows = snapshot.artist_rows(artists)
+    targets = [profile.get('avgEnergy'), profile.get('avgDanceability'), profile.get('avgValence')]
+    if None in targets:
+        means = snapshot.feature_means(artist_rows, default=0.6) if len(artist_rows) else [0.6, 0.6, 0.6]
+        targets = [means[i] if t is None else float(t) for i, t in enumerate(targets)]
+    return (artist_rows, *[float(t) for t in targets])
+
+def precompute_recommendations(access_token, user_id):
+    """Fresh recommendations for the background refresh, skipping the cached preferences"""
+    if catalog is None:
+        return None
+    return build_recommendations(access_token, user_id, use_cache=False)
+
+precomputer = Precomputer(
+    precompute_recommendations, refresh_access_token,
+    interval=PRECOMPUTE_INTERVAL, active_window=PRECOMPUTE_ACTIVE_WINDOW,
+    workers=PRECOMPUTE_WORKERS, ready=lambda: catalog is not None
+) if PRECOMPUTE else None
+
+@app.route('/api/recommendations/batch', methods=['POST'])
+def get_batch_recommendations():
+    """Recommendations for many preference profiles in one call, for offline jobs
+    
+    Expects {"profiles": [{"id", "artists", "avgEnergy", "avgDanceability", "avgValence"}], "limit": 20}
+    with an "Authorization: Bearer <BATCH_API_KEY>" header. Each profile gets the same
+    recommendations as /api/recommendations would give a user with those preferences,
+    without the random top-up.
+    """
+    if not BATCH_API_KEY:
+        return jsonify({'error': 'Batch recommendations are disabled'}), 404
+    # Compared as bytes; compare_digest raises TypeError on non-ASCII str
+    authorization = request.headers.get('Authorization', '').encode()
+    if not hmac.compare_digest(authorization, f'Bearer {BATCH_API_KEY}'.encode()):
+        return jsonify({'error': 'Not authenticated'}), 401
+    snapshot = catalog
+    if snapshot is None:
+        return jsonify({'error': 'Song catalog is still loading, try again shortly'}), 503
+    
+    body = request.get_json(silent=True) or {}
+    profiles = body.get('profiles')
+    if not isinstance(profiles, list) or not all(isinstance(p, dict) for p in profiles):
+        return jsonify({'error': 'profiles must be a list of objects'}), 400
+    if len(profiles) > BATCH_MAX_PROFILES:
+        return jsonify({'error': f'At most {BATCH_MAX_PROFILES} profiles per request'}), 400
+    
+    try:
+        limit = min(max(int(body.get('limit', 20)), 1), 100)
+        with stage('artist_lookup'):
+            inputs = [batch_profile(snapshot, p) for p in profiles]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'artists must be a list and limit and avg* values numbers'}), 400
+    
+    try:
+        # Re-rank the same way rank_preferences does
+        pool, rerank = limit, None
+        if DIVERSITY:
+            from diversity import diversify
+            pool = max(DIVERSITY_POOL, limit)
+            rerank = lambda rows, scores: diversify(
+                snapshot, rows, scores, limit, DIVERSITY_RELEVANCE_WEIGHT, DIVERSITY_ARTIST_CAP
+            )
+        candidates = max(RECOMMENDATION_CANDIDATES, pool) if RECOMMENDATION_CANDIDATES else None
+        with stage('scoring'):
+            results = snapshot.recommend_batch(inputs, limit=pool, candidates=candidates, rerank=rerank)
         
-        # Store in session for visualization
-        user_preferences = {
-            'topArtists': top_artists[:5],
-            'topGenres': top_genres[:5],
-            'avgEnergy': avg_energy,
-            'avgDanceability': avg_danceability,
-            'avgValence': avg_valence
-        }
-        session['user_preferences'] = user_preferences
-        session['recommendations'] = recommendations
+        with stage('objectid_conversion'):
+            for recommendations in results:
+                for rec in recommendations:
+                    rec['_id'] = str(rec['_id'])
         
-        return jsonify({
-            'recommendations': recommendations,
-            'userPreferences': user_preferences
-        })
+        print(f'📦 Scored {len(profiles)} batch profiles')
+        with stage('json_serialization'):
+            return jsonify({
+                'results': [
+                    {'id': profile.get('id'), 'recommendations': recommendations}
+                    for profile, recommendations in zip(profiles, results)
+                ]
+            })
     except Exception as error:
-        print(f'Error generating recommendations: {error}')
+        print(f'Error generating batch recommendations: {error}')
         import traceback
         traceback.print_exc()
         return jsonify({'error': 'Failed to generate recommendations'}), 500
@@ -399,194 +1247,80 @@ def get_recommendations():
 @app.route('/logout')
 def logout():
     """Logout user"""
+    user_id = session.get('user_id')
+    if user_id:
+        user_cache.invalidate_where(lambda key: key[0] == user_id)
+        ranking_cache.invalidate_where(lambda key: key[0] == user_id)
+    if precomputer and user_id:
+        precomputer.forget(user_id)
+    if 'result_key' in session:
+        result_store.delete(session['result_key'])
     session.clear()
     return redirect('/')
 
+@app.route('/api/ready')
+def ready():
+    """Readiness check with a startup timing breakdown"""
+    return jsonify(startup.report()), 200 if startup.ready else 503
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Request and stage latency histograms and event counters in Prometheus text format"""
+    return app.response_class(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/auth-status')
 def auth_status():
     """Check authentication status"""
     return jsonify({'authenticated': 'access_token' in session})
 
+def load_analysis_inputs():
+    """User averages and recommendation features from the session's stored result
+    
+    Returns None if recommendations haven't been generated yet.
+    """
+    result = result_store.get(session['result_key']) if 'result_key' in session else None
+    if result is None:
+        return None
+    
+    user_prefs = result['preferences']
+    rec_features = result['features']
+    
+    # Extract audio features from recommendations
+    rec_energy = [v for v in rec_features['Energy'] if v is not None]
+    rec_dance = [v for v in rec_features['Danceability'] if v is not None]
+    rec_valence = [v for v in rec_features['Valence'] if v is not None]
+    
+    # User preferences
+    user_vals = [
+        user_prefs.get('avgEnergy', 0.5),
+        user_prefs.get('avgDanceability', 0.5),
+        user_prefs.get('avgValence', 0.5)
+    ]
+    return user_vals, rec_energy, rec_dance, rec_valence
+
 @app.route('/api/visualize-analysis')
 def visualize_analysis():
-    """Generate visualization comparing user preferences with recommendations"""
+    """Analysis numbers comparing user preferences with recommendations"""
     if 'access_token' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    if 'user_preferences' not in session or 'recommendations' not in session:
+    inputs = load_analysis_inputs()
+    if inputs is None:
         return jsonify({'error': 'Generate recommendations first'}), 400
     
+    import numpy as np
+    
     try:
-        user_prefs = session['user_preferences']
-        recommendations = session['recommendations']
-        
-        # Set style for aesthetic graphs
-        plt.style.use('dark_background')
-        
-        # Create figure with subplots
-        fig = plt.figure(figsize=(16, 10))
-        fig.patch.set_facecolor('#121212')
-        
-        # Define colors matching Spotify theme
-        spotify_green = '#1DB954'
-        spotify_white = '#FFFFFF'
-        spotify_gray = '#535353'
-        rec_color = '#FF006C'
-        
-        # Extract audio features from recommendations
-        rec_energy = [r.get('Energy', 0) for r in recommendations if r.get('Energy') is not None]
-        rec_dance = [r.get('Danceability', 0) for r in recommendations if r.get('Danceability') is not None]
-        rec_valence = [r.get('Valence', 0) for r in recommendations if r.get('Valence') is not None]
-        
-        # User preferences
-        user_energy = user_prefs.get('avgEnergy', 0.5)
-        user_dance = user_prefs.get('avgDanceability', 0.5)
-        user_valence = user_prefs.get('avgValence', 0.5)
-        
-        # 1. Radar Chart - Audio Features Comparison
-        ax1 = plt.subplot(2, 3, 1, projection='polar')
-        categories = ['Energy', 'Danceability', 'Valence']
-        N = len(categories)
-        
-        # User data
-        user_values = [user_energy, user_dance, user_valence]
-        user_values += user_values[:1]  # Complete the circle
-        
-        # Recommendations average
-        rec_values = [
-            np.mean(rec_energy) if rec_energy else 0.5,
-            np.mean(rec_dance) if rec_dance else 0.5,
-            np.mean(rec_valence) if rec_valence else 0.5
-        ]
-        rec_values += rec_values[:1]
-        
-        angles = [n / float(N) * 2 * np.pi for n in range(N)]
-        angles += angles[:1]
-        
-        ax1.plot(angles, user_values, 'o-', linewidth=2, color=spotify_green, label='Your Taste')
-        ax1.fill(angles, user_values, alpha=0.25, color=spotify_green)
-        ax1.plot(angles, rec_values, 'o-', linewidth=2, color=rec_color, label='Recommendations')
-        ax1.fill(angles, rec_values, alpha=0.25, color=rec_color)
-        
-        ax1.set_xticks(angles[:-1])
-        ax1.set_xticklabels(categories, color=spotify_white, size=10)
-        ax1.set_ylim(0, 1)
-        ax1.set_title('Audio Features Comparison', color=spotify_white, size=12, pad=20, weight='bold')
-        ax1.legend(loc='upper right', bbox_to_anchor=(1.3, 1.1))
-        ax1.grid(color=spotify_gray, alpha=0.3)
-        
-        # 2. Distribution - Energy
-        ax2 = plt.subplot(2, 3, 2)
-        if rec_energy:
-            ax2.hist(rec_energy, bins=15, alpha=0.7, color=rec_color, edgecolor='white', linewidth=0.5)
-            ax2.axvline(user_energy, color=spotify_green, linestyle='--', linewidth=2, label='Your Average')
-            ax2.set_xlabel('Energy Level', color=spotify_white, size=10)
-            ax2.set_ylabel('Number of Songs', color=spotify_white, size=10)
-            ax2.set_title('Energy Distribution', color=spotify_white, size=12, weight='bold')
-            ax2.legend()
-            ax2.tick_params(colors=spotify_white)
-            ax2.set_facecolor('#1a1a1a')
-        
-        # 3. Distribution - Danceability
-        ax3 = plt.subplot(2, 3, 3)
-        if rec_dance:
-            ax3.hist(rec_dance, bins=15, alpha=0.7, color=rec_color, edgecolor='white', linewidth=0.5)
-            ax3.axvline(user_dance, color=spotify_green, linestyle='--', linewidth=2, label='Your Average')
-            ax3.set_xlabel('Danceability', color=spotify_white, size=10)
-            ax3.set_ylabel('Number of Songs', color=spotify_white, size=10)
-            ax3.set_title('Danceability Distribution', color=spotify_white, size=12, weight='bold')
-            ax3.legend()
-            ax3.tick_params(colors=spotify_white)
-            ax3.set_facecolor('#1a1a1a')
-        
-        # 4. Scatter Plot - Energy vs Danceability
-        ax4 = plt.subplot(2, 3, 4)
-        if rec_energy and rec_dance:
-            ax4.scatter(rec_energy, rec_dance, alpha=0.6, s=100, color=rec_color, edgecolors='white', linewidth=0.5)
-            ax4.scatter([user_energy], [user_dance], s=300, color=spotify_green, marker='*', 
-                       edgecolors='white', linewidth=2, label='Your Profile', zorder=5)
-            ax4.set_xlabel('Energy', color=spotify_white, size=10)
-            ax4.set_ylabel('Danceability', color=spotify_white, size=10)
-            ax4.set_title('Energy vs Danceability', color=spotify_white, size=12, weight='bold')
-            ax4.legend()
-            ax4.grid(True, alpha=0.2, color=spotify_gray)
-            ax4.tick_params(colors=spotify_white)
-            ax4.set_facecolor('#1a1a1a')
-        
-        # 5. Bar Chart - Average Comparison
-        ax5 = plt.subplot(2, 3, 5)
-        metrics = ['Energy', 'Danceability', 'Valence']
-        user_vals = [user_energy, user_dance, user_valence]
+        user_vals, rec_energy, rec_dance, rec_valence = inputs
+        user_energy, user_dance, user_valence = user_vals
         rec_vals = [
             np.mean(rec_energy) if rec_energy else 0,
             np.mean(rec_dance) if rec_dance else 0,
             np.mean(rec_valence) if rec_valence else 0
         ]
         
-        x = np.arange(len(metrics))
-        width = 0.35
-        
-        bars1 = ax5.bar(x - width/2, user_vals, width, label='Your Taste', color=spotify_green, edgecolor='white', linewidth=0.5)
-        bars2 = ax5.bar(x + width/2, rec_vals, width, label='Recommendations', color=rec_color, edgecolor='white', linewidth=0.5)
-        
-        ax5.set_ylabel('Value', color=spotify_white, size=10)
-        ax5.set_title('Average Metrics Comparison', color=spotify_white, size=12, weight='bold')
-        ax5.set_xticks(x)
-        ax5.set_xticklabels(metrics, color=spotify_white)
-        ax5.legend()
-        ax5.tick_params(colors=spotify_white)
-        ax5.set_facecolor('#1a1a1a')
-        ax5.set_ylim(0, 1)
-        
-        # Add value labels on bars
-        for bars in [bars1, bars2]:
-            for bar in bars:
-                height = bar.get_height()
-                ax5.text(bar.get_x() + bar.get_width()/2., height,
-                        f'{height:.2f}',
-                        ha='center', va='bottom', color=spotify_white, size=8)
-        
-        # 6. Box Plot - Feature Distribution
-        ax6 = plt.subplot(2, 3, 6)
-        data_to_plot = []
-        labels = []
-        
-        if rec_energy:
-            data_to_plot.append(rec_energy)
-            labels.append('Energy')
-        if rec_dance:
-            data_to_plot.append(rec_dance)
-            labels.append('Dance')
-        if rec_valence:
-            data_to_plot.append(rec_valence)
-            labels.append('Valence')
-        
-        if data_to_plot:
-            bp = ax6.boxplot(data_to_plot, labels=labels, patch_artist=True,
-                            boxprops=dict(facecolor=rec_color, alpha=0.7, edgecolor='white'),
-                            whiskerprops=dict(color='white'),
-                            capprops=dict(color='white'),
-                            medianprops=dict(color=spotify_green, linewidth=2))
-            
-            ax6.set_ylabel('Value', color=spotify_white, size=10)
-            ax6.set_title('Feature Distribution (Box Plot)', color=spotify_white, size=12, weight='bold')
-            ax6.tick_params(colors=spotify_white)
-            ax6.set_facecolor('#1a1a1a')
-            ax6.set_ylim(0, 1)
-        
-        plt.tight_layout(pad=3.0)
-        
-        # Save to bytes buffer
-        buf = BytesIO()
-        plt.savefig(buf, format='png', dpi=150, facecolor='#121212', edgecolor='none')
-        buf.seek(0)
-        plt.close()
-        
-        # Encode to base64
-        img_base64 = b64.b64encode(buf.getvalue()).decode('utf-8')
-        
         return jsonify({
-            'image': f'data:image/png;base64,{img_base64}',
+            'chart': '/api/visualize-analysis/chart',
             'analysis': {
                 'similarity_score': calculate_similarity_score(user_vals, rec_vals),
                 'energy_match': abs(user_energy - np.mean(rec_energy)) if rec_energy else 0,
@@ -595,6 +1329,55 @@ def visualize_analysis():
             }
         })
         
+    except Exception as error:
+        print(f'Error generating analysis: {error}')
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': 'Failed to generate analysis'}), 500
+
+@app.route('/api/visualize-analysis/chart')
+def visualize_analysis_chart():
+    """Analysis chart as a PNG or SVG image
+    
+    Query parameters: format (png or svg), dpi, width and height (inches).
+    """
+    if 'access_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    inputs = load_analysis_inputs()
+    if inputs is None:
+        return jsonify({'error': 'Generate recommendations first'}), 400
+    
+    fmt = request.args.get('format', 'png')
+    if fmt not in CHART_FORMATS:
+        return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+    try:
+        dpi = min(max(int(request.args.get('dpi', 150)), 30), 300)
+        width = min(max(float(request.args.get('width', 16)), 2), 32)
+        height = min(max(float(request.args.get('height', 10)), 2), 32)
+    except ValueError:
+        return jsonify({'error': 'dpi, width and height must be numbers'}), 400
+    
+    try:
+        # The ETag is a hash of the chart inputs, so unchanged charts are never re-rendered
+        etag = chart_key(*inputs, dpi=dpi, size=(width, height), fmt=fmt)
+        if etag in request.if_none_match:
+            metrics.EVENTS.inc('chart_not_modified')
+            response = app.response_class(status=304)
+        else:
+            phases = []
+            with stage('chart'):
+                image = get_analysis_chart(*inputs, dpi=dpi, size=(width, height), fmt=fmt, phases=phases)
+            # Render phases are timed in the rendering process; a cache hit has none
+            for phase, seconds in phases:
+                metrics.record_stage(request.endpoint, phase, seconds, g.timings)
+            metrics.EVENTS.inc('chart_rendered' if phases else 'chart_cache_hit')
+            response = app.response_class(image, mimetype=CHART_FORMATS[fmt])
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+        
     except Exception as error:
         print(f'Error generating visualization: {error}')
         import traceback
@@ -603,6 +1386,8 @@ def visualize_analysis():
 
 def calculate_similarity_score(user_vals, rec_vals):
     """Calculate overall similarity score between user taste and recommendations"""
+    import numpy as np
+    
     if not user_vals or not rec_vals:
         return 0
     
@@ -615,10 +1400,19 @@ def calculate_similarity_score(user_vals, rec_vals):
     
     return round(similarity, 1)
 
+startup.record('imports', time.perf_counter() - startup.started)
+
 # Start server
-if __name__ == '__main__':
-    connect_to_mongodb()
+def main():
+    """Run the development server (python serve.py)"""
+    connect_to_mongodb(background=BACKGROUND_STARTUP)
+    if precomputer:
+        precomputer.start()
+        print(f'🔄 Refreshing recommendations for active users every {PRECOMPUTE_INTERVAL}s')
     port = int(os.getenv('PORT', 3000))
     print(f'🎵 SpotiRec server running on http://localhost:{port}')
     print(f'🔑 Make sure to set up your .env file with Spotify credentials')
     app.run(host='0.0.0.0', port=port, debug=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+SpotiRec - Artist metadata
+Resolves Spotify artist genres in batches and caches them across users,
+with an index from genre to the artists known to play it
+"""
+
+import threading
+from collections import OrderedDict
+
+from cache import TTLCache
+
+
+class ArtistMetadata:
+    """Long-lived cache of Spotify artists' names and genres
+
+    fetch(access_token, artist_ids) returns full artist objects for the ids it
+    could resolve. Every artist resolved for any user also goes into a genre
+    index, so catalog songs by artists a user never played can be matched on
+    genre. The index keeps the `maxsize` most recently resolved artists.
+    """
+
+    def __init__(self, fetch, ttl=7 * 86400, maxsize=50000):
+        self.fetch = fetch
+        self.maxsize = maxsize
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.fetched = 0
+        self._genres_by_artist = OrderedDict()  # normalized name -> genres
+        self._artists_by_genre = {}             # genre -> set of normalized names
+        self._lock = threading.Lock()
+
+    def resolve(self, access_token, artist_ids):
+        """{artist_id: {'name', 'genres'}} for the given ids, fetching only the uncached ones"""
+        artists, missing = self._cached(artist_ids)
+        if missing:
+            self._store(self.fetch(access_token, missing), artists)
+            self.fetched += len(missing)
+        return artists
+
+    async def resolve_async(self, access_token, artist_ids, fetch):
+        """resolve() for the async server, with an async fetch(access_token, artist_ids)"""
+        artists, missing = self._cached(artist_ids)
+        if missing:
+            self._store(await fetch(access_token, missing), artists)
+            self.fetched += len(missing)
+        return artists
+
+    def _cached(self, artist_ids):
+        artists = {}
+        missing = []
+        for artist_id in dict.fromkeys(artist_ids):
+            artist = self.cache.get(artist_id)
+            if artist is None:
+                missing.append(artist_id)
+            else:
+                artists[artist_id] = artist
+        return artists, missing
+
+    def _store(self, fetched, artists):
+        for artist in fetched:
+            entry = {'name': artist.get('name'), 'genres': list(artist.get('genres') or [])}
+            self.cache.set(artist['id'], entry)
+            self._index(entry)
+            artists[artist['id']] = entry
+
+    def _index(self, artist):
+        if not isinstance(artist['name'], str):
+            return
+        # Imported here so loading this module doesn't pull in NumPy
+        from catalog import normalize_artist
+        key = normalize_artist(artist['name'])
+        genres = set(artist['genres'])
+        with self._lock:
+            self._unindex(key)
+            self._genres_by_artist[key] = genres
+            for genre in genres:
+                self._artists_by_genre.setdefault(genre, set()).add(key)
+            while len(self._genres_by_artist) > self.maxsize:
+                self._unindex(next(iter(self._genres_by_artist)))
+
+    def _unindex(self, key):
+        for genre in self._genres_by_artist.pop(key, ()):
+            names = self._artists_by_genre.get(genre)
+            if names is not None:
+                names.discard(key)
+                if not names:
+                    del self._artists_by_genre[genre]
+
+    def related_artists(self, genre_weights, limit=500):
+        """{normalized artist name: affinity} for known artists sharing the weighted genres
+
+        An artist's affinity is the weight of its best matching genre; the
+        `limit` artists with the highest affinity are kept.
+        """
+        affinity = {}
+        with self._lock:
+            for genre, weight in genre_weights.items():
+                for key in self._artists_by_genre.get(genre, ()):
+                    if weight > affinity.get(key, 0):
+                        affinity[key] = weight
+        if len(affinity) > limit:
+            affinity = dict(sorted(affinity.items(), key=lambda item: -item[1])[:limit])
+        return affinity
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats.update({'fetched': self.fetched, 'indexed': len(self._genres_by_artist)})
+        return stats
+
+
+def genre_weights(artists, weights=None):
+    """Relative weight of each genre across the given artist entries, 1.0 for the most common
+
+    Each artist counts once, or by its entry in `weights` if given.
+    """
+    counts = {}
+    for i, artist in enumerate(artists):
+        weight = 1 if weights is None else weights[i]
+        for genre in artist['genres']:
+            counts[genre] = counts.get(genre, 0) + weight
+    top = max(counts.values(), default=0)
+    if top <= 0:
+        return {}
+    return {genre: count / top for genre, count in sorted(counts.items(), key=lambda item: -item[1])}
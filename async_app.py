@@ -0,0 +1,342 @@
+"""
+SpotiRec - Async server
+ASGI entry point that serves the Spotify-facing endpoints on an event loop,
+so requests waiting on Spotify don't each hold a worker thread
+
+Usage:
+    python serve.py async
+    uvicorn async_app:application --port 3000
+
+/api/user, /api/top-tracks, /api/recommendations and /api/recommendations/stream
+are handled here with the same JSON contracts as app.py; Spotify calls go
+through an httpx.AsyncClient and the catalog scoring runs on a thread. Every
+other route is passed through to the Flask app, which reads the same session
+cookie. The catalog, caches and result store are the ones app.py sets up.
+"""
+
+import asyncio
+import os
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+from quart import Quart, Response, g, jsonify, request, session
+
+import app as flask_app
+import metrics
+import spotify_client
+from result_store import new_key
+from spotify_gateway import SpotifyError
+
+api = Quart(__name__, static_folder=None)
+api.secret_key = flask_app.app.secret_key
+api.config.update({
+    key: flask_app.app.config[key] for key in (
+        'SESSION_COOKIE_NAME', 'SESSION_COOKIE_SECURE', 'SESSION_COOKIE_HTTPONLY',
+        'SESSION_COOKIE_SAMESITE', 'PERMANENT_SESSION_LIFETIME',
+    )
+})
+
+# Everything not routed on `api` runs in the Flask app on a thread pool
+wsgi = WsgiToAsgi(flask_app.app)
+
+# Instrumentation
+
+@api.before_serving
+async def start():
+    """Connect and load the catalog, as `python app.py` does before serving"""
+    await asyncio.to_thread(flask_app.connect_to_mongodb, background=flask_app.BACKGROUND_STARTUP)
+    if flask_app.precomputer:
+        flask_app.precomputer.start()
+        print(f'🔄 Refreshing recommendations for active users every {flask_app.PRECOMPUTE_INTERVAL}s')
+
+@api.after_serving
+async def stop():
+    await spotify_client.close_async()
+
+@api.before_request
+async def start_timer():
+    metrics.current_request.set((request.endpoint, []))
+    g.request_started = time.perf_counter()
+
+@api.after_request
+async def record_request(response):
+    """Record request latency and attach the Server-Timing header, like the Flask app"""
+    elapsed = time.perf_counter() - g.pop('request_started', time.perf_counter())
+    metrics.REQUEST_SECONDS.observe(request.endpoint or 'unknown', str(response.status_code), value=elapsed)
+    current = metrics.current_request.get()
+    if flask_app.SERVER_TIMING and current is not None:
+        response.headers['Server-Timing'] = metrics.server_timing_header(current[1] + [('total', elapsed)])
+    if 'Origin' in request.headers:
+        # Same policy as flask_cors' defaults on the Flask app
+        response.headers['Access-Control-Allow-Origin'] = '*'
+    flask_app.save_renewed_token(session, g.get('spotify_token'))
+    return response
+
+def spotify_token():
+    """Async server's app.spotify_token"""
+    if 'spotify_token' not in g:
+        g.spotify_token = flask_app.user_token(session)
+    return g.spotify_token
+
+# Spotify I/O
+
+async def fetch_user_profile(access_token):
+    """Async app.fetch_user_profile"""
+    user_id = session.get('user_id')
+    profile = flask_app.user_cache.get((user_id, 'profile')) if user_id else None
+    if profile is not None:
+        return profile
+
+    response = await spotify_client.get_async('/me', access_token)
+    if response.status_code != 200:
+        return None
+
+    profile = response.json()
+    session['user_id'] = profile['id']
+    flask_app.user_cache.set((profile['id'], 'profile'), profile)
+    return profile
+
+async def load_user_preferences(access_token, snapshot, user_id=None):
+    """Async app.load_user_preferences"""
+    if flask_app.TASTE_PROFILES and user_id:
+        return await load_profile_preferences(access_token, snapshot, user_id)
+
+    with flask_app.stage('spotify_top_tracks'):
+        top_tracks, time_range_used = await spotify_client.get_top_tracks_with_fallback_async(access_token, limit=20)
+
+    if not top_tracks:
+        return None
+
+    try:
+        with flask_app.stage('spotify_artists'):
+            artists = await flask_app.artist_metadata.resolve_async(
+                access_token, flask_app.top_track_artist_ids(top_tracks), spotify_client.get_artists_async
+            )
+    except Exception as error:
+        print(f'⚠️  Could not resolve artist genres: {error}')
+        metrics.EVENTS.inc('artist_genres_failed')
+        artists = {}
+
+    return await asyncio.to_thread(flask_app.preferences_from_top_tracks, top_tracks, time_range_used, artists, snapshot)
+
+async def load_profile_preferences(access_token, snapshot, user_id):
+    """Async app.load_profile_preferences"""
+    profile = flask_app.taste_profiles.get(user_id)
+    top_tracks = []
+    if profile is None:
+        with flask_app.stage('spotify_top_tracks'):
+            top_tracks, _ = await spotify_client.get_top_tracks_with_fallback_async(access_token, limit=20)
+
+    with flask_app.stage('spotify_recently_played'):
+        plays = await spotify_client.get_recently_played_async(access_token, after=profile['cursor'] if profile else None)
+
+    profile = await asyncio.to_thread(flask_app.update_taste_profile, user_id, snapshot, plays, top_tracks, profile)
+    if profile is None:
+        return None
+
+    top = flask_app.taste_profiles.top_artists(profile, flask_app.TASTE_PROFILE_ARTISTS)
+    try:
+        with flask_app.stage('spotify_artists'):
+            artists = await flask_app.artist_metadata.resolve_async(
+                access_token, [artist_id for artist_id, _, _ in top], spotify_client.get_artists_async
+            )
+    except Exception as error:
+        print(f'⚠️  Could not resolve artist genres: {error}')
+        metrics.EVENTS.inc('artist_genres_failed')
+        artists = {}
+
+    return flask_app.preferences_from_profile(profile, artists)
+
+async def rank_recommendations(access_token, user_id):
+    """Async app.rank_recommendations"""
+    snapshot = flask_app.catalog
+
+    preferences = flask_app.cached_preferences(user_id)
+    if preferences is None:
+        preferences = await load_user_preferences(access_token, snapshot, user_id)
+        if preferences is not None and user_id:
+            flask_app.user_cache.set((user_id, 'preferences'), preferences)
+
+    if preferences is None:
+        return None
+    return await asyncio.to_thread(flask_app.rank_preferences, user_id, preferences, snapshot)
+
+async def current_recommendations():
+    """Async app.current_recommendations"""
+    user_id = session.get('user_id')
+    entry = flask_app.precomputed_entry(user_id, session.get('refresh_token'))
+    if entry is None:
+        ranked = await rank_recommendations(spotify_token(), user_id)
+        result = await asyncio.to_thread(flask_app.first_page, ranked)
+        entry = flask_app.result_entry(user_id, result)
+    return entry
+
+# Routes
+
+@api.route('/api/user')
+async def get_user():
+    """Get user profile"""
+    if 'access_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    try:
+        profile = await fetch_user_profile(spotify_token())
+
+        if profile is None:
+            return jsonify({'error': 'Failed to fetch user profile'}), 500
+
+        return jsonify(profile)
+    except SpotifyError as error:
+        return flask_app.spotify_error_response(error)
+    except Exception as error:
+        print(f'Error fetching user profile: {error}')
+        return jsonify({'error': 'Failed to fetch user profile'}), 500
+
+@api.route('/api/top-tracks')
+async def get_top_tracks():
+    """Get user's top tracks"""
+    if 'access_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    try:
+        user_id = session.get('user_id')
+        cache_key = (user_id, 'top_tracks', 'medium_term')
+        top_tracks = flask_app.user_cache.get(cache_key) if user_id else None
+
+        if top_tracks is None:
+            response = await spotify_client.get_async(
+                '/me/top/tracks',
+                spotify_token(),
+                params={'limit': 20, 'time_range': 'medium_term'}
+            )
+
+            if response.status_code != 200:
+                return jsonify({'error': 'Failed to fetch top tracks'}), 500
+
+            top_tracks = response.json()
+            if user_id:
+                flask_app.user_cache.set(cache_key, top_tracks)
+
+        return jsonify(top_tracks)
+    except SpotifyError as error:
+        return flask_app.spotify_error_response(error)
+    except Exception as error:
+        print(f'Error fetching top tracks: {error}')
+        return jsonify({'error': 'Failed to fetch top tracks'}), 500
+
+@api.route('/api/recommendations')
+async def get_recommendations():
+    """Async app.get_recommendations"""
+    if 'access_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    try:
+        limit = flask_app.page_limit(request.args)
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+
+    try:
+        unavailable = flask_app.catalog_unavailable()
+        if unavailable is not None:
+            return unavailable
+
+        user_id = session.get('user_id')
+        cursor = request.args.get('cursor')
+        if cursor:
+            ranking_id, ranking, offset, error = flask_app.resolve_cursor(cursor, user_id)
+            if error is not None:
+                return error
+            body = await asyncio.to_thread(flask_app.cursor_page, ranking_id, ranking, offset, limit)
+            with flask_app.stage('json_serialization'):
+                return jsonify(body)
+
+        entry = await current_recommendations()
+        if entry is None:
+            with flask_app.stage('json_serialization'):
+                return jsonify(flask_app.no_history_response())
+
+        # Store a compact copy server-side for visualization; the cookie only keeps its key
+        result_key = session.get('result_key') or new_key()
+        body = await asyncio.to_thread(flask_app.recommendations_response, entry, user_id, limit, result_key)
+        session['result_key'] = result_key
+
+        with flask_app.stage('json_serialization'):
+            return jsonify(body)
+    except SpotifyError as error:
+        return flask_app.spotify_error_response(error)
+    except Exception as error:
+        print(f'Error generating recommendations: {error}')
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': 'Failed to generate recommendations'}), 500
+
+@api.route('/api/recommendations/stream')
+async def stream_recommendations():
+    """Async app.stream_recommendations
+
+    Same lines as app.py, sent once the ranking and the whole page are ready
+    rather than one at a time, since the documents are built off the event loop.
+    """
+    if 'access_token' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    try:
+        limit = flask_app.page_limit(request.args)
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+
+    try:
+        unavailable = flask_app.catalog_unavailable()
+        if unavailable is not None:
+            return unavailable
+
+        user_id = session.get('user_id')
+        cursor = request.args.get('cursor')
+        if cursor:
+            ranking_id, ranking, offset, error = flask_app.resolve_cursor(cursor, user_id)
+            if error is not None:
+                return error
+            header = flask_app.stream_header(ranking)
+        else:
+            entry = await current_recommendations()
+            ranked = entry and flask_app.entry_ranking(entry, user_id)
+            if entry and not ranked:
+                # The precomputed ranking has been evicted; rank again
+                ranked = await rank_recommendations(spotify_token(), user_id)
+            if not ranked:
+                return Response(''.join(flask_app.no_history_lines()), mimetype='application/x-ndjson')
+            ranking_id, ranking = ranked
+            offset = 0
+            header = flask_app.stream_header(ranking, entry)
+    except SpotifyError as error:
+        return flask_app.spotify_error_response(error)
+    except Exception as error:
+        print(f'Error generating recommendations: {error}')
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': 'Failed to generate recommendations'}), 500
+
+    # The page's documents are built on a thread too, so the lines go out together once it's done
+    lines = await asyncio.to_thread(list, flask_app.ndjson_lines(header, ranking_id, ranking, offset, limit))
+    metrics.EVENTS.inc('recommendations_streamed')
+    return Response(''.join(lines), mimetype='application/x-ndjson')
+
+ASYNC_PATHS = {rule.rule for rule in api.url_map.iter_rules()}
+
+async def application(scope, receive, send):
+    """ASGI app: the routes above on the event loop, everything else through Flask"""
+    if scope['type'] == 'lifespan' or scope.get('path') in ASYNC_PATHS:
+        await api(scope, receive, send)
+    else:
+        await wsgi(scope, receive, send)
+
+def main():
+    """Run the server with uvicorn (python serve.py async)"""
+    import uvicorn
+
+    port = int(os.getenv('PORT', 3000))
+    print(f'🎵 SpotiRec async server running on http://localhost:{port}')
+    uvicorn.run(application, host='0.0.0.0', port=port)
+
+if __name__ == '__main__':
+    main()
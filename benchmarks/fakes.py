@@ -0,0 +1,174 @@
+"""
+SpotiRec - Benchmark stand-ins
+Synthetic song catalogs, an in-memory replacement for the songs collection
+and a stub Spotify Web API server that replays canned payloads
+"""
+
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+ALBUM_TYPES = ['album', 'single', 'compilation']
+
+
+def artist_name(i):
+    return f'Artist {i:06d}'
+
+
+def synthetic_songs(count, artists=None, seed=0):
+    """Songs with the cleaned_copy3 schema and random audio features"""
+    rng = np.random.default_rng(seed)
+    artists = artists or max(count // 20, 1)
+    artist_ids = rng.integers(0, artists, count)
+    features = rng.random((count, 3), dtype=np.float32).round(3)
+    return [
+        {
+            '_id': i,
+            'Artist': artist_name(int(artist_ids[i])),
+            'Track': f'Track {i}',
+            'Album': f'Album {i // 12}',
+            'Album_type': ALBUM_TYPES[i % 3],
+            'Energy': float(features[i, 0]),
+            'Danceability': float(features[i, 1]),
+            'Valence': float(features[i, 2]),
+        }
+        for i in range(count)
+    ], artists
+
+
+class FakeCollection:
+    """Just enough of the pymongo Collection API for the app's query paths"""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def estimated_document_count(self):
+        return len(self.documents)
+
+    def count_documents(self, query):
+        return len(self.documents)
+
+    def find(self, query=None, projection=None):
+        return iter(self.documents)
+
+
+def top_tracks_payload(artists, count, seed):
+    """Spotify top-tracks response with `count` tracks by catalog artists"""
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        artist = rng.randrange(artists)
+        items.append({
+            'id': f'track{seed}-{i}',
+            'name': f'Top Track {i}',
+            'artists': [{'id': f'artist{artist}', 'name': artist_name(artist)}],
+        })
+    return {'items': items}
+
+
+def recently_played_payload(artists, token, started, after=None, limit=50):
+    """Spotify recently-played response: a play every ten minutes before `started`, newest first"""
+    tracks = top_tracks_payload(artists, 30, seed=zlib.crc32(f'{token}:recent'.encode('utf-8')))['items']
+    items = []
+    for i, track in enumerate(tracks):
+        played_at = int((started - i * 600) * 1000)
+        if after is not None and played_at <= after:
+            continue
+        items.append({
+            'track': track,
+            'played_at': datetime.fromtimestamp(played_at / 1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+        })
+    return {'items': items[:limit]}
+
+
+def artists_payload(ids):
+    """Spotify several-artists response, with a few genres derived from each artist number"""
+    artists = []
+    for artist_id in ids:
+        number = int(artist_id[len('artist'):]) if artist_id[len('artist'):].isdigit() else 0
+        artists.append({
+            'id': artist_id,
+            'name': artist_name(number),
+            'genres': [f'genre{number % 40}', f'genre{number % 7 + 40}'],
+        })
+    return {'artists': artists}
+
+
+class StubSpotify:
+    """Local HTTP server that answers /me, /me/top/tracks, /me/player/recently-played and /artists
+    from canned payloads
+
+    The access token selects the listening profile: tokens starting with
+    'empty' have no history in any time range, 'thin' only has a few
+    long_term tracks, anything else has 20 tracks in every range. Every user
+    but 'empty' ones has 30 plays before the stub started.
+    """
+
+    def __init__(self, artists):
+        self.artists = artists
+        self.started = time.time()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def payload(self, token, path, query):
+        if path.endswith('/me'):
+            return {'id': token, 'display_name': token}
+        if path.endswith('/me/top/tracks'):
+            time_range = query.get('time_range', ['medium_term'])[0]
+            if token.startswith('empty'):
+                count = 0
+            elif token.startswith('thin'):
+                count = 3 if time_range == 'long_term' else 0
+            else:
+                count = 20
+            return top_tracks_payload(self.artists, count, seed=zlib.crc32(f'{token}:{time_range}'.encode('utf-8')))
+        if path.endswith('/me/player/recently-played'):
+            if token.startswith('empty'):
+                return {'items': []}
+            after = query.get('after', [None])[0]
+            limit = int(query.get('limit', ['50'])[0])
+            return recently_played_payload(self.artists, token, self.started, int(after) if after else None, limit)
+        if path.endswith('/artists'):
+            return artists_payload(query.get('ids', [''])[0].split(','))
+        return None
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                token = self.headers.get('Authorization', '')[len('Bearer '):]
+                body = stub.payload(token, url.path, parse_qs(url.query))
+                data = json.dumps(body if body is not None else {'error': 'not found'}).encode('utf-8')
+                self.send_response(200 if body is not None else 404)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
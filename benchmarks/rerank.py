@@ -0,0 +1,84 @@
+"""
+SpotiRec - Diversity re-ranking benchmark
+Times the MMR re-ranking stage against a synthetic catalog for several pool
+sizes, next to the scoring that produces the pool, and reports how much it
+spreads the first page over artists
+
+Usage:
+    python benchmarks/rerank.py --size 1000000 --pools 100 250 500 1000 2000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import Catalog
+from diversity import diversify
+from fakes import artist_name, synthetic_songs
+
+PAGE = 20
+
+
+def percentile(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000, 3)
+
+
+def first_page_stats(snapshot, rows, scores):
+    """Distinct artists, most songs by one artist and mean score on the first page"""
+    _, counts = np.unique(snapshot.primary_artists(rows[:PAGE]), return_counts=True)
+    return len(counts), int(counts.max()), float(np.nanmean(scores[:PAGE]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the diversity re-ranking stage')
+    parser.add_argument('--size', type=int, default=1_000_000, help='catalog size')
+    parser.add_argument('--pools', type=int, nargs='+', default=[100, 250, 500, 1000, 2000], help='pool sizes')
+    parser.add_argument('--depth', type=int, default=200, help='songs kept in the re-ranked ranking')
+    parser.add_argument('--profiles', type=int, default=200, help='random preference profiles per pool size')
+    parser.add_argument('--relevance-weight', type=float, default=0.7, help='MMR relevance/diversity weight')
+    parser.add_argument('--artist-cap', type=int, default=3, help='songs per artist before the rest (0 = no cap)')
+    parser.add_argument('--seed', type=int, default=0, help='synthetic catalog seed')
+    args = parser.parse_args()
+
+    print(f'🎲 Generating {args.size:,} synthetic songs...', file=sys.stderr)
+    documents, artists = synthetic_songs(args.size, seed=args.seed)
+    snapshot = Catalog(documents)
+    rng = np.random.default_rng(args.seed)
+    # Five favorite artists and a feature target per simulated user, like load_user_preferences gives
+    profiles = [
+        (snapshot.artist_rows([artist_name(int(a)) for a in rng.integers(0, artists, 5)]), *rng.random(3))
+        for _ in range(args.profiles)
+    ]
+
+    print(f'{"pool":>6} {"scoring p50":>12} {"rerank p50":>11} {"rerank p95":>11} '
+          f'{"artists/page":>18} {"max per artist":>15} {"mean score":>16}')
+    for pool in args.pools:
+        scoring, rerank, before, after = [], [], [], []
+        for artist_rows, energy, danceability, valence in profiles:
+            started = time.perf_counter()
+            rows, scores = snapshot.rank(
+                artist_rows, energy, danceability, valence, limit=pool, candidates=max(pool, 500)
+            )
+            scoring.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            ranked_rows, ranked_scores = diversify(
+                snapshot, rows, scores, args.depth, args.relevance_weight, args.artist_cap
+            )
+            rerank.append(time.perf_counter() - started)
+            before.append(first_page_stats(snapshot, rows, scores))
+            after.append(first_page_stats(snapshot, ranked_rows, ranked_scores))
+        before, after = np.mean(before, axis=0), np.mean(after, axis=0)
+        print(
+            f'{pool:>6} {percentile(scoring, 50):>10}ms {percentile(rerank, 50):>9}ms {percentile(rerank, 95):>9}ms '
+            f'{before[0]:>7.1f} -> {after[0]:>5.1f} {before[1]:>6.1f} -> {after[1]:>4.1f} '
+            f'{before[2]:>6.2f} -> {after[2]:>5.2f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
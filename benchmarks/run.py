@@ -0,0 +1,226 @@
+"""
+SpotiRec - Offline benchmark harness
+Runs the Flask app against a synthetic in-memory catalog and a stub Spotify
+server, drives concurrent clients at the recommendation and visualization
+endpoints and reports throughput and latency percentiles
+
+Usage:
+    python benchmarks/run.py --sizes 10000 1000000 --requests 500 --concurrency 16
+    python benchmarks/run.py --sizes 10000 --baseline benchmarks/results/previous.json
+
+The client, the app and the stubs share one process, so absolute numbers
+include client overhead; compare runs made on the same machine.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeCollection, StubSpotify, synthetic_songs
+
+DEFAULT_SIZES = [10_000, 1_000_000, 10_000_000]
+ENDPOINTS = [
+    '/api/recommendations',
+    '/api/visualize-analysis',
+    '/api/visualize-analysis/chart',
+]
+# Share of simulated users per listening profile (see StubSpotify)
+PROFILE_MIX = [('full', 0.8), ('thin', 0.1), ('empty', 0.1)]
+
+
+def quiet(args):
+    """Silence the app's per-request log unless --verbose was given"""
+    if args.verbose:
+        return contextlib.nullcontext()
+    return contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+
+def summarize(latencies, errors, elapsed):
+    """Throughput and latency percentiles for one endpoint run"""
+    ms = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'mean_ms': round(float(ms.mean()), 2) if len(ms) else None,
+        'p50_ms': round(float(np.percentile(ms, 50)), 2) if len(ms) else None,
+        'p95_ms': round(float(np.percentile(ms, 95)), 2) if len(ms) else None,
+        'p99_ms': round(float(np.percentile(ms, 99)), 2) if len(ms) else None,
+    }
+
+
+def user_tokens(count):
+    """Access tokens for simulated users, spread across listening profiles"""
+    tokens = []
+    for profile, share in PROFILE_MIX:
+        tokens += [f'{profile}-{i}' for i in range(max(int(count * share), 1))]
+    return tokens
+
+
+def make_client(app, base_url, token):
+    """HTTP session carrying a signed Flask session cookie for the given token"""
+    client = requests.Session()
+    # The stub uses the token as the Spotify user id
+    cookie = app.session_interface.get_signing_serializer(app).dumps({'access_token': token, 'user_id': token})
+    client.cookies.set(app.config['SESSION_COOKIE_NAME'], cookie, domain='127.0.0.1', path='/')
+    client.base_url = base_url
+    return client
+
+
+def drive(clients, path, total, concurrency):
+    """Send `total` GET requests round-robin over the clients and time each one"""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def call(n):
+        nonlocal errors
+        client = clients[n % len(clients)]
+        started = time.perf_counter()
+        try:
+            ok = client.get(f'{client.base_url}{path}', timeout=120).status_code < 400
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            errors += 0 if ok else 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, range(total)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def bench_catalog_size(app_module, base_url, size, args):
+    """Benchmark every endpoint against a synthetic catalog of `size` songs"""
+    import charts
+    import spotify_client
+
+    print(f'🎲 Generating {size:,} synthetic songs...', file=sys.stderr)
+    documents, artists = synthetic_songs(size, seed=args.seed)
+    app_module.songs_collection = FakeCollection(documents)
+    app_module.catalog = None
+    app_module.user_cache.clear()
+    charts.chart_cache.clear()
+
+    with quiet(args):
+        app_module.load_catalog()
+
+    stub = StubSpotify(artists).start()
+    spotify_client.API_BASE_URL = stub.url
+
+    tokens = user_tokens(args.users)
+    clients = [make_client(app_module.app, base_url, token) for token in tokens]
+    # Only users with history get stored results to visualize
+    history_clients = [c for c, t in zip(clients, tokens) if not t.startswith('empty')]
+
+    results = []
+    try:
+        with quiet(args):
+            for path in ENDPOINTS:
+                targets = clients if path == '/api/recommendations' else history_clients
+                if path != '/api/recommendations':
+                    # Make sure each session has a stored result to visualize
+                    drive(targets, '/api/recommendations', len(targets), args.concurrency)
+                stats = drive(targets, path, args.requests, args.concurrency)
+                results.append({'catalog_size': size, 'endpoint': path, **stats})
+    finally:
+        stub.stop()
+
+    for row in results:
+        print(
+            f"📈 {size:>11,} {row['endpoint']:<32} {row['throughput_rps']:>8} req/s  "
+            f"p50 {row['p50_ms']}ms  p95 {row['p95_ms']}ms  p99 {row['p99_ms']}ms  errors {row['errors']}",
+            file=sys.stderr
+        )
+    return results
+
+
+def compare(results, baseline_path, tolerance):
+    """Regressions where p95 latency grew by more than `tolerance` over the baseline"""
+    with open(baseline_path) as f:
+        baseline = {(r['catalog_size'], r['endpoint']): r for r in json.load(f)['results']}
+    regressions = []
+    for row in results:
+        before = baseline.get((row['catalog_size'], row['endpoint']))
+        if before and before['p95_ms'] and row['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append({**row, 'baseline_p95_ms': before['p95_ms']})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SpotiRec endpoints offline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='catalog sizes to test')
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint and size')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--users', type=int, default=200, help='simulated users')
+    parser.add_argument('--seed', type=int, default=0, help='synthetic catalog seed')
+    parser.add_argument('--output', help='results file (default benchmarks/results/bench-<timestamp>.json)')
+    parser.add_argument('--baseline', help='earlier results file to check for p95 regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 growth over the baseline')
+    parser.add_argument('--verbose', action='store_true', help='show the app log')
+    args = parser.parse_args()
+
+    # The stub has no rate limit, so keep the gateway's Spotify budget out of the numbers
+    os.environ.setdefault('SPOTIFY_RATE_LIMIT', '1000000')
+    os.environ.setdefault('SPOTIFY_RATE_BURST', '1000000')
+    import app as app_module
+
+    if not args.verbose:
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    results = []
+    try:
+        for size in args.sizes:
+            results += bench_catalog_size(app_module, base_url, size, args)
+    finally:
+        server.shutdown()
+
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'results', f'bench-{time.strftime("%Y%m%d-%H%M%S")}.json'
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'meta': {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'args': vars(args),
+            },
+            'results': results,
+        }, f, indent=2)
+    print(f'💾 Results saved to {output}', file=sys.stderr)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for row in regressions:
+            print(
+                f"⚠️  Regression: {row['catalog_size']:,} {row['endpoint']} p95 "
+                f"{row['baseline_p95_ms']}ms -> {row['p95_ms']}ms",
+                file=sys.stderr
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,751 @@
+"""
+SpotiRec - In-memory song catalog
+Keeps the songs collection as contiguous feature columns so recommendations
+can be scored with NumPy instead of a MongoDB aggregation per request
+"""
+
+import copy
+import itertools
+import threading
+import unicodedata
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Scoring weights (same as the original aggregation pipeline)
+ARTIST_WEIGHT = 10
+ENERGY_WEIGHT = 5
+DANCEABILITY_WEIGHT = 5
+VALENCE_WEIGHT = 3
+# Added in proportion to how well a song's artist matches the user's genres (0-1)
+GENRE_WEIGHT = 4
+
+# Songs within this distance of the user's average are considered a match
+FEATURE_RANGE = 0.3
+
+# Upper bound on profiles x songs scored at once by recommend_batch, to bound memory
+BATCH_CHUNK_CELLS = 1 << 18
+
+# Songs changed since the KD-tree was built that the feature index compares one by one;
+# past this many, Catalog.updated() rebuilds the tree
+OVERLAY_ROWS = 4096
+
+# Numbers the row layouts of catalogs built in this process (see Catalog.generation)
+_generations = itertools.count(1)
+
+
+def _feature_column(documents, field):
+    """Build a float32 column for a feature, using NaN for missing values"""
+    values = [doc.get(field) for doc in documents]
+    return np.ascontiguousarray(
+        [np.nan if v is None else v for v in values], dtype=np.float32
+    )
+
+
+def normalize_artist(name):
+    """Case- and accent-insensitive form of an artist name"""
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.casefold().split())
+
+
+# Artists whose own name has a comma, so it isn't a list of artists
+COMMA_ARTISTS = frozenset({
+    'blood, sweat & tears',
+    'crosby, stills & nash',
+    'crosby, stills, nash & young',
+    'earth, wind & fire',
+    'emerson, lake & palmer',
+    'peter, paul and mary',
+})
+
+
+def split_artists(name):
+    """Normalized keys of the individual artists in a catalog artist string
+
+    Splits "A, B" on commas, but keeps an inverted article ("Tyler, The
+    Creator") and the names in COMMA_ARTISTS ("Earth, Wind & Fire") whole.
+    Other artists with a comma in their name are still split.
+    """
+    parts = [normalize_artist(part) for part in name.split(',')]
+    artists = []
+    start = 0
+    while start < len(parts):
+        # Longest known comma name starting here, else one part and its inverted article
+        end = next((stop for stop in range(len(parts), start + 1, -1)
+                    if ', '.join(parts[start:stop]) in COMMA_ARTISTS), None)
+        if end is None:
+            end = start + 1
+            if end < len(parts) and parts[end].startswith('the '):
+                end += 1
+        artists.append(', '.join(parts[start:end]))
+        start = end
+    return [artist for artist in artists if artist]
+
+
+def artist_keys(name):
+    """Normalized keys a catalog artist string is indexed under
+
+    Multi-artist strings like "A, B" are indexed under the full string and
+    under each individual artist, as split by split_artists().
+    """
+    if not isinstance(name, str):
+        return set()
+    keys = {normalize_artist(name)}
+    if ',' in name:
+        keys.update(split_artists(name))
+    keys.discard('')
+    return keys
+
+
+def primary_artist(name):
+    """Normalized key of the first artist in a catalog artist string ("A, B" and "Á" give "a")"""
+    if not isinstance(name, str):
+        return ''
+    artists = split_artists(name)
+    return artists[0] if artists else ''
+
+
+def _contains(sorted_values, values):
+    """Mask of the values that are in a sorted array"""
+    if not len(sorted_values):
+        return np.zeros(np.shape(values), dtype=bool)
+    position = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[position] == values
+
+
+def _group_rows(artist_names, artist_codes):
+    """Catalog rows sorted by artist code, and where each code's rows start
+
+    Deleted rows have code -1 and sort before every artist.
+    """
+    order = np.argsort(artist_codes, kind='stable').astype(np.int32)
+    bounds = np.searchsorted(artist_codes[order], np.arange(len(artist_names) + 1))
+    return order, bounds
+
+
+class ArtistIndex:
+    """Inverted index from normalized artist name to catalog rows"""
+
+    def __init__(self, artist_names, artist_codes):
+        # Group catalog rows by artist code
+        order, bounds = _group_rows(artist_names, artist_codes)
+
+        self.codes_by_key = self._codes_by_key(artist_names)
+        self.artist_count = len(artist_names)
+        self.rows = {}
+        for key, codes in self.codes_by_key.items():
+            self._build_postings(key, codes, order, bounds)
+
+    @classmethod
+    def from_postings(cls, rows, artist_count):
+        """Index over postings built elsewhere, e.g. read from a catalog snapshot"""
+        index = cls.__new__(cls)
+        index.rows = rows
+        index.artist_count = artist_count
+        # Only needed by updated(), which rebuilds it from the artist names
+        index.codes_by_key = None
+        return index
+
+    @staticmethod
+    def _codes_by_key(artist_names):
+        codes_by_key = {}
+        for code, name in enumerate(artist_names):
+            for key in artist_keys(name):
+                codes_by_key.setdefault(key, []).append(code)
+        return codes_by_key
+
+    def _build_postings(self, key, codes, order, bounds):
+        parts = [order[bounds[code]:bounds[code + 1]] for code in codes]
+        rows = np.unique(np.concatenate(parts)) if len(parts) > 1 else parts[0]
+        if len(rows):
+            self.rows[key] = rows
+        else:
+            self.rows.pop(key, None)
+
+    def updated(self, artist_names, artist_codes, changed_rows, changed_codes):
+        """Index for a modified catalog, patching only the postings of the changed artists
+
+        `changed_rows` are the sorted rows deleted, replaced or added and
+        `changed_codes` their artists before and after the change.
+        """
+        index = copy.copy(self)
+        if self.codes_by_key is None:
+            self.codes_by_key = self._codes_by_key(artist_names[:self.artist_count])
+        index.codes_by_key = dict(self.codes_by_key)
+        index.rows = dict(self.rows)
+        index.artist_count = len(artist_names)
+
+        affected = set()
+        for code in changed_codes:
+            for key in artist_keys(artist_names[code]):
+                affected.add(key)
+                if code >= self.artist_count and code not in index.codes_by_key.get(key, ()):
+                    index.codes_by_key[key] = index.codes_by_key.get(key, []) + [code]
+
+        # Rows that didn't change keep their artist, so only the changed rows move between postings
+        changed_by_code = {}
+        for row, code in zip(changed_rows.tolist(), artist_codes[changed_rows].tolist()):
+            changed_by_code.setdefault(code, []).append(row)
+        for key in affected:
+            rows = index.rows.get(key, np.empty(0, dtype=np.int32))
+            rows = rows[~_contains(changed_rows, rows)]
+            added = [row for code in index.codes_by_key[key] for row in changed_by_code.get(code, ())]
+            if added:
+                rows = np.union1d(rows, np.array(added, dtype=np.int32))
+            if len(rows):
+                index.rows[key] = rows
+            else:
+                index.rows.pop(key, None)
+        return index
+
+    def lookup(self, artists):
+        """Sorted catalog rows for songs by any of the given artists"""
+        parts = [self.rows[key] for key in {normalize_artist(a) for a in artists} if key in self.rows]
+        if not parts:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate(parts))
+
+
+class FeatureIndex:
+    """KD-tree over (Energy, Danceability, Valence) for nearest-neighbour retrieval
+
+    Axes are scaled by the scoring weights and queried with the L1 metric, so the
+    nearest songs are exactly the ones with the highest audio-feature score.
+    A non-zero eps gives approximate results, trading recall for speed on very
+    large catalogs.
+
+    An index from updated() shares its parent's tree. Tree entries for changed
+    rows are `stale` and skipped, and the rows' current features (`extra_rows`,
+    `extra_points`) are compared with each query directly.
+    """
+
+    WEIGHTS = np.array([ENERGY_WEIGHT, DANCEABILITY_WEIGHT, VALENCE_WEIGHT], dtype=np.float32)
+
+    def __init__(self, energy, danceability, valence, eps=0.0):
+        points = np.column_stack([energy, danceability, valence])
+        # Songs with missing features can't be placed in the tree
+        complete = ~np.isnan(points).any(axis=1)
+        self.rows = np.flatnonzero(complete)
+        self.tree = cKDTree(points[complete] * self.WEIGHTS)
+        self.eps = eps
+        self.stale = np.empty(0, dtype=np.intp)
+        self.extra_rows = np.empty(0, dtype=np.intp)
+        self.extra_points = np.empty((0, 3), dtype=np.float32)
+
+    @property
+    def size(self):
+        """Number of songs in the index"""
+        return len(self.rows) - len(self.stale) + len(self.extra_rows)
+
+    def updated(self, rows, energy, danceability, valence):
+        """Index for the catalog with these columns, where only the given sorted rows changed
+
+        Shares this index's tree until more than OVERLAY_ROWS rows are kept
+        outside it, then builds a new one.
+        """
+        index = copy.copy(self)
+        index.stale = np.union1d(self.stale, rows[_contains(self.rows, rows)])
+        points = np.column_stack([energy[rows], danceability[rows], valence[rows]])
+        complete = ~np.isnan(points).any(axis=1)
+        kept = ~_contains(rows, self.extra_rows)
+        index.extra_rows = np.concatenate([self.extra_rows[kept], rows[complete]])
+        index.extra_points = np.concatenate([self.extra_points[kept], points[complete] * self.WEIGHTS])
+        if len(index.stale) + len(index.extra_rows) > OVERLAY_ROWS:
+            return FeatureIndex(energy, danceability, valence, eps=self.eps)
+        return index
+
+    def nearest(self, targets, k, workers=1):
+        """(distances, rows) of the k closest songs to each (energy, danceability, valence) row of targets
+
+        Both are (targets, k) arrays, closest first; distances are weighted L1.
+        """
+        targets = np.asarray(targets) * self.WEIGHTS
+        count, k = len(targets), min(k, self.size)
+        if k == 0:
+            return np.empty((count, 0)), np.empty((count, 0), dtype=np.intp)
+        if not len(self.stale) and not len(self.extra_rows):
+            distances, nearest = self.tree.query(targets, k=k, p=1, eps=self.eps, workers=workers)
+            return distances.reshape(count, k), self.rows[nearest.reshape(count, k)]
+
+        distances, rows = self._tree_nearest(targets, k, workers)
+        if len(self.extra_rows):
+            extra = np.zeros((count, len(self.extra_rows)))
+            for axis in range(3):
+                extra += np.abs(targets[:, axis:axis + 1].astype(np.float64) - self.extra_points[:, axis])
+            distances = np.hstack([distances, extra])
+            rows = np.hstack([rows, np.broadcast_to(self.extra_rows, extra.shape)])
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+    def _tree_nearest(self, targets, k, workers):
+        """The k closest tree entries to each target that aren't stale, padded with infinite distances"""
+        count, size = len(targets), len(self.rows)
+        distances = np.full((count, k), np.inf)
+        rows = np.zeros((count, k), dtype=np.intp)
+        # Stale entries are rarely among the nearest, so look a little further first and
+        # only search past all of them for targets that came up short
+        pending = np.arange(count)
+        for width in (min(k + min(len(self.stale), 16 + k // 16), size), min(k + len(self.stale), size)):
+            if not len(pending) or not width:
+                break
+            found, nearest = self.tree.query(targets[pending], k=width, p=1, eps=self.eps, workers=workers)
+            found, nearest = found.reshape(len(pending), width), self.rows[nearest.reshape(len(pending), width)]
+            stale = _contains(self.stale, nearest)
+            if stale.any():
+                found[stale] = np.inf
+                order = np.argsort(found, axis=1, kind='stable')
+                found, nearest = np.take_along_axis(found, order, axis=1), np.take_along_axis(nearest, order, axis=1)
+            distances[pending, :min(k, width)] = found[:, :k]
+            rows[pending, :min(k, width)] = nearest[:, :k]
+            pending = pending[np.isinf(distances[pending, -1]) & (width < size)]
+        return distances, rows
+
+    def query(self, avg_energy, avg_danceability, avg_valence, k):
+        """Catalog rows of the k songs closest to the given preferences"""
+        return self.nearest([[avg_energy, avg_danceability, avg_valence]], k)[1][0]
+
+    def query_many(self, targets, k):
+        """Catalog rows of the k closest songs for each (energy, danceability, valence) row of targets"""
+        return self.nearest(targets, k)[1]
+
+
+class _ChangedDocuments(Sequence):
+    """Documents of an updated() catalog: its parent's, with rows replaced, deleted (None) or added"""
+
+    def __init__(self, documents):
+        if isinstance(documents, _ChangedDocuments):
+            self.base, self.changed, self.count = documents.base, dict(documents.changed), documents.count
+        else:
+            self.base, self.changed, self.count = documents, {}, len(documents)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(self.count))]
+        if row < 0:
+            row += self.count
+        if not 0 <= row < self.count:
+            raise IndexError(row)
+        if row in self.changed:
+            return self.changed[row]
+        return self.base[row]
+
+    def __setitem__(self, row, doc):
+        self.changed[row] = doc
+
+    def append(self, doc):
+        self.changed[self.count] = doc
+        self.count += 1
+
+    def to_list(self):
+        documents = list(self.base) + [None] * (self.count - len(self.base))
+        for row, doc in self.changed.items():
+            documents[row] = doc
+        return documents
+
+
+class _ChangedIds(Mapping):
+    """Id table of an updated() catalog: its parent's, with ids added (row) or removed (None)"""
+
+    def __init__(self, rows_by_id):
+        if isinstance(rows_by_id, _ChangedIds):
+            self.base, self.changed = rows_by_id.base, dict(rows_by_id.changed)
+        else:
+            self.base, self.changed = rows_by_id, {}
+
+    def __getitem__(self, song_id):
+        row = self.changed[song_id] if song_id in self.changed else self.base[song_id]
+        if row is None:
+            raise KeyError(song_id)
+        return row
+
+    def __iter__(self):
+        for song_id in self.base:
+            if song_id not in self.changed:
+                yield song_id
+        for song_id, row in self.changed.items():
+            if row is not None:
+                yield song_id
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __setitem__(self, song_id, row):
+        self.changed[song_id] = row
+
+    def pop(self, song_id, default=None):
+        row = self.get(song_id)
+        if row is None:
+            return default
+        self.changed[song_id] = None
+        return row
+
+    def to_dict(self):
+        rows_by_id = dict(self.base)
+        for song_id, row in self.changed.items():
+            if row is None:
+                rows_by_id.pop(song_id, None)
+            else:
+                rows_by_id[song_id] = row
+        return rows_by_id
+
+
+class Catalog:
+    """Song catalog held in memory as float32 feature columns and artist codes
+
+    A catalog is never modified once built; updated() returns a new snapshot,
+    so requests holding the old one keep a consistent view.
+
+    `generation` identifies the row layout. updated() snapshots keep their
+    parent's rows and generation; a new build or compact() moves rows and
+    gets a new one, so a row number is only meaningful with its generation.
+    """
+
+    def __init__(self, documents, knn_eps=0.0):
+        self.documents = documents
+        self.knn_eps = knn_eps
+        self.energy = _feature_column(documents, 'Energy')
+        self.danceability = _feature_column(documents, 'Danceability')
+        self.valence = _feature_column(documents, 'Valence')
+
+        # Encode artists as integer codes so matching is an integer comparison
+        self.artist_names = []
+        self.artist_lookup = {}
+        codes = [self._artist_code(doc.get('Artist')) for doc in documents]
+        self.artist_codes = np.ascontiguousarray(codes, dtype=np.int32)
+
+        self.artist_index = ArtistIndex(self.artist_names, self.artist_codes)
+        self._feature_index = FeatureIndex(self.energy, self.danceability, self.valence, eps=knn_eps)
+        self._feature_index_lock = threading.Lock()
+        # Rows of deleted songs, kept as gaps until the catalog is compacted
+        self.deleted = 0
+        self.generation = next(_generations)
+        self._rows_by_id = {str(doc['_id']): row for row, doc in enumerate(documents)}
+        self._primary_artists = {}
+
+    @classmethod
+    def from_columns(cls, documents, energy, danceability, valence, artist_names, artist_codes, artist_index,
+                     knn_eps=0.0, ids=None):
+        """Catalog over prebuilt columns and artist index, e.g. memory-mapped from a snapshot
+
+        `ids` holds str(_id) of each row; without it they are read from the
+        documents. The feature index is built on first use.
+        """
+        catalog = cls.__new__(cls)
+        catalog.documents = documents
+        catalog.knn_eps = knn_eps
+        catalog.energy, catalog.danceability, catalog.valence = energy, danceability, valence
+        catalog.artist_names = artist_names
+        catalog.artist_lookup = {name: code for code, name in enumerate(artist_names)}
+        catalog.artist_codes = artist_codes
+        catalog.artist_index = artist_index
+        catalog._feature_index = None
+        catalog._feature_index_lock = threading.Lock()
+        catalog.deleted = 0
+        catalog.generation = next(_generations)
+        if ids is None:
+            ids = (str(doc['_id']) for doc in documents)
+        catalog._rows_by_id = {song_id: row for row, song_id in enumerate(ids)}
+        catalog._primary_artists = {}
+        return catalog
+
+    @property
+    def feature_index(self):
+        if self._feature_index is None:
+            with self._feature_index_lock:
+                if self._feature_index is None:
+                    self._feature_index = FeatureIndex(self.energy, self.danceability, self.valence, eps=self.knn_eps)
+        return self._feature_index
+
+    def _artist_code(self, artist):
+        if artist not in self.artist_lookup:
+            self.artist_lookup[artist] = len(self.artist_names)
+            self.artist_names.append(artist)
+        return self.artist_lookup[artist]
+
+    @classmethod
+    def from_collection(cls, collection, projection=None, **kwargs):
+        """Load every song from a MongoDB collection"""
+        return cls(list(collection.find({}, projection)), **kwargs)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def rows_by_id(self):
+        """Catalog row of each song by the id clients see, str(_id)
+
+        Built with the catalog, so lookups never decode documents.
+        """
+        return self._rows_by_id
+
+    def updated(self, upserts=(), deleted_ids=()):
+        """New snapshot with songs inserted or replaced and deleted songs removed
+
+        Updates are written in place in copies of the columns and new songs are
+        appended, so existing rows keep their positions. Deleted rows become gaps
+        that never match a recommendation until compact() drops them. Documents
+        and the id table are layered over this catalog's instead of copied, the
+        artist index patches the changed artists' postings, and the feature index
+        keeps its KD-tree (see FeatureIndex.updated).
+        """
+        snapshot = copy.copy(self)
+        snapshot.documents = documents = _ChangedDocuments(self.documents)
+        snapshot._rows_by_id = rows_by_id = _ChangedIds(self._rows_by_id)
+        snapshot.artist_names = list(self.artist_names)
+        snapshot.artist_lookup = dict(self.artist_lookup)
+        codes = self.artist_codes.copy()
+        columns = [self.energy.copy(), self.danceability.copy(), self.valence.copy()]
+        fields = ['Energy', 'Danceability', 'Valence']
+        changed_rows = set()
+        changed_codes = set()
+
+        for _id in deleted_ids:
+            row = rows_by_id.pop(str(_id), None)
+            if row is None:
+                continue
+            changed_rows.add(row)
+            changed_codes.add(int(codes[row]))
+            documents[row] = None
+            codes[row] = -1
+            for column in columns:
+                column[row] = np.nan
+            snapshot.deleted += 1
+
+        for doc in upserts:
+            row = rows_by_id.get(str(doc['_id']))
+            if row is None:
+                rows_by_id[str(doc['_id'])] = len(documents)
+                documents.append(doc)
+                continue
+            documents[row] = doc
+            if row >= len(codes):
+                # Added earlier in this batch
+                continue
+            changed_rows.add(row)
+            changed_codes.add(int(codes[row]))
+            codes[row] = snapshot._artist_code(doc.get('Artist'))
+            changed_codes.add(int(codes[row]))
+            for column, field in zip(columns, fields):
+                value = doc.get(field)
+                column[row] = np.nan if value is None else value
+
+        # Songs added in this batch go on the end
+        appended = documents[len(codes):]
+        if appended:
+            changed_rows.update(range(len(codes), len(documents)))
+            new_codes = [snapshot._artist_code(doc.get('Artist')) for doc in appended]
+            changed_codes.update(new_codes)
+            codes = np.concatenate([codes, np.array(new_codes, dtype=np.int32)])
+            columns = [
+                np.concatenate([column, _feature_column(appended, field)])
+                for column, field in zip(columns, fields)
+            ]
+
+        # Fold long-lived layers back into plain containers; a snapshot's documents stay mapped
+        if len(documents.changed) > OVERLAY_ROWS and isinstance(documents.base, list):
+            snapshot.documents = documents.to_list()
+        if len(rows_by_id.changed) > OVERLAY_ROWS:
+            snapshot._rows_by_id = rows_by_id.to_dict()
+
+        changed_rows = np.array(sorted(changed_rows), dtype=np.intp)
+        changed_codes.discard(-1)
+        snapshot.artist_codes = codes
+        snapshot.energy, snapshot.danceability, snapshot.valence = columns
+        snapshot.artist_index = self.artist_index.updated(snapshot.artist_names, codes, changed_rows, changed_codes)
+        # Without a feature index yet (a snapshot still building it), the new catalog builds its own on first use
+        feature_index = self._feature_index
+        snapshot._feature_index = feature_index.updated(changed_rows, *columns) if feature_index is not None else None
+        snapshot._feature_index_lock = threading.Lock()
+        return snapshot
+
+    def compact(self):
+        """New snapshot without the gaps left by deleted songs"""
+        return Catalog([doc for doc in self.documents if doc is not None], knn_eps=self.knn_eps)
+
+    def artist_rows(self, artists):
+        """Rows of songs by any of the given artists (case- and accent-insensitive)"""
+        return self.artist_index.lookup(artists)
+
+    def primary_artists(self, rows):
+        """primary_artist() of each row's artist
+
+        Keys are cached by artist code; codes keep their artist across
+        updated() snapshots, which share the cache.
+        """
+        keys = self._primary_artists
+        result = []
+        for code in self.artist_codes[rows].tolist():
+            key = keys.get(code)
+            if key is None:
+                key = keys[code] = primary_artist(self.artist_names[code]) if code >= 0 else ''
+            result.append(key)
+        return result
+
+    def feature_means(self, rows, default=None):
+        """Average Energy, Danceability and Valence over the given rows"""
+        means = []
+        for column in (self.energy, self.danceability, self.valence):
+            values = column[rows]
+            values = values[~np.isnan(values)]
+            means.append(float(values.mean()) if len(values) else default)
+        return means
+
+    def artist_affinity(self, affinities):
+        """Sorted rows of songs by the given artists and each row's highest affinity
+
+        `affinities` maps artist names to a genre affinity between 0 and 1.
+        """
+        parts, values = [], []
+        for name, affinity in affinities.items():
+            rows = self.artist_index.rows.get(normalize_artist(name))
+            if rows is not None and len(rows):
+                parts.append(rows)
+                values.append(np.full(len(rows), affinity, dtype=np.float32))
+        if not parts:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        rows, values = np.concatenate(parts), np.concatenate(values)
+        # Highest affinity first, so np.unique keeps it for rows by several of the artists
+        order = np.lexsort((-values, rows))
+        rows, first = np.unique(rows[order], return_index=True)
+        return rows.astype(np.intp), values[order][first]
+
+    def score(self, rows, artist_mask, avg_energy, avg_danceability, avg_valence, genre_affinity=None):
+        """Score the given rows against the user's preferences in a single pass
+
+        Preferences may also be (profiles, 1) arrays with matching 2-D rows and
+        artist_mask, which scores every profile at once. genre_affinity, if
+        given, holds a 0-1 genre match for each row.
+        """
+        energy_diff = np.abs(self.energy[rows] - np.float32(avg_energy))
+        dance_diff = np.abs(self.danceability[rows] - np.float32(avg_danceability))
+        valence_diff = np.abs(self.valence[rows] - np.float32(avg_valence))
+
+        scores = ARTIST_WEIGHT * artist_mask.astype(np.float32)
+        scores += ENERGY_WEIGHT * (1 - energy_diff)
+        scores += DANCEABILITY_WEIGHT * (1 - dance_diff)
+        scores += VALENCE_WEIGHT * (1 - valence_diff)
+
+        # Same candidate filter as the old $match stage
+        matches = (
+            artist_mask
+            | ((energy_diff <= FEATURE_RANGE) & (dance_diff <= FEATURE_RANGE))
+            | (valence_diff <= FEATURE_RANGE)
+        )
+        if genre_affinity is not None:
+            scores += GENRE_WEIGHT * genre_affinity
+            matches |= genre_affinity > 0
+        return scores, matches
+
+    def top_k(self, scores, candidates, k):
+        """Indices of the k best scoring candidates, best first"""
+        candidates = np.flatnonzero(candidates)
+        # Songs with missing features have a NaN score; rank them last like MongoDB does with null
+        ranked = np.where(np.isnan(scores[candidates]), -np.inf, scores[candidates])
+        if len(candidates) > k:
+            partition = np.argpartition(-ranked, k - 1)[:k]
+            candidates, ranked = candidates[partition], ranked[partition]
+        order = np.argsort(-ranked, kind='stable')
+        return candidates[order]
+
+    def document(self, index, score=None):
+        """Copy of a song document, with its score attached"""
+        doc = dict(self.documents[index])
+        if score is not None:
+            doc['score'] = None if np.isnan(score) else float(score)
+        return doc
+
+    def rank(self, artist_rows, avg_energy, avg_danceability, avg_valence, limit=20, candidates=None,
+             genre_rows=None, genre_affinity=None):
+        """Rows and scores of the top scoring songs for the given preferences, best first
+
+        With candidates=None every song is scored. Otherwise only the artist and
+        genre matches and the `candidates` nearest songs from the feature index
+        are scored. genre_rows and genre_affinity come from artist_affinity().
+        """
+        has_genres = genre_rows is not None and len(genre_rows) > 0
+        if candidates is None:
+            artist_mask = np.zeros(len(self), dtype=bool)
+            artist_mask[artist_rows] = True
+            affinity = None
+            if has_genres:
+                affinity = np.zeros(len(self), dtype=np.float32)
+                affinity[genre_rows] = genre_affinity
+            scores, matches = self.score(slice(None), artist_mask, avg_energy, avg_danceability, avg_valence, affinity)
+            top = self.top_k(scores, matches, limit)
+            return top, scores[top]
+
+        nearest = self.feature_index.query(avg_energy, avg_danceability, avg_valence, candidates)
+        rows = np.union1d(nearest, artist_rows)
+        affinity = None
+        if has_genres:
+            rows = np.union1d(rows, genre_rows)
+            affinity = np.zeros(len(rows), dtype=np.float32)
+            affinity[np.searchsorted(rows, genre_rows)] = genre_affinity
+        scores, matches = self.score(
+            rows, np.isin(rows, artist_rows), avg_energy, avg_danceability, avg_valence, affinity
+        )
+        top = self.top_k(scores, matches, limit)
+        return rows[top], scores[top]
+
+    def recommend(self, artist_rows, avg_energy, avg_danceability, avg_valence, limit=20, candidates=None,
+                  genre_rows=None, genre_affinity=None):
+        """Top scoring songs for the given preferences, as documents with a score"""
+        rows, scores = self.rank(
+            artist_rows, avg_energy, avg_danceability, avg_valence, limit, candidates, genre_rows, genre_affinity
+        )
+        return [self.document(row, score) for row, score in zip(rows, scores)]
+
+    def recommend_batch(self, profiles, limit=20, candidates=None, chunk_cells=BATCH_CHUNK_CELLS, rerank=None):
+        """Top scoring songs for many preference profiles at once
+
+        Each profile is an (artist_rows, avg_energy, avg_danceability, avg_valence)
+        tuple. Profiles are scored together as a matrix, a chunk at a time so that
+        at most about chunk_cells scores are held in memory, and each result is
+        identical to recommend() for that profile. rerank(rows, scores), if
+        given, reorders or trims each profile's top `limit` rows before they
+        become documents.
+        """
+        results = []
+        width = len(self) if candidates is None else candidates
+        chunk = max(1, chunk_cells // max(width, 1))
+        for start in range(0, len(profiles), chunk):
+            block = profiles[start:start + chunk]
+            targets = np.array([profile[1:] for profile in block], dtype=np.float64)
+            energy, danceability, valence = targets[:, 0:1], targets[:, 1:2], targets[:, 2:3]
+
+            if candidates is None:
+                artist_mask = np.zeros((len(block), len(self)), dtype=bool)
+                for i, (artist_rows, *_) in enumerate(block):
+                    artist_mask[i, artist_rows] = True
+                scores, matches = self.score(slice(None), artist_mask, energy, danceability, valence)
+                for i in range(len(block)):
+                    top = self.top_k(scores[i], matches[i], limit)
+                    results.append(self._documents(top, scores[i, top], rerank))
+                continue
+
+            # Candidate sets differ in size, so pad them into one matrix and mask the padding out
+            nearest = self.feature_index.query_many(targets, candidates)
+            row_sets = [np.union1d(nearest[i], artist_rows) for i, (artist_rows, *_) in enumerate(block)]
+            rows = np.zeros((len(block), max(len(r) for r in row_sets)), dtype=np.intp)
+            valid = np.zeros(rows.shape, dtype=bool)
+            artist_mask = np.zeros(rows.shape, dtype=bool)
+            for i, (artist_rows, *_) in enumerate(block):
+                count = len(row_sets[i])
+                rows[i, :count] = row_sets[i]
+                valid[i, :count] = True
+                artist_mask[i, :count] = np.isin(row_sets[i], artist_rows)
+            scores, matches = self.score(rows, artist_mask, energy, danceability, valence)
+            matches &= valid
+            for i in range(len(block)):
+                top = self.top_k(scores[i], matches[i], limit)
+                results.append(self._documents(rows[i, top], scores[i, top], rerank))
+        return results
+
+    def _documents(self, rows, scores, rerank=None):
+        if rerank is not None:
+            rows, scores = rerank(rows, scores)
+        return [self.document(row, score) for row, score in zip(rows, scores)]
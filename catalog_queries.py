@@ -0,0 +1,133 @@
+"""
+SpotiRec - Catalog queries and indexes
+Projections and index declarations for every query the app sends to the
+songs collection, plus an explain report that flags collection scans
+
+Usage:
+    python catalog_queries.py ensure    # create the declared indexes
+    python catalog_queries.py explain   # explain each query shape
+"""
+
+import os
+import sys
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import PyMongoError
+
+# Fields the recommendation responses and the frontend use
+SONG_FIELDS = ['Artist', 'Track', 'Album', 'Album_type', 'Energy', 'Danceability', 'Valence']
+
+
+def song_projection(watermark_field=None):
+    """Projection for song documents; includes the sync watermark when polling"""
+    fields = SONG_FIELDS + ([watermark_field] if watermark_field else [])
+    return {field: 1 for field in fields}
+
+
+def change_stream_pipeline(watermark_field=None):
+    """Change stream stage trimming full documents to the projected fields"""
+    projection = {'operationType': 1, 'documentKey': 1, 'clusterTime': 1, 'fullDocument._id': 1}
+    projection.update({f'fullDocument.{field}': 1 for field in song_projection(watermark_field)})
+    return [{'$project': projection}]
+
+
+def declared_indexes(watermark_field=None):
+    """Indexes the query paths need
+
+    Artist and audio-feature lookups run against the in-memory catalog, so the
+    only filtered query left on the collection is the sync watermark poll.
+    """
+    indexes = []
+    if watermark_field:
+        indexes.append(IndexModel([(watermark_field, ASCENDING)], name=f'{watermark_field}_1'))
+    return indexes
+
+
+def ensure_indexes(collection, watermark_field=None):
+    """Create the declared indexes; existing ones with the same spec are left as they are"""
+    indexes = declared_indexes(watermark_field)
+    if not indexes:
+        return []
+    try:
+        names = collection.create_indexes(indexes)
+        print(f'🗂️  Indexes in place: {", ".join(names)}')
+        return names
+    except PyMongoError as error:
+        print(f'⚠️  Could not create indexes: {error}')
+        return []
+
+
+def query_shapes(watermark_field=None):
+    """(name, filter, projection, sort, full scan expected) for each query the app sends"""
+    shapes = [
+        # Loading the catalog reads every song, so a collection scan is the right plan
+        ('catalog_load', {}, song_projection(watermark_field), None, True),
+    ]
+    if watermark_field:
+        shapes.append((
+            # The bound value doesn't matter for the plan, only the filtered and sorted field
+            'catalog_sync_poll', {watermark_field: {'$gt': 0}}, song_projection(watermark_field),
+            [(watermark_field, ASCENDING)], False
+        ))
+    return shapes
+
+
+def _plan_stages(plan):
+    """Every stage name in an explain plan tree"""
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages += _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            stages += _plan_stages(item)
+    return stages
+
+
+def explain(collection, watermark_field=None):
+    """Winning plan stages for each query shape, flagging unexpected collection scans"""
+    report = []
+    for name, query, projection, sort, full_scan in query_shapes(watermark_field):
+        cursor = collection.find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = _plan_stages(cursor.explain().get('queryPlanner', {}).get('winningPlan', {}))
+        report.append({
+            'query': name,
+            'stages': stages,
+            'collection_scan': 'COLLSCAN' in stages,
+            'flagged': 'COLLSCAN' in stages and not full_scan,
+        })
+    return report
+
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] not in ('ensure', 'explain'):
+        print(__doc__.split('Usage:')[1].strip('\n'))
+        sys.exit(2)
+
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    collection = MongoClient(os.getenv('MONGODB_URI'))['recommender']['cleaned_copy3']
+    sync = os.getenv('CATALOG_SYNC', 'false').lower() == 'true'
+    watermark_field = os.getenv('CATALOG_SYNC_FIELD', 'updated_at') if sync else None
+
+    if sys.argv[1] == 'ensure':
+        ensure_indexes(collection, watermark_field)
+        return
+
+    flagged = False
+    for row in explain(collection, watermark_field):
+        marker = '❌' if row['flagged'] else '✅'
+        note = ' (collection scan)' if row['collection_scan'] else ''
+        print(f'{marker} {row["query"]}: {" <- ".join(row["stages"])}{note}')
+        flagged = flagged or row['flagged']
+    sys.exit(1 if flagged else 0)
+
+
+if __name__ == '__main__':
+    main()
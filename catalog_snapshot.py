@@ -0,0 +1,285 @@
+"""
+SpotiRec - Catalog snapshots
+Writes the catalog to an on-disk columnar format that worker processes
+memory-map read-only, so they share one copy and boot without MongoDB
+
+Usage:
+    python catalog_snapshot.py export data/catalog   # from the MONGODB_URI collection
+    python catalog_snapshot.py info data/catalog
+
+A snapshot directory holds .npy arrays (float32 feature columns, int32 artist
+codes, the artist index postings) and offset-based string tables for Track,
+Artist, the song ids and the remaining document fields as Extended JSON. `path` is a
+symlink to the newest version, replaced atomically on export.
+
+The manifest records where the export read the collection from (the change
+stream position and the newest CATALOG_SYNC_FIELD value), so catalog sync can
+pick up from there instead of from when the server started.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections.abc import Sequence
+
+import numpy as np
+from bson import json_util
+from pymongo.errors import PyMongoError
+
+from catalog import ArtistIndex, Catalog
+from catalog_queries import song_projection
+
+FORMAT_VERSION = 1
+FEATURE_FIELDS = [('energy', 'Energy'), ('danceability', 'Danceability'), ('valence', 'Valence')]
+
+
+def _string_table(values):
+    """Offsets, UTF-8 bytes and a missing-value mask for a list of strings"""
+    encoded = [value.encode('utf-8') if isinstance(value, str) else b'' for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    missing = np.array([not isinstance(value, str) for value in values], dtype=bool)
+    return offsets, data, missing
+
+
+class StringTable:
+    """Read-only view of an offset-based string table"""
+
+    def __init__(self, offsets, data, missing=None):
+        self.offsets = offsets
+        self.data = data
+        self.missing = missing
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if self.missing is not None and self.missing[index]:
+            return None
+        return bytes(self.data[self.offsets[index]:self.offsets[index + 1]]).decode('utf-8')
+
+    def to_list(self):
+        """Decode every string at once (for small tables)"""
+        data = bytes(self.data)
+        offsets = self.offsets.tolist()
+        missing = self.missing.tolist() if self.missing is not None else [False] * len(self)
+        return [None if missing[i] else data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(self))]
+
+
+class SnapshotDocuments(Sequence):
+    """Song documents rebuilt on demand from a snapshot's string tables"""
+
+    def __init__(self, tracks, extras, artist_names, artist_codes):
+        self.tracks = tracks
+        self.extras = extras
+        self.artist_names = artist_names
+        self.artist_codes = artist_codes
+
+    def __len__(self):
+        return len(self.extras)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        doc = json.loads(self.extras[index], object_hook=json_util.object_hook)
+        artist = self.artist_names[self.artist_codes[index]]
+        if isinstance(artist, str):
+            doc['Artist'] = artist
+        track = self.tracks[index]
+        if track is not None:
+            doc['Track'] = track
+        return doc
+
+
+def sync_point(collection, watermark_field=None):
+    """Where catalog sync would start following the collection right now; take it before reading
+
+    The change stream position is None on servers without change streams
+    (standalone), and the watermark is the newest `watermark_field` value.
+    """
+    newest = collection.find_one(
+        {watermark_field: {'$exists': True}}, {watermark_field: 1}, sort=[(watermark_field, -1)]
+    ) if watermark_field else None
+    point = {
+        'resume_token': None,
+        'cluster_time': None,
+        'watermark_field': watermark_field,
+        'watermark': newest[watermark_field] if newest else None,
+    }
+    try:
+        with collection.watch(max_await_time_ms=1) as stream:
+            # The first getMore reports where the stream stands even when nothing has changed
+            stream.try_next()
+            point['resume_token'] = stream.resume_token
+        point['cluster_time'] = collection.database.command('ping').get('operationTime')
+    except PyMongoError as error:
+        print(f'⚠️  No change stream position to record ({error})')
+    return point
+
+
+def write_snapshot(catalog, path, since=None):
+    """Write a catalog snapshot and point `path` at it
+
+    `since` is the sync_point() taken before the catalog was read.
+    """
+    if catalog.deleted:
+        catalog = catalog.compact()
+    version = new_version(path)
+
+    def save(name, array):
+        np.save(os.path.join(version, f'{name}.npy'), np.ascontiguousarray(array))
+
+    for name, _ in FEATURE_FIELDS:
+        save(name, getattr(catalog, name).astype(np.float32))
+    save('artist_codes', catalog.artist_codes.astype(np.int32))
+
+    for name, values in [
+        ('artist', catalog.artist_names),
+        # The ids clients look songs up by, so workers don't decode every document for them
+        ('id', [str(doc['_id']) for doc in catalog.documents]),
+        ('track', [doc.get('Track') for doc in catalog.documents]),
+        # Everything but the string-table fields, with original feature values and _id types intact
+        ('extra', [
+            json.dumps({
+                key: value for key, value in doc.items()
+                if not (key in ('Artist', 'Track') and isinstance(value, str))
+            }, default=json_util.default)
+            for doc in catalog.documents
+        ]),
+    ]:
+        offsets, data, missing = _string_table(values)
+        save(f'{name}_offsets', offsets)
+        save(f'{name}_strings', data)
+        save(f'{name}_missing', missing)
+
+    # Artist index postings, so workers don't rebuild it on boot
+    keys = sorted(catalog.artist_index.rows)
+    postings = [catalog.artist_index.rows[key] for key in keys]
+    offsets, data, _ = _string_table(keys)
+    save('index_key_offsets', offsets)
+    save('index_key_strings', data)
+    row_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum([len(rows) for rows in postings], out=row_offsets[1:])
+    save('index_row_offsets', row_offsets)
+    save('index_rows', np.concatenate(postings).astype(np.int32) if postings else np.empty(0, dtype=np.int32))
+
+    manifest = {
+        'format': FORMAT_VERSION,
+        'songs': len(catalog),
+        'artists': len(catalog.artist_names),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    if since is not None:
+        manifest['since'] = since
+    with open(os.path.join(version, 'manifest.json'), 'w') as f:
+        # Extended JSON keeps the resume token, cluster time and watermark types
+        json.dump(manifest, f, indent=2, default=json_util.default)
+
+    return publish_version(path, version)
+
+
+def new_version(path):
+    """Create an empty directory for a new version of `path`"""
+    _check_link(path)
+    directory, name = os.path.split(os.path.abspath(path))
+    # mkdtemp's random suffix keeps versions written within the same second apart
+    version = tempfile.mkdtemp(prefix=f'{name}.{time.strftime("%Y%m%d%H%M%S")}-', dir=directory)
+    os.chmod(version, 0o755)
+    return version
+
+
+def _check_link(path):
+    """Refuse to replace anything at `path` but a symlink from an earlier export"""
+    if os.path.lexists(path) and not os.path.islink(path):
+        raise FileExistsError(
+            f'{path} exists and is not a snapshot symlink; move it away or choose another path'
+        )
+
+
+def publish_version(path, version):
+    """Point `path` at a fully written version directory and remove older versions"""
+    _check_link(path)
+    # Swap the symlink so readers see either the old or the new version, never a partial one
+    link = f'{path}.link-{os.getpid()}'
+    os.symlink(os.path.basename(version), link)
+    os.replace(link, path)
+
+    # Older versions can go; workers that still map them keep their open files
+    directory, prefix = os.path.split(os.path.abspath(path))
+    for name in os.listdir(directory or '.'):
+        old = os.path.join(directory, name)
+        if name.startswith(f'{prefix}.') and name[len(prefix) + 1:][:1].isdigit() and os.path.isdir(old) \
+                and name != os.path.basename(version):
+            shutil.rmtree(old, ignore_errors=True)
+    return version
+
+
+def read_manifest(path):
+    """A snapshot's manifest, with datetimes naive UTC like pymongo returns them"""
+    with open(os.path.join(path, 'manifest.json')) as f:
+        return json_util.loads(f.read(), json_options=json_util.JSONOptions(tz_aware=False))
+
+
+def load_snapshot(path, knn_eps=0.0):
+    """Memory-map a snapshot as a read-only Catalog"""
+    path = os.path.realpath(path)
+    manifest = read_manifest(path)
+    if manifest['format'] != FORMAT_VERSION:
+        raise ValueError(f'Unsupported catalog snapshot format {manifest["format"]}')
+
+    def load(name):
+        # Plain ndarray views of the mapping index faster than np.memmap objects
+        return np.asarray(np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+
+    def strings(name):
+        return StringTable(load(f'{name}_offsets'), load(f'{name}_strings'), load(f'{name}_missing'))
+
+    artist_names = strings('artist').to_list()
+    artist_codes = load('artist_codes')
+
+    keys = StringTable(load('index_key_offsets'), load('index_key_strings')).to_list()
+    row_offsets = load('index_row_offsets').tolist()
+    index_rows = load('index_rows')
+    postings = {key: index_rows[row_offsets[i]:row_offsets[i + 1]] for i, key in enumerate(keys)}
+
+    # Snapshots exported before the id table get their ids from the documents
+    ids = strings('id').to_list() if os.path.exists(os.path.join(path, 'id_offsets.npy')) else None
+
+    documents = SnapshotDocuments(strings('track'), strings('extra'), artist_names, artist_codes)
+    return Catalog.from_columns(
+        documents, *[load(name) for name, _ in FEATURE_FIELDS], artist_names, artist_codes,
+        ArtistIndex.from_postings(postings, len(artist_names)), knn_eps=knn_eps, ids=ids
+    )
+
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] not in ('export', 'info'):
+        print(__doc__.split('Usage:')[1].split('\n\n')[0])
+        sys.exit(2)
+    command, path = sys.argv[1:]
+
+    if command == 'info':
+        with open(os.path.join(os.path.realpath(path), 'manifest.json')) as f:
+            print(json.dumps(json.load(f), indent=2))
+        return
+
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    collection = MongoClient(os.getenv('MONGODB_URI'))['recommender']['cleaned_copy3']
+    watermark_field = os.getenv('CATALOG_SYNC_FIELD', 'updated_at')
+    started = time.perf_counter()
+    # Taken before the read, so changes made during it are applied again rather than missed
+    since = sync_point(collection, watermark_field)
+    catalog = Catalog.from_collection(collection, projection=song_projection(watermark_field))
+    version = write_snapshot(catalog, path, since=since)
+    print(f'💾 Wrote {len(catalog)} songs to {version} in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+SpotiRec - Incremental catalog sync
+Follows changes to the songs collection and publishes updated catalog
+snapshots, so edits show up without reloading the whole collection
+"""
+
+import threading
+import time
+from datetime import datetime, timezone
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from catalog_queries import change_stream_pipeline, song_projection
+
+
+class CatalogSync:
+    """Applies collection changes to the in-memory catalog in batches
+
+    Changes are read from a MongoDB change stream, or by polling for documents
+    whose `watermark_field` is newer than the last one seen when change streams
+    aren't available (standalone servers). Polling can't see hard deletes, so
+    in that mode the catalog is also reloaded every `resync_interval` seconds.
+
+    Each batch produces a new snapshot via Catalog.updated() that is handed to
+    `publish`; requests already holding the previous snapshot are unaffected.
+
+    A catalog loaded from a snapshot file was read from the collection at
+    export time, so sync opens at the point recorded then (see
+    catalog_snapshot.sync_point) and reloads the collection once started if
+    that point is missing or too old to resume from.
+    """
+
+    def __init__(self, collection, current, publish, mode='auto', watermark_field='updated_at',
+                 batch_size=500, batch_delay=1.0, poll_interval=30, resync_interval=86400,
+                 compact_ratio=0.2):
+        self.collection = collection
+        self.current = current
+        self.publish = publish
+        self.mode = mode
+        self.watermark_field = watermark_field
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.poll_interval = poll_interval
+        self.resync_interval = resync_interval
+        self.compact_ratio = compact_ratio
+        self.projection = song_projection(watermark_field)
+
+        self.stream = None
+        self.resume_token = None
+        self.watermark = None
+        self.catch_up = False
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.changes = {'upsert': 0, 'delete': 0}
+        self.batches = 0
+        self.rebuilds = 0
+        self.errors = 0
+        self.lag = 0.0
+        self.last_sync = None
+
+    def open(self, since=None):
+        """Start following changes; call before the initial load so nothing is missed
+
+        For a catalog read earlier, `since` is the sync point it was read at
+        (a snapshot manifest's 'since' entry, {} for none).
+        """
+        if self.mode in ('auto', 'change_stream'):
+            try:
+                self.stream = self._watch() if since is None else self._watch_since(since)
+                self.mode = 'change_stream'
+                return
+            except (PyMongoError, AttributeError) as error:
+                if self.mode == 'change_stream':
+                    raise
+                print(f'⚠️  Change streams unavailable ({error}), polling {self.watermark_field} instead')
+        self.mode = 'watermark'
+        self.catch_up = False
+        if since is not None:
+            if since.get('watermark_field') == self.watermark_field and since.get('watermark') is not None:
+                self.watermark = since['watermark']
+            else:
+                self.catch_up = True
+
+    def _watch_since(self, since):
+        """Change stream from a recorded sync point, or from now with a catch-up reload"""
+        for option, key in (('resume_after', 'resume_token'), ('start_at_operation_time', 'cluster_time')):
+            if since.get(key) is None:
+                continue
+            try:
+                stream = self._watch(**{option: since[key]})
+                self.resume_token = since.get('resume_token')
+                self.catch_up = False
+                return stream
+            except OperationFailure as error:
+                # The point has aged out of the oplog
+                print(f'⚠️  Could not follow changes from the catalog snapshot ({error})')
+        self.catch_up = True
+        return self._watch()
+
+    def start(self):
+        """Follow changes on a background thread"""
+        if self.stream is None and self.mode != 'watermark':
+            self.open()
+        if self.mode == 'watermark' and self.watermark is None and not self.catch_up:
+            self.watermark = self._max_watermark(self.current().documents)
+        self._thread = threading.Thread(target=self._run, name='catalog-sync', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'changes': dict(self.changes),
+            'batches': self.batches,
+            'rebuilds': self.rebuilds,
+            'errors': self.errors,
+            'lag_seconds': round(self.lag, 3),
+            'last_sync': self.last_sync,
+        }
+
+    def _run(self):
+        last_resync = time.time()
+        while not self._stop.is_set():
+            try:
+                if self.catch_up:
+                    print('🔁 Catalog sync: no sync point to follow the loaded catalog from, reloading')
+                    self.rebuild()
+                    self.catch_up = False
+                if self.mode == 'change_stream':
+                    self._follow_stream()
+                else:
+                    self.poll()
+                    if self.resync_interval and time.time() - last_resync > self.resync_interval:
+                        self.rebuild()
+                        last_resync = time.time()
+                    self._stop.wait(self.poll_interval)
+            except Exception as error:
+                self.errors += 1
+                print(f'⚠️  Catalog sync error: {error}')
+                self._stop.wait(5)
+                try:
+                    self._reopen_stream()
+                except Exception as reopen_error:
+                    print(f'⚠️  Could not reopen the change stream: {reopen_error}')
+
+    def _reopen_stream(self):
+        """Resume the change stream after an error, or rebuild if it can't be resumed"""
+        if self.mode != 'change_stream':
+            return
+        try:
+            if self.stream is not None:
+                self.stream.close()
+            self.stream = self._watch(resume_after=self.resume_token)
+        except PyMongoError:
+            # The resume point has aged out of the oplog; start over from a fresh load
+            self.stream = self._watch()
+            self.rebuild()
+
+    def _watch(self, **kwargs):
+        return self.collection.watch(
+            change_stream_pipeline(self.watermark_field), full_document='updateLookup', max_await_time_ms=1000, **kwargs
+        )
+
+    def _follow_stream(self):
+        pending = {}
+        oldest = None
+        first_seen = None
+        while not self._stop.is_set():
+            change = self.stream.try_next()
+            if change is not None:
+                self.resume_token = self.stream.resume_token
+                operation = change['operationType']
+                if operation in ('invalidate', 'drop', 'rename', 'dropDatabase'):
+                    self.stream.close()
+                    self.stream = self._watch()
+                    self.rebuild()
+                    pending, oldest, first_seen = {}, None, None
+                    continue
+                if 'documentKey' not in change:
+                    continue
+                # The latest change per song wins; a missing full document means it was deleted since
+                pending[change['documentKey']['_id']] = change.get('fullDocument')
+                cluster_time = change.get('clusterTime')
+                changed_at = cluster_time.time if cluster_time is not None else time.time()
+                oldest = changed_at if oldest is None else min(oldest, changed_at)
+                first_seen = first_seen or time.time()
+
+            # Apply when the batch is full, or when changes have waited long enough
+            if pending and (len(pending) >= self.batch_size or time.time() - first_seen >= self.batch_delay):
+                self.apply(pending, oldest)
+                pending, oldest, first_seen = {}, None, None
+
+    def poll(self):
+        """Apply documents modified since the last watermark, oldest first"""
+        if self.watermark is None:
+            query = {self.watermark_field: {'$exists': True}}
+        else:
+            query = {self.watermark_field: {'$gt': self.watermark}}
+        pending = {}
+        for doc in self.collection.find(query, self.projection).sort(self.watermark_field, 1):
+            pending[doc['_id']] = doc
+            if len(pending) >= self.batch_size:
+                self._apply_polled(pending)
+                pending = {}
+        if pending:
+            self._apply_polled(pending)
+
+    def _apply_polled(self, documents):
+        values = [doc[self.watermark_field] for doc in documents.values()]
+        self.apply(documents, self._timestamp(min(values)))
+        self.watermark = max(values + ([self.watermark] if self.watermark is not None else []))
+
+    def apply(self, changes, oldest=None):
+        """Publish a snapshot with a batch of {_id: document or None (deleted)} changes"""
+        upserts = [doc for doc in changes.values() if doc is not None]
+        deleted = [_id for _id, doc in changes.items() if doc is None]
+        snapshot = self.current().updated(upserts, deleted)
+        if snapshot.deleted > self.compact_ratio * len(snapshot):
+            snapshot = snapshot.compact()
+            self.rebuilds += 1
+        self.publish(snapshot)
+
+        self.changes['upsert'] += len(upserts)
+        self.changes['delete'] += len(deleted)
+        self.batches += 1
+        self.last_sync = time.time()
+        if oldest is not None:
+            self.lag = max(self.last_sync - oldest, 0.0)
+        print(f'🔁 Catalog sync: {len(upserts)} upserts, {len(deleted)} deletes applied')
+
+    def rebuild(self):
+        """Reload the whole collection into a fresh snapshot"""
+        current = self.current()
+        snapshot = type(current).from_collection(self.collection, projection=self.projection, knn_eps=current.knn_eps)
+        if self.mode == 'watermark':
+            self.watermark = self._max_watermark(snapshot.documents, self.watermark)
+        self.publish(snapshot)
+        self.rebuilds += 1
+        self.last_sync = time.time()
+        self.lag = 0.0
+        print(f'🔁 Catalog sync: reloaded {len(snapshot)} songs')
+
+    def _max_watermark(self, documents, initial=None):
+        values = [doc.get(self.watermark_field) for doc in documents if doc is not None]
+        values = [v for v in values if v is not None]
+        if initial is not None:
+            values.append(initial)
+        return max(values) if values else None
+
+    @staticmethod
+    def _timestamp(value):
+        """Seconds since the epoch for a watermark value (datetime or number)"""
+        if isinstance(value, datetime):
+            # pymongo returns naive datetimes in UTC
+            return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+        if isinstance(value, (int, float)):
+            return float(value)
+        return None
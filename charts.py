@@ -0,0 +1,259 @@
+"""
+SpotiRec - Analysis chart rendering
+Draws the taste-vs-recommendations chart on explicit Figure objects in a
+bounded process pool, and caches the encoded image by content hash
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from cache import TTLCache
+
+# Output formats the chart can be rendered to, with their MIME types
+CHART_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+# Rendering processes (0 renders in the request thread instead)
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', 2))
+CHART_TIMEOUT = float(os.getenv('CHART_TIMEOUT', 30))  # seconds
+
+# Rendered images keyed by a hash of everything that goes into the chart
+chart_cache = TTLCache(
+    maxsize=int(os.getenv('CHART_CACHE_SIZE', 256)),
+    ttl=int(os.getenv('CHART_CACHE_TTL', 3600))
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+# Style contexts change process-global rcParams, so in-thread renders take turns
+_render_lock = threading.Lock()
+
+
+def render_analysis_chart(user_values, rec_energy, rec_dance, rec_valence, dpi=150, size=(16, 10), fmt='png'):
+    """Render the six-panel analysis chart
+
+    Returns the encoded image bytes and a list of (phase, seconds) timings.
+    """
+    # Imported here so the web process only pays for matplotlib when a chart is drawn
+    import matplotlib
+    matplotlib.use('Agg')  # Use non-GUI backend
+    import matplotlib.style
+    import numpy as np
+    from matplotlib.figure import Figure
+
+    user_energy, user_dance, user_valence = user_values
+
+    # Set style for aesthetic graphs
+    phases = []
+    started = time.perf_counter()
+
+    with matplotlib.style.context('dark_background'):
+        # Create figure with subplots
+        fig = Figure(figsize=size)
+        fig.patch.set_facecolor('#121212')
+
+        # Define colors matching Spotify theme
+        spotify_green = '#1DB954'
+        spotify_white = '#FFFFFF'
+        spotify_gray = '#535353'
+        rec_color = '#FF006C'
+
+        # 1. Radar Chart - Audio Features Comparison
+        ax1 = fig.add_subplot(2, 3, 1, projection='polar')
+        categories = ['Energy', 'Danceability', 'Valence']
+        N = len(categories)
+
+        # User data
+        user_values = [user_energy, user_dance, user_valence]
+        user_values += user_values[:1]  # Complete the circle
+
+        # Recommendations average
+        rec_values = [
+            np.mean(rec_energy) if rec_energy else 0.5,
+            np.mean(rec_dance) if rec_dance else 0.5,
+            np.mean(rec_valence) if rec_valence else 0.5
+        ]
+        rec_values += rec_values[:1]
+
+        angles = [n / float(N) * 2 * np.pi for n in range(N)]
+        angles += angles[:1]
+
+        ax1.plot(angles, user_values, 'o-', linewidth=2, color=spotify_green, label='Your Taste')
+        ax1.fill(angles, user_values, alpha=0.25, color=spotify_green)
+        ax1.plot(angles, rec_values, 'o-', linewidth=2, color=rec_color, label='Recommendations')
+        ax1.fill(angles, rec_values, alpha=0.25, color=rec_color)
+
+        ax1.set_xticks(angles[:-1])
+        ax1.set_xticklabels(categories, color=spotify_white, size=10)
+        ax1.set_ylim(0, 1)
+        ax1.set_title('Audio Features Comparison', color=spotify_white, size=12, pad=20, weight='bold')
+        ax1.legend(loc='upper right', bbox_to_anchor=(1.3, 1.1))
+        ax1.grid(color=spotify_gray, alpha=0.3)
+
+        # 2. Distribution - Energy
+        ax2 = fig.add_subplot(2, 3, 2)
+        if rec_energy:
+            ax2.hist(rec_energy, bins=15, alpha=0.7, color=rec_color, edgecolor='white', linewidth=0.5)
+            ax2.axvline(user_energy, color=spotify_green, linestyle='--', linewidth=2, label='Your Average')
+            ax2.set_xlabel('Energy Level', color=spotify_white, size=10)
+            ax2.set_ylabel('Number of Songs', color=spotify_white, size=10)
+            ax2.set_title('Energy Distribution', color=spotify_white, size=12, weight='bold')
+            ax2.legend()
+            ax2.tick_params(colors=spotify_white)
+            ax2.set_facecolor('#1a1a1a')
+
+        # 3. Distribution - Danceability
+        ax3 = fig.add_subplot(2, 3, 3)
+        if rec_dance:
+            ax3.hist(rec_dance, bins=15, alpha=0.7, color=rec_color, edgecolor='white', linewidth=0.5)
+            ax3.axvline(user_dance, color=spotify_green, linestyle='--', linewidth=2, label='Your Average')
+            ax3.set_xlabel('Danceability', color=spotify_white, size=10)
+            ax3.set_ylabel('Number of Songs', color=spotify_white, size=10)
+            ax3.set_title('Danceability Distribution', color=spotify_white, size=12, weight='bold')
+            ax3.legend()
+            ax3.tick_params(colors=spotify_white)
+            ax3.set_facecolor('#1a1a1a')
+
+        # 4. Scatter Plot - Energy vs Danceability
+        ax4 = fig.add_subplot(2, 3, 4)
+        if rec_energy and rec_dance:
+            ax4.scatter(rec_energy, rec_dance, alpha=0.6, s=100, color=rec_color, edgecolors='white', linewidth=0.5)
+            ax4.scatter([user_energy], [user_dance], s=300, color=spotify_green, marker='*', 
+                       edgecolors='white', linewidth=2, label='Your Profile', zorder=5)
+            ax4.set_xlabel('Energy', color=spotify_white, size=10)
+            ax4.set_ylabel('Danceability', color=spotify_white, size=10)
+            ax4.set_title('Energy vs Danceability', color=spotify_white, size=12, weight='bold')
+            ax4.legend()
+            ax4.grid(True, alpha=0.2, color=spotify_gray)
+            ax4.tick_params(colors=spotify_white)
+            ax4.set_facecolor('#1a1a1a')
+
+        # 5. Bar Chart - Average Comparison
+        ax5 = fig.add_subplot(2, 3, 5)
+        metrics = ['Energy', 'Danceability', 'Valence']
+        user_vals = [user_energy, user_dance, user_valence]
+        rec_vals = [
+            np.mean(rec_energy) if rec_energy else 0,
+            np.mean(rec_dance) if rec_dance else 0,
+            np.mean(rec_valence) if rec_valence else 0
+        ]
+
+        x = np.arange(len(metrics))
+        width = 0.35
+
+        bars1 = ax5.bar(x - width/2, user_vals, width, label='Your Taste', color=spotify_green, edgecolor='white', linewidth=0.5)
+        bars2 = ax5.bar(x + width/2, rec_vals, width, label='Recommendations', color=rec_color, edgecolor='white', linewidth=0.5)
+
+        ax5.set_ylabel('Value', color=spotify_white, size=10)
+        ax5.set_title('Average Metrics Comparison', color=spotify_white, size=12, weight='bold')
+        ax5.set_xticks(x)
+        ax5.set_xticklabels(metrics, color=spotify_white)
+        ax5.legend()
+        ax5.tick_params(colors=spotify_white)
+        ax5.set_facecolor('#1a1a1a')
+        ax5.set_ylim(0, 1)
+
+        # Add value labels on bars
+        for bars in [bars1, bars2]:
+            for bar in bars:
+                height = bar.get_height()
+                ax5.text(bar.get_x() + bar.get_width()/2., height,
+                        f'{height:.2f}',
+                        ha='center', va='bottom', color=spotify_white, size=8)
+
+        # 6. Box Plot - Feature Distribution
+        ax6 = fig.add_subplot(2, 3, 6)
+        data_to_plot = []
+        labels = []
+
+        if rec_energy:
+            data_to_plot.append(rec_energy)
+            labels.append('Energy')
+        if rec_dance:
+            data_to_plot.append(rec_dance)
+            labels.append('Dance')
+        if rec_valence:
+            data_to_plot.append(rec_valence)
+            labels.append('Valence')
+
+        if data_to_plot:
+            bp = ax6.boxplot(data_to_plot, labels=labels, patch_artist=True,
+                            boxprops=dict(facecolor=rec_color, alpha=0.7, edgecolor='white'),
+                            whiskerprops=dict(color='white'),
+                            capprops=dict(color='white'),
+                            medianprops=dict(color=spotify_green, linewidth=2))
+
+            ax6.set_ylabel('Value', color=spotify_white, size=10)
+            ax6.set_title('Feature Distribution (Box Plot)', color=spotify_white, size=12, weight='bold')
+            ax6.tick_params(colors=spotify_white)
+            ax6.set_facecolor('#1a1a1a')
+            ax6.set_ylim(0, 1)
+
+        phases.append(('chart_draw', time.perf_counter() - started))
+        started = time.perf_counter()
+
+        fig.tight_layout(pad=3.0)
+        phases.append(('chart_layout', time.perf_counter() - started))
+        started = time.perf_counter()
+
+        # Save to bytes buffer
+        buf = BytesIO()
+        fig.savefig(buf, format=fmt, dpi=dpi, facecolor='#121212', edgecolor='none')
+        phases.append(('chart_encode', time.perf_counter() - started))
+        return buf.getvalue(), phases
+
+
+def chart_key(user_values, rec_energy, rec_dance, rec_valence, dpi=150, size=(16, 10), fmt='png'):
+    """Content hash identifying a rendered chart (also used as its ETag)"""
+    payload = json.dumps([list(user_values), rec_energy, rec_dance, rec_valence, dpi, list(size), fmt])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _get_executor():
+    """Process pool for rendering, created on first use
+
+    Spawned workers import this module and, if the server's __main__ module
+    has a __file__, re-run that too, so how the server is launched decides
+    what a worker start costs. serve.py is a launcher with next to nothing to
+    re-run; `python app.py` makes every worker import the whole server.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn avoids forking a process that already has request threads running
+            _executor = ProcessPoolExecutor(
+                max_workers=CHART_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _executor
+
+
+def get_analysis_chart(user_values, rec_energy, rec_dance, rec_valence, dpi=150, size=(16, 10), fmt='png', phases=None):
+    """Image bytes for the analysis chart, rendered at most once per distinct input
+
+    If a phases list is given, the rendering phase timings are appended to it.
+    """
+    args = (list(user_values), list(rec_energy), list(rec_dance), list(rec_valence), dpi, tuple(size), fmt)
+    key = chart_key(*args)
+    image = chart_cache.get(key)
+    if image is not None:
+        return image
+
+    if CHART_WORKERS > 0:
+        image, render_phases = _get_executor().submit(render_analysis_chart, *args).result(timeout=CHART_TIMEOUT)
+    else:
+        with _render_lock:
+            image, render_phases = render_analysis_chart(*args)
+    if phases is not None:
+        phases.extend(render_phases)
+
+    chart_cache.set(key, image)
+    return image
@@ -0,0 +1,112 @@
+"""
+SpotiRec - Cold-start pool
+A refreshed, stratified sample of the catalog that random picks are drawn
+from, instead of a $sample over the whole collection per request
+"""
+
+import threading
+import time
+
+import numpy as np
+
+
+class ColdStartPool:
+    """Songs spread across the Energy x Danceability x Valence space
+
+    The feature space is split into bins**3 cells, plus one stratum for songs
+    missing a feature. Each non-empty stratum gets a share of the pool
+    proportional to how many songs it holds and at least one song while the
+    pool has room, so the pool is both diverse and representative. Draws are
+    O(size) and never touch the database.
+    """
+
+    # Songs considered per pool slot when stratifying a large catalog
+    OVERSAMPLE = 50
+
+    def __init__(self, size=2000, bins=4, refresh_interval=3600):
+        self.size = size
+        self.bins = bins
+        self.refresh_interval = refresh_interval
+        # (catalog, rows, ids), replaced as a whole on rebuild
+        self._state = (None, np.empty(0, dtype=np.intp), [])
+        self.rebuilds = 0
+        self.draws = 0
+        self.built_at = None
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return len(self._state[1])
+
+    def rebuild(self, catalog):
+        """Pick a fresh stratified pool from the catalog"""
+        rng = np.random.default_rng()
+        features = np.column_stack([catalog.energy, catalog.danceability, catalog.valence])
+        # Deleted rows have no artist code
+        rows = np.flatnonzero(catalog.artist_codes >= 0)
+        if len(rows) > self.OVERSAMPLE * self.size:
+            rows = np.unique(rng.choice(rows, self.OVERSAMPLE * self.size))
+
+        # Songs missing any feature get a stratum of their own after the bins**3 cells
+        complete = ~np.isnan(features[rows]).any(axis=1)
+        cells = np.full(len(rows), self.bins ** 3, dtype=np.intp)
+        binned = np.clip((features[rows[complete]] * self.bins).astype(np.intp), 0, self.bins - 1)
+        cells[complete] = (binned[:, 0] * self.bins + binned[:, 1]) * self.bins + binned[:, 2]
+        counts = np.bincount(cells, minlength=self.bins ** 3 + 1)
+        quota = np.where(counts > 0, np.maximum(1, np.round(self.size * counts / max(len(rows), 1))), 0)
+        quota = np.minimum(quota, counts).astype(np.intp)
+        # Rounding and the one-per-stratum minimum can miss the size; trim the biggest quotas,
+        # or top up the strata with the most songs left over
+        target = min(self.size, len(rows))
+        for _ in range(max(int(quota.sum()) - target, 0)):
+            quota[quota.argmax()] -= 1
+        for _ in range(max(target - int(quota.sum()), 0)):
+            quota[(counts - quota).argmax()] += 1
+
+        # Shuffle, group by cell, and keep the first `quota` songs of each cell
+        shuffled = rng.permutation(len(rows))
+        order = shuffled[np.argsort(cells[shuffled], kind='stable')]
+        sorted_cells = cells[order]
+        starts = np.searchsorted(sorted_cells, np.arange(len(counts)))
+        rank = np.arange(len(order)) - starts[sorted_cells]
+        pool = rows[order[rank < quota[sorted_cells]]]
+        pool = pool[rng.permutation(len(pool))]
+
+        self._state = (catalog, pool, [catalog.documents[row]['_id'] for row in pool.tolist()])
+        self.rebuilds += 1
+        self.built_at = time.time()
+        return self
+
+    def draw(self, size, exclude_ids=()):
+        """Random songs from the pool, skipping the given ids"""
+        catalog, rows, ids = self._state
+        if not len(rows) or size <= 0:
+            return []
+        self.draws += 1
+        exclude = set(exclude_ids)
+        rng = np.random.default_rng()
+        picked = {}
+        for _ in range(10):
+            for position in rng.integers(0, len(rows), size=2 * size).tolist():
+                if position not in picked and ids[position] not in exclude:
+                    picked[position] = catalog.document(rows[position])
+                    if len(picked) == size:
+                        return list(picked.values())
+        return list(picked.values())
+
+    def start(self, current):
+        """Rebuild from current() every refresh_interval seconds on a background thread"""
+        def refresh():
+            while not self._stop.wait(self.refresh_interval):
+                try:
+                    self.rebuild(current())
+                except Exception as error:
+                    print(f'⚠️  Cold-start pool refresh failed: {error}')
+
+        threading.Thread(target=refresh, name='cold-start-pool', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {'size': len(self), 'rebuilds': self.rebuilds, 'draws': self.draws, 'built_at': self.built_at}
@@ -0,0 +1,96 @@
+"""
+SpotiRec - Diversity re-ranking
+Reorders the best scoring songs with maximal marginal relevance and a cap on
+songs per artist, so the top of a ranking isn't taken over by one artist
+"""
+
+import numpy as np
+
+from catalog import DANCEABILITY_WEIGHT, ENERGY_WEIGHT, VALENCE_WEIGHT
+
+FEATURE_WEIGHTS = np.array([ENERGY_WEIGHT, DANCEABILITY_WEIGHT, VALENCE_WEIGHT], dtype=np.float32)
+
+
+def mmr(relevance, points, artists, limit, relevance_weight=0.7, artist_cap=3):
+    """Order in which to show `limit` items of a pool, by maximal marginal relevance
+
+    Each step picks the item with the highest
+    relevance_weight * relevance - (1 - relevance_weight) * similarity, where
+    relevance is scaled to 0-1 over the pool and similarity is to the closest
+    item already picked: 1 minus the weighted Energy/Danceability/Valence
+    distance, relative to the spread of the pool. Only the new pick's
+    distances are computed each step, O(pool), instead of every pair.
+
+    `artists` holds an integer artist id per item. Once an artist has
+    `artist_cap` picks (0 for no cap) its other items are set aside, and are
+    appended by relevance if the pool runs out of others.
+    """
+    count = len(relevance)
+    limit = min(limit, count)
+    if not limit:
+        return np.empty(0, dtype=np.intp)
+    relevance = np.asarray(relevance, dtype=np.float32)
+    by_relevance = np.argsort(-np.where(np.isnan(relevance), -np.inf, relevance), kind='stable')
+    if relevance_weight >= 1 and not artist_cap:
+        return by_relevance[:limit]
+
+    # Songs with missing features or scores are least relevant and never count as similar
+    low = np.nanmin(relevance) if not np.isnan(relevance).all() else 0.0
+    relevance = np.nan_to_num(relevance, nan=low)
+    span = relevance.max() - low
+    penalty = np.float32(1 - relevance_weight)
+    # value = gain + distance, with distance = penalty * (1 - similarity) to the closest pick
+    gain = relevance_weight * ((relevance - low) / span if span > 0 else np.zeros(count, np.float32)) - penalty
+
+    points = np.asarray(points, dtype=np.float32)
+    total = np.nan_to_num((np.nanmax(points, axis=0) - np.nanmin(points, axis=0)) * FEATURE_WEIGHTS).sum()
+    scale = penalty * FEATURE_WEIGHTS / total if total > 0 else np.zeros(3, np.float32)
+    # One row per feature, so a pick's distances are three row operations
+    scaled = np.ascontiguousarray((points * scale).T)
+    distance = np.full(count, penalty, dtype=np.float32)
+
+    picks = []
+    per_artist = {}
+    value = np.empty(count, dtype=np.float32)
+    difference = np.empty_like(scaled)
+    pick_distance = np.empty(count, dtype=np.float32)
+    while len(picks) < limit:
+        np.add(gain, distance, out=value)
+        pick = int(value.argmax())
+        if value[pick] == -np.inf:
+            break
+        picks.append(pick)
+        gain[pick] = -np.inf
+
+        artist = artists[pick]
+        per_artist[artist] = per_artist.get(artist, 0) + 1
+        if artist_cap and per_artist[artist] >= artist_cap:
+            gain[artists == artist] = -np.inf
+
+        # fmin skips NaN distances, so songs with missing features don't pull others down
+        np.subtract(scaled, scaled[:, pick:pick + 1], out=difference)
+        np.abs(difference, out=difference)
+        np.add(difference[0], difference[1], out=pick_distance)
+        np.add(pick_distance, difference[2], out=pick_distance)
+        np.minimum(pick_distance, penalty, out=pick_distance)
+        np.fmin(distance, pick_distance, out=distance)
+
+    if len(picks) < limit:
+        picked = np.zeros(count, dtype=bool)
+        picked[picks] = True
+        rest = by_relevance[~picked[by_relevance]]
+        picks.extend(rest[:limit - len(picks)].tolist())
+    return np.array(picks, dtype=np.intp)
+
+
+def diversify(catalog, rows, scores, limit, relevance_weight=0.7, artist_cap=3):
+    """(rows, scores) of a ranking reordered by mmr(), keeping `limit` of them
+
+    The artist cap counts songs by their normalized primary artist, so
+    "A, B", "A" and "á" are the same artist.
+    """
+    points = np.column_stack((catalog.energy[rows], catalog.danceability[rows], catalog.valence[rows]))
+    ids = {}
+    artists = np.array([ids.setdefault(key, len(ids)) for key in catalog.primary_artists(rows)], dtype=np.intp)
+    order = mmr(scores, points, artists, limit, relevance_weight, artist_cap)
+    return rows[order], scores[order]
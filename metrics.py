@@ -0,0 +1,160 @@
+"""
+SpotiRec - Metrics
+Per-stage latency histograms and event counters, rendered in the Prometheus
+text exposition format
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels"""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, *labels, value):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labels, entry in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, entry):
+                    samples.append((f'{self.name}_bucket', labels + (bound,), count))
+                samples.append((f'{self.name}_bucket', labels + ('+Inf',), entry[-1]))
+                samples.append((f'{self.name}_sum', labels, entry[-2]))
+                samples.append((f'{self.name}_count', labels, entry[-1]))
+        return samples
+
+
+class Registry:
+    """Collection of metrics rendered together on /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Register a callable returning (name, type, documentation, labelnames, [(labels, value)]) tuples"""
+        self._collectors.append(collector)
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                labelnames = metric.labelnames
+                if name.endswith('_bucket'):
+                    labelnames = labelnames + ('le',)
+                lines.append(f'{name}{_format_labels(labelnames, labels)} {value}')
+        for collector in self._collectors:
+            for name, kind, documentation, labelnames, samples in collector():
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(labelnames, labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    'spotirec_request_seconds', 'Request latency by endpoint', ['endpoint', 'status']
+)
+STAGE_SECONDS = registry.histogram(
+    'spotirec_stage_seconds', 'Time spent in each stage of a request', ['endpoint', 'stage']
+)
+EVENTS = registry.counter(
+    'spotirec_events_total', 'Notable events on the recommendation path', ['event']
+)
+
+# (endpoint, timings) of the request being handled by the async server, which
+# has no Flask request context; copied into the tasks and threads it starts
+current_request = ContextVar('current_request', default=None)
+
+
+@contextmanager
+def timed(endpoint, stage, timings=None):
+    """Time a block as a request stage; appends (stage, seconds) to timings if given"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(endpoint, stage, time.perf_counter() - started, timings)
+
+
+def record_stage(endpoint, stage, seconds, timings=None):
+    """Record a stage that was timed elsewhere (e.g. in a rendering process)"""
+    STAGE_SECONDS.observe(endpoint, stage, value=seconds)
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+def server_timing_header(timings):
+    """Server-Timing header value for a request's recorded stages"""
+    return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in timings)
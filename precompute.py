@@ -0,0 +1,134 @@
+"""
+SpotiRec - Background precomputation
+Keeps recommendations for recently active users fresh on a schedule, so the
+request path can serve them without waiting on Spotify
+"""
+
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Precomputer:
+    """Tracks active users and recomputes their recommendations on an interval
+
+    compute(access_token, user_id) returns a result dict, or None if there is
+    nothing to precompute for the user. refresh(refresh_token) exchanges a
+    refresh token for (access_token, expires_in, new_refresh_token or None).
+    """
+
+    def __init__(self, compute, refresh, interval=900, active_window=86400, max_age=None, workers=4, ready=None):
+        self.compute = compute
+        self.refresh = refresh
+        self.interval = interval
+        self.active_window = active_window
+        # Results older than this are not served, even if the refresh fell behind
+        self.max_age = max_age or 2 * interval
+        self.ready = ready or (lambda: True)
+        self._users = {}    # user_id -> refresh token, access token and last activity
+        self._results = {}  # user_id -> {'version', 'computed_at', 'result'}
+        self._pending = set()
+        self._versions = itertools.count(1)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='precompute')
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Refresh tokens remembered per user as rotated away by a background refresh
+    RETIRED_TOKENS = 8
+
+    def touch(self, user_id, refresh_token):
+        """Mark a user as active so their recommendations are kept fresh
+
+        A different refresh token replaces the stored one, unless a background
+        refresh has rotated away from it: the session cookie keeps the token
+        from login, which Spotify may no longer accept.
+        """
+        with self._lock:
+            user = self._users.setdefault(user_id, {'access_token': None, 'token_expires': 0, 'retired': []})
+            if refresh_token not in user['retired']:
+                user['refresh_token'] = refresh_token
+            user['last_seen'] = time.time()
+
+    def forget(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._results.pop(user_id, None)
+
+    def latest(self, user_id):
+        """Most recent result for the user if it's fresh enough to serve, else None"""
+        with self._lock:
+            entry = self._results.get(user_id)
+        if entry is None or time.time() - entry['computed_at'] > self.max_age:
+            return None
+        return entry
+
+    def store(self, user_id, result):
+        """Save a result under a new version number"""
+        entry = {'version': next(self._versions), 'computed_at': time.time(), 'result': result}
+        with self._lock:
+            self._results[user_id] = entry
+        return entry
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='precompute-scheduler', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        # Check often enough that a user's refresh is never more than a fraction of the interval late
+        while not self._stop.wait(min(self.interval / 4, 60)):
+            if self.ready():
+                self.run_once()
+
+    def run_once(self):
+        """Drop inactive users and queue refreshes for the ones that are due"""
+        now = time.time()
+        due = []
+        with self._lock:
+            for user_id, user in list(self._users.items()):
+                if now - user['last_seen'] > self.active_window:
+                    del self._users[user_id]
+                    self._results.pop(user_id, None)
+                    continue
+                entry = self._results.get(user_id)
+                if user_id not in self._pending and (entry is None or now - entry['computed_at'] >= self.interval):
+                    self._pending.add(user_id)
+                    due.append(user_id)
+        for user_id in due:
+            self._executor.submit(self._refresh_user, user_id)
+        return due
+
+    def _refresh_user(self, user_id):
+        try:
+            with self._lock:
+                user = dict(self._users.get(user_id) or {})
+            if not user:
+                return
+            access_token = user['access_token']
+            # Renew the access token a minute before it expires
+            if access_token is None or time.time() > user['token_expires'] - 60:
+                access_token, expires_in, refresh_token = self.refresh(user['refresh_token'])
+                with self._lock:
+                    stored = self._users.get(user_id)
+                    if stored is not None:
+                        stored['access_token'] = access_token
+                        stored['token_expires'] = time.time() + expires_in
+                        if refresh_token and refresh_token != user['refresh_token']:
+                            # Rotated; keep touch() from putting the old token back
+                            stored['refresh_token'] = refresh_token
+                            stored['retired'] = (stored['retired'] + [user['refresh_token']])[-self.RETIRED_TOKENS:]
+            result = self.compute(access_token, user_id)
+            if result is not None:
+                self.store(user_id, result)
+        except Exception as error:
+            print(f'⚠️  Background refresh failed for {user_id}: {error}')
+        finally:
+            with self._lock:
+                self._pending.discard(user_id)
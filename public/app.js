@@ -262,9 +262,10 @@ async function loadVisualization() {
         
         const data = await response.json();
         
-        // Display the visualization image
+        // Display the visualization image (smaller render on narrow screens)
+        const dpi = window.innerWidth < 768 ? 72 : 150;
         visualizationContainer.innerHTML = `
-            <img src="${data.image}" alt="Music Analysis Visualization" class="visualization-image" />
+            <img src="${data.chart}?dpi=${dpi}" alt="Music Analysis Visualization" class="visualization-image" />
         `;
         
         // Display analysis metrics
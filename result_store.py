@@ -0,0 +1,99 @@
+"""
+SpotiRec - Server-side recommendation result store
+Keeps each session's latest recommendations on the server so the session
+cookie only has to carry an opaque key
+"""
+
+import json
+import secrets
+import sqlite3
+import threading
+import time
+
+from cache import TTLCache
+
+FEATURES = ('Energy', 'Danceability', 'Valence')
+
+
+def new_key():
+    """Random opaque key for a stored result"""
+    return secrets.token_urlsafe(16)
+
+
+def compact_record(recommendations, user_preferences):
+    """Reduce recommendations to ids, scores and audio features"""
+    return {
+        'preferences': user_preferences,
+        'ids': [str(r['_id']) for r in recommendations],
+        'scores': [r.get('score') for r in recommendations],
+        'features': {f: [r.get(f) for r in recommendations] for f in FEATURES},
+    }
+
+
+class MemoryResultStore:
+    """In-process LRU store; results are lost on restart and not shared between workers"""
+
+    def __init__(self, maxsize=10000, ttl=86400):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, record):
+        self._cache.set(key, record)
+
+    def delete(self, key):
+        self._cache.invalidate(key)
+
+
+class SQLiteResultStore:
+    """SQLite-backed store that several worker processes on one host can share"""
+
+    def __init__(self, path, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, record TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            # Every write purges expired rows, which would otherwise scan the table
+            conn.execute('CREATE INDEX IF NOT EXISTS results_expires_at ON results (expires_at)')
+
+    def _connection(self):
+        """One connection per thread (sqlite3 connections can't be shared across threads)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT record FROM results WHERE key = ? AND expires_at > ?', (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, record):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO results (key, record, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(record), now + self.ttl)
+            )
+            conn.execute('DELETE FROM results WHERE expires_at <= ?', (now,))
+
+    def delete(self, key):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM results WHERE key = ?', (key,))
+
+
+def create_result_store(backend, ttl=86400, maxsize=10000):
+    """Build a store from a backend spec: 'memory' or 'sqlite:///path/to/results.db'"""
+    if backend == 'memory':
+        return MemoryResultStore(maxsize=maxsize, ttl=ttl)
+    if backend.startswith('sqlite:///'):
+        return SQLiteResultStore(backend[len('sqlite:///'):], ttl=ttl)
+    raise ValueError(f'Unknown result store backend: {backend}')
@@ -0,0 +1,31 @@
+"""
+SpotiRec - Server launcher
+Starts the Flask or async server from its imported module, so this small
+script is all that chart workers re-run when they are spawned
+
+Usage:
+    python serve.py          # Flask server (app.py)
+    python serve.py async    # ASGI server (async_app.py) under uvicorn
+
+Spawned processes run the parent's __main__ script as __mp_main__ before
+they do any work. Launched as `python app.py`, every chart worker would set
+up a whole second server; launched from here, it imports nothing but sys.
+"""
+
+import sys
+
+
+def main():
+    if sys.argv[1:] not in ([], ['async']):
+        print(__doc__.split('Usage:')[1].split('\n\n')[0])
+        sys.exit(2)
+    if sys.argv[1:] == ['async']:
+        import async_app
+        async_app.main()
+    else:
+        import app
+        app.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""
+SpotiRec - Similar tracks index
+Precomputes every song's most similar songs so "more like this" is a lookup
+instead of a scored query
+
+Usage:
+    python similar_tracks.py build data/similar   # from CATALOG_SNAPSHOT, else the MONGODB_URI collection
+    python similar_tracks.py info data/similar
+
+Similarity is the catalog's audio-feature score between two songs (weighted
+Energy, Danceability and Valence closeness) plus ARTIST_BONUS when they share
+an artist. An index directory holds an int32 matrix of neighbour rows, a
+float16 matrix of their scores and the song ids the rows were built from, and
+is published like a catalog snapshot.
+"""
+
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from catalog import DANCEABILITY_WEIGHT, ENERGY_WEIGHT, VALENCE_WEIGHT, FeatureIndex, normalize_artist
+from catalog_snapshot import StringTable, _string_table, new_version, publish_version
+
+FORMAT_VERSION = 1
+# Neighbours stored per song
+DEFAULT_NEIGHBOURS = 50
+# Added to the similarity of two songs by the same artist
+ARTIST_BONUS = 2.0
+# Similarity of two songs with identical features
+FEATURE_SCORE = ENERGY_WEIGHT + DANCEABILITY_WEIGHT + VALENCE_WEIGHT
+
+# Songs whose feature neighbours are queried at once
+BLOCK_ROWS = 1 << 16
+# Upper bound on pairwise feature differences held in memory by the same-artist pass
+ARTIST_CHUNK_CELLS = 1 << 22
+
+
+def _points(catalog, rows=slice(None)):
+    """(Energy, Danceability, Valence) of the given rows as an (n, 3) float32 array"""
+    return np.column_stack([catalog.energy[rows], catalog.danceability[rows], catalog.valence[rows]]).astype(np.float32)
+
+
+def _row_artists(catalog):
+    """Artist code of each row, or -1 for deleted songs and songs without an artist"""
+    codes = np.asarray(catalog.artist_codes, dtype=np.int64)
+    named = np.array([isinstance(name, str) for name in catalog.artist_names] + [False], dtype=bool)
+    # Deleted rows have code -1, which picks the trailing False
+    return np.where(named[codes], codes, -1)
+
+
+def _select(candidates, scores, n):
+    """The n best (row, score) candidates per query row, best first, padded with -1 / -inf"""
+    if scores.shape[1] > n:
+        keep = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+        candidates = np.take_along_axis(candidates, keep, axis=1)
+        scores = np.take_along_axis(scores, keep, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    candidates = np.take_along_axis(candidates, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    candidates = np.where(np.isfinite(scores), candidates, -1)
+    if scores.shape[1] < n:
+        pad = n - scores.shape[1]
+        candidates = np.pad(candidates, ((0, 0), (0, pad)), constant_values=-1)
+        scores = np.pad(scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+    return candidates, scores
+
+
+def _feature_neighbours(feature_index, rows, points, artists, artist_codes, n):
+    """Nearest songs by feature score to the given rows, skipping each row itself and songs by its artist
+
+    `points` and `artists` hold the rows' features and artist codes (-1 for
+    none); same-artist songs come from the artist pass, with the bonus added.
+    """
+    k = min(n + 1, feature_index.size)
+    if k == 0 or len(rows) == 0:
+        return np.full((len(rows), 0), -1, dtype=np.intp), np.empty((len(rows), 0), dtype=np.float32)
+    distances, candidates = feature_index.nearest(points, k, workers=-1)
+    scores = (FEATURE_SCORE - distances).astype(np.float32)
+    artists = artists[:, None]
+    skip = (candidates == rows[:, None]) | ((artist_codes[candidates] == artists) & (artists >= 0))
+    scores[skip] = -np.inf
+    return candidates, scores
+
+
+def _artist_neighbours(points, row_artists, neighbours, scores, chunk_cells=ARTIST_CHUNK_CELLS):
+    """Fill (songs, n) neighbours and scores with each song's best songs by the same artist, bonus included
+
+    Artists are padded to the next power of two in size and compared in
+    batches of equal width, so each batch is one vectorized pairwise pass.
+    """
+    n = neighbours.shape[1]
+    order = np.argsort(row_artists, kind='stable')
+    order = order[row_artists[order] >= 0]
+    if len(order) == 0:
+        return
+    codes = row_artists[order]
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    starts, sizes = starts[sizes > 1], sizes[sizes > 1]
+    widths = 1 << np.ceil(np.log2(np.maximum(sizes, 2))).astype(np.int64)
+
+    for width in np.unique(widths):
+        width = int(width)
+        group_starts, group_sizes = starts[widths == width], sizes[widths == width]
+        columns = np.arange(width)
+        groups_per_chunk = max(1, chunk_cells // (width * width * 3))
+        rows_per_slice = width if groups_per_chunk > 1 else max(1, chunk_cells // (width * 3))
+        for g in range(0, len(group_starts), groups_per_chunk):
+            chunk_starts, chunk_sizes = group_starts[g:g + groups_per_chunk], group_sizes[g:g + groups_per_chunk]
+            present = columns < chunk_sizes[:, None]
+            members = np.where(present, order[np.minimum(chunk_starts[:, None] + columns, len(order) - 1)], -1)
+            features = np.where(present[..., None], points[members], np.nan) * FeatureIndex.WEIGHTS
+            for a in range(0, width, rows_per_slice):
+                b = min(a + rows_per_slice, width)
+                distances = np.abs(features[:, a:b, None, :] - features[:, None, :, :]).sum(axis=-1)
+                similarity = FEATURE_SCORE + ARTIST_BONUS - distances
+                similarity[np.isnan(similarity)] = -np.inf
+                similarity[:, np.arange(b - a), np.arange(a, b)] = -np.inf
+                candidates = np.broadcast_to(members[:, None, :], similarity.shape)
+                top, top_scores = _select(
+                    candidates.reshape(-1, width), similarity.reshape(-1, width), n
+                )
+                queries = members[:, a:b].reshape(-1)
+                valid = queries >= 0
+                neighbours[queries[valid]] = top[valid]
+                scores[queries[valid]] = top_scores[valid]
+
+
+def build(catalog, n=DEFAULT_NEIGHBOURS, block_rows=BLOCK_ROWS, chunk_cells=ARTIST_CHUNK_CELLS):
+    """(neighbours, scores): each song's n most similar songs as an (songs, n) row matrix, best first
+
+    Only the n nearest songs by features and the n best by the same artist can
+    make a song's top n, so both are computed in vectorized blocks and merged;
+    the result is exact (up to the catalog's knn_eps). Songs with missing
+    features get no neighbours and are nobody's neighbour. Unused slots are -1.
+    """
+    points = _points(catalog)
+    row_artists = _row_artists(catalog)
+    feature_index = catalog.feature_index
+
+    # Same-artist candidates first, then merged with the feature candidates a block at a time
+    neighbours = np.full((len(catalog), n), -1, dtype=np.int32)
+    scores = np.full((len(catalog), n), -np.inf, dtype=np.float32)
+    _artist_neighbours(points, row_artists, neighbours, scores, chunk_cells)
+    for start in range(0, len(catalog), block_rows):
+        rows = np.arange(start, min(start + block_rows, len(catalog)))
+        rows = rows[~np.isnan(points[rows]).any(axis=1)]
+        candidates, candidate_scores = _feature_neighbours(
+            feature_index, rows, points[rows], row_artists[rows], row_artists, n
+        )
+        top, top_scores = _select(
+            np.hstack([candidates, neighbours[rows]]), np.hstack([candidate_scores, scores[rows]]), n
+        )
+        neighbours[rows] = top
+        scores[rows] = top_scores
+    # Scores only order neighbours for display, so half precision is enough to store them
+    scores[neighbours < 0] = np.nan
+    return neighbours, scores.astype(np.float16)
+
+
+def similar_rows(catalog, row, n=DEFAULT_NEIGHBOURS):
+    """(rows, scores) of one song's n most similar songs, computed on demand like build()"""
+    rows = np.array([row])
+    point = _points(catalog, rows)
+    if row >= len(catalog) or np.isnan(point).any():
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+    artist_codes = np.asarray(catalog.artist_codes)
+    code = int(artist_codes[row])
+    name = catalog.artist_names[code] if code >= 0 else None
+    if not isinstance(name, str):
+        code = -1
+
+    candidates, scores = _feature_neighbours(
+        catalog.feature_index, rows, point, np.array([code]), artist_codes, n
+    )
+    if code >= 0:
+        same = np.asarray(catalog.artist_index.rows.get(normalize_artist(name), ()), dtype=np.intp)
+        same = same[(artist_codes[same] == code) & (same != row)]
+        distances = (np.abs(_points(catalog, same) - point) * FeatureIndex.WEIGHTS).sum(axis=1)
+        same_scores = (FEATURE_SCORE + ARTIST_BONUS - distances).astype(np.float32)
+        same_scores[np.isnan(same_scores)] = -np.inf
+        candidates = np.hstack([candidates, same[None, :]])
+        scores = np.hstack([scores, same_scores[None, :]])
+    top, top_scores = _select(candidates, scores, n)
+    keep = top[0] >= 0
+    return top[0][keep], top_scores[0][keep]
+
+
+class SimilarTracks:
+    """Neighbour lists from a built index, looked up by catalog row
+
+    The index is only used for a song while the catalog still has the same
+    song at that row, as it does after incremental sync; otherwise, or without
+    an index, neighbours are computed on demand.
+    """
+
+    def __init__(self, neighbours=None, scores=None, ids=None):
+        self.neighbours = neighbours
+        self.scores = scores
+        self.ids = ids
+        self.hits = 0
+        self.misses = 0
+
+    def find(self, catalog, song_id):
+        """Catalog row of a song by the id clients see (str of its _id), or None"""
+        return catalog.rows_by_id().get(song_id)
+
+    def _indexed(self, catalog, row):
+        if self.neighbours is None or row >= len(self.neighbours):
+            return False
+        return catalog.rows_by_id().get(self.ids[row]) == row
+
+    def similar(self, catalog, row, limit=20):
+        """(rows, scores) of up to `limit` songs most similar to a catalog row, best first"""
+        if not self._indexed(catalog, row):
+            self.misses += 1
+            rows, scores = similar_rows(catalog, row, limit)
+            return rows.tolist(), scores.tolist()
+        self.hits += 1
+        rows, scores = [], []
+        for neighbour, score in zip(self.neighbours[row].tolist(), self.scores[row].tolist()):
+            if neighbour < 0 or len(rows) == limit:
+                break
+            # Skip neighbours deleted or replaced since the index was built
+            if self._indexed(catalog, neighbour):
+                rows.append(neighbour)
+                scores.append(score)
+        return rows, scores
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': 0 if self.neighbours is None else len(self.neighbours),
+        }
+
+
+def write_index(catalog, path, n=DEFAULT_NEIGHBOURS):
+    """Build the similar tracks index for a catalog and point `path` at it"""
+    if catalog.deleted:
+        catalog = catalog.compact()
+    neighbours, scores = build(catalog, n)
+    version = new_version(path)
+
+    def save(name, array):
+        np.save(os.path.join(version, f'{name}.npy'), np.ascontiguousarray(array))
+
+    save('neighbours', neighbours)
+    save('scores', scores)
+    offsets, data, _ = _string_table([str(doc['_id']) for doc in catalog.documents])
+    save('id_offsets', offsets)
+    save('id_strings', data)
+
+    with open(os.path.join(version, 'manifest.json'), 'w') as f:
+        json.dump({
+            'format': FORMAT_VERSION,
+            'songs': len(catalog),
+            'neighbours': n,
+            'artist_bonus': ARTIST_BONUS,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }, f, indent=2)
+    return publish_version(path, version)
+
+
+def load_index(path):
+    """Memory-map a similar tracks index"""
+    path = os.path.realpath(path)
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest['format'] != FORMAT_VERSION:
+        raise ValueError(f'Unsupported similar tracks index format {manifest["format"]}')
+
+    def load(name):
+        return np.asarray(np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+
+    return SimilarTracks(load('neighbours'), load('scores'), StringTable(load('id_offsets'), load('id_strings')))
+
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] not in ('build', 'info'):
+        print(__doc__.split('Usage:')[1].split('\n\n')[0])
+        sys.exit(2)
+    command, path = sys.argv[1:]
+
+    if command == 'info':
+        with open(os.path.join(os.path.realpath(path), 'manifest.json')) as f:
+            print(json.dumps(json.load(f), indent=2))
+        return
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    started = time.perf_counter()
+    if os.getenv('CATALOG_SNAPSHOT'):
+        from catalog_snapshot import load_snapshot
+        catalog = load_snapshot(os.getenv('CATALOG_SNAPSHOT'))
+    else:
+        from pymongo import MongoClient
+        from catalog import Catalog
+        from catalog_queries import song_projection
+        collection = MongoClient(os.getenv('MONGODB_URI'))['recommender']['cleaned_copy3']
+        catalog = Catalog.from_collection(collection, projection=song_projection())
+    n = int(os.getenv('SIMILAR_NEIGHBOURS', DEFAULT_NEIGHBOURS))
+    version = write_index(catalog, path, n)
+    print(f'💾 Wrote {n} neighbours for {len(catalog)} songs to {version} in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
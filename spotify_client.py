@@ -0,0 +1,269 @@
+"""
+SpotiRec - Spotify Web API client
+Shared keep-alive connection pool with timeouts for all Spotify calls, plus
+asyncio versions of the request-path calls for the async server. API calls go
+through a SpotifyGateway for rate limiting, coalescing and token renewal.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from spotify_gateway import SpotifyError, SpotifyGateway
+
+# Overridable so benchmarks can point the app at a local stub server
+API_BASE_URL = os.getenv('SPOTIFY_API_URL', 'https://api.spotify.com/v1')
+TOKEN_URL = os.getenv('SPOTIFY_TOKEN_URL', 'https://accounts.spotify.com/api/token')
+
+# (connect, read) timeout in seconds for every Spotify request
+SPOTIFY_TIMEOUT = (
+    float(os.getenv('SPOTIFY_CONNECT_TIMEOUT', 3.05)),
+    float(os.getenv('SPOTIFY_READ_TIMEOUT', 10)),
+)
+SPOTIFY_POOL_SIZE = int(os.getenv('SPOTIFY_POOL_SIZE', 20))
+# Connections the async client may hold open at once (async server only)
+SPOTIFY_ASYNC_POOL_SIZE = int(os.getenv('SPOTIFY_ASYNC_POOL_SIZE', 200))
+
+# Shared request budget: steady rate per second and burst size
+SPOTIFY_RATE_LIMIT = float(os.getenv('SPOTIFY_RATE_LIMIT', 10))
+SPOTIFY_RATE_BURST = int(os.getenv('SPOTIFY_RATE_BURST', 20))
+# Longest a request waits for budget (or a Retry-After) before serving cached data
+SPOTIFY_MAX_WAIT = float(os.getenv('SPOTIFY_MAX_WAIT', 5))
+# Consecutive failures that open the circuit, and seconds before a trial call
+SPOTIFY_BREAKER_THRESHOLD = int(os.getenv('SPOTIFY_BREAKER_THRESHOLD', 5))
+SPOTIFY_BREAKER_RESET = float(os.getenv('SPOTIFY_BREAKER_RESET', 30))
+# Last good responses kept to serve while Spotify is unavailable
+SPOTIFY_STALE_TTL = int(os.getenv('SPOTIFY_STALE_TTL', 86400))
+SPOTIFY_STALE_SIZE = int(os.getenv('SPOTIFY_STALE_SIZE', 5000))
+
+# Most ids the several-artists endpoint accepts per call
+ARTISTS_BATCH_SIZE = 50
+
+# Time ranges tried for top tracks, in priority order
+TIME_RANGES = [
+    ('short_term', 'short_term (last 4 weeks)'),
+    ('medium_term', 'medium_term (last 6 months)'),
+    ('long_term', 'long_term (all time)'),
+]
+
+# One session per process so TLS connections are reused across requests
+http = requests.Session()
+http.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=SPOTIFY_POOL_SIZE))
+http.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=SPOTIFY_POOL_SIZE))
+
+_executor = ThreadPoolExecutor(max_workers=SPOTIFY_POOL_SIZE, thread_name_prefix='spotify')
+
+# Senders are looked up on each call so benchmarks can patch them; the app sets
+# gateway.refresher once it can exchange refresh tokens
+gateway = SpotifyGateway(
+    lambda *args: send(*args), lambda *args: send_async(*args),
+    rate=SPOTIFY_RATE_LIMIT, burst=SPOTIFY_RATE_BURST, max_wait=SPOTIFY_MAX_WAIT,
+    breaker_threshold=SPOTIFY_BREAKER_THRESHOLD, breaker_reset=SPOTIFY_BREAKER_RESET,
+    stale_ttl=SPOTIFY_STALE_TTL, stale_size=SPOTIFY_STALE_SIZE,
+)
+
+
+def send(path, access_token, params=None):
+    """GET a Spotify Web API endpoint directly"""
+    return http.get(
+        f'{API_BASE_URL}{path}',
+        headers={'Authorization': f'Bearer {access_token}'},
+        params=params,
+        timeout=SPOTIFY_TIMEOUT
+    )
+
+
+def get(path, token, params=None):
+    """GET a Spotify Web API endpoint through the gateway; token is an access token or a UserToken"""
+    return gateway.get(path, token, params)
+
+
+def request_token(data, auth_header):
+    """POST to the Spotify accounts token endpoint"""
+    return http.post(
+        TOKEN_URL,
+        data=data,
+        headers={
+            'Authorization': f'Basic {auth_header}',
+            'Content-Type': 'application/x-www-form-urlencoded'
+        },
+        timeout=SPOTIFY_TIMEOUT
+    )
+
+
+def get_top_tracks(access_token, time_range, limit=20):
+    """User's top tracks for a time range, or an empty list if unavailable"""
+    try:
+        response = get('/me/top/tracks', access_token, params={'limit': limit, 'time_range': time_range})
+        if response.status_code == 200:
+            return response.json().get('items', [])
+    except SpotifyError:
+        raise
+    except Exception:
+        pass
+    print(f'⚠️  No {time_range} data available')
+    return []
+
+
+def get_recently_played(access_token, after=None, limit=50):
+    """Tracks played after `after` (milliseconds since the epoch), newest first, or an empty list if unavailable
+
+    Spotify only keeps the last 50 plays, so one page covers everything new.
+    """
+    params = {'limit': limit}
+    if after:
+        params['after'] = after
+    try:
+        response = get('/me/player/recently-played', access_token, params=params)
+        if response.status_code == 200:
+            return response.json().get('items', [])
+        print(f'⚠️  Recently played lookup failed with status {response.status_code}')
+    except SpotifyError:
+        raise
+    except Exception as error:
+        print(f'⚠️  Recently played lookup failed: {error}')
+    return []
+
+
+def _get_artist_batch(access_token, artist_ids):
+    response = get('/artists', access_token, params={'ids': ','.join(artist_ids)})
+    if response.status_code != 200:
+        print(f'⚠️  Artist lookup failed with status {response.status_code}')
+        return []
+    return [artist for artist in response.json().get('artists', []) if artist]
+
+
+def get_artists(access_token, artist_ids):
+    """Full artist objects (with genres) for the given ids, 50 per request
+
+    Batches are requested concurrently. Ids Spotify doesn't know, and batches
+    that fail, are left out of the result.
+    """
+    artist_ids = list(dict.fromkeys(artist_ids))
+    batches = [artist_ids[i:i + ARTISTS_BATCH_SIZE] for i in range(0, len(artist_ids), ARTISTS_BATCH_SIZE)]
+    if len(batches) == 1:
+        return _get_artist_batch(access_token, batches[0])
+    futures = [_executor.submit(_get_artist_batch, access_token, batch) for batch in batches]
+    return [artist for future in futures for artist in future.result()]
+
+
+def get_top_tracks_with_fallback(access_token, limit=20, parallel=True):
+    """Top tracks from the first time range that has any, with a label for the range used
+
+    In parallel mode all time ranges are requested at once, so the worst case
+    costs one round trip instead of three.
+    """
+    if parallel:
+        futures = [
+            (_executor.submit(get_top_tracks, access_token, time_range, limit), label)
+            for time_range, label in TIME_RANGES
+        ]
+        for future, label in futures:
+            top_tracks = future.result()
+            if top_tracks:
+                return top_tracks, label
+        return [], ''
+
+    for time_range, label in TIME_RANGES:
+        top_tracks = get_top_tracks(access_token, time_range, limit)
+        if top_tracks:
+            return top_tracks, label
+    return [], ''
+
+
+# Async client, created on first use inside the server's event loop
+_async_http = None
+
+
+def async_http():
+    """Shared httpx.AsyncClient for the async server"""
+    global _async_http
+    if _async_http is None:
+        import httpx
+        _async_http = httpx.AsyncClient(
+            timeout=httpx.Timeout(SPOTIFY_TIMEOUT[1], connect=SPOTIFY_TIMEOUT[0]),
+            limits=httpx.Limits(max_connections=SPOTIFY_ASYNC_POOL_SIZE, max_keepalive_connections=SPOTIFY_POOL_SIZE),
+        )
+    return _async_http
+
+
+async def close_async():
+    global _async_http
+    if _async_http is not None:
+        await _async_http.aclose()
+        _async_http = None
+
+
+async def send_async(path, access_token, params=None):
+    """GET a Spotify Web API endpoint directly without blocking the event loop"""
+    return await async_http().get(
+        f'{API_BASE_URL}{path}',
+        headers={'Authorization': f'Bearer {access_token}'},
+        params=params
+    )
+
+
+async def get_async(path, token, params=None):
+    """Async get"""
+    return await gateway.get_async(path, token, params)
+
+
+async def get_top_tracks_async(access_token, time_range, limit=20):
+    """Async get_top_tracks"""
+    try:
+        response = await get_async('/me/top/tracks', access_token, params={'limit': limit, 'time_range': time_range})
+        if response.status_code == 200:
+            return response.json().get('items', [])
+    except SpotifyError:
+        raise
+    except Exception:
+        pass
+    print(f'⚠️  No {time_range} data available')
+    return []
+
+
+async def get_top_tracks_with_fallback_async(access_token, limit=20):
+    """Async get_top_tracks_with_fallback; all time ranges are requested at once"""
+    results = await asyncio.gather(*[
+        get_top_tracks_async(access_token, time_range, limit) for time_range, _ in TIME_RANGES
+    ])
+    for top_tracks, (_, label) in zip(results, TIME_RANGES):
+        if top_tracks:
+            return top_tracks, label
+    return [], ''
+
+
+async def get_recently_played_async(access_token, after=None, limit=50):
+    """Async get_recently_played"""
+    params = {'limit': limit}
+    if after:
+        params['after'] = after
+    try:
+        response = await get_async('/me/player/recently-played', access_token, params=params)
+        if response.status_code == 200:
+            return response.json().get('items', [])
+        print(f'⚠️  Recently played lookup failed with status {response.status_code}')
+    except SpotifyError:
+        raise
+    except Exception as error:
+        print(f'⚠️  Recently played lookup failed: {error}')
+    return []
+
+
+async def _get_artist_batch_async(access_token, artist_ids):
+    response = await get_async('/artists', access_token, params={'ids': ','.join(artist_ids)})
+    if response.status_code != 200:
+        print(f'⚠️  Artist lookup failed with status {response.status_code}')
+        return []
+    return [artist for artist in response.json().get('artists', []) if artist]
+
+
+async def get_artists_async(access_token, artist_ids):
+    """Async get_artists"""
+    artist_ids = list(dict.fromkeys(artist_ids))
+    batches = [artist_ids[i:i + ARTISTS_BATCH_SIZE] for i in range(0, len(artist_ids), ARTISTS_BATCH_SIZE)]
+    results = await asyncio.gather(*[_get_artist_batch_async(access_token, batch) for batch in batches])
+    return [artist for batch in results for artist in batch]
@@ -0,0 +1,417 @@
+"""
+SpotiRec - Spotify gateway
+Request policies shared by every Spotify call: coalescing of identical
+in-flight requests, a shared rate budget that honors Retry-After, transparent
+access token renewal and a circuit breaker that falls back to cached data
+"""
+
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+from cache import TTLCache
+
+
+class SpotifyError(Exception):
+    """A Spotify call that could not be answered"""
+
+
+class SpotifyUnavailable(SpotifyError):
+    """Spotify is rate limiting or failing and there is no cached response to serve"""
+
+    def __init__(self, reason, retry_after=1):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class SpotifyAuthError(SpotifyError):
+    """Spotify rejected the user's token and it could not be renewed"""
+
+
+class UserToken:
+    """A user's access token, renewable with their refresh token
+
+    The gateway updates it in place when it renews it and sets `renewed`, so
+    the caller can save the new token back to the session.
+    """
+
+    def __init__(self, access_token, refresh_token=None, expires_at=None, user=None):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+        self.user = user
+        self.renewed = False
+
+    def expiring(self, margin=60):
+        """True if the token is about to expire and can be renewed"""
+        return bool(self.refresh_token and self.expires_at and time.time() > self.expires_at - margin)
+
+
+class CachedResponse:
+    """Last good response to a request, served in place of a live one"""
+
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+        self.text = json.dumps(data)
+        self.headers = {'X-Cache': 'stale'}
+
+    def json(self):
+        return self.data
+
+
+class TokenBucket:
+    """Request budget of `rate` per second with bursts of up to `burst`
+
+    A 429's Retry-After blocks the whole bucket, since Spotify's limit applies
+    to the app rather than to a user.
+    """
+
+    def __init__(self, rate=10, burst=20):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token; returns how many seconds to wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            debt = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(debt, self.blocked_until - now)
+
+    def cancel(self):
+        """Give back a reserved token that won't be used"""
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    def block(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def blocked_for(self):
+        return max(self.blocked_until - time.monotonic(), 0.0)
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and lets one trial call through every `reset_timeout` seconds
+
+    The trial call must end with success(), failure() or release(); a trial
+    still pending after `reset_timeout` is given to another call.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.opens = 0
+        self._trial = False
+        self._trial_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if self._trial else 'open'
+
+    def allow(self):
+        """False if calls are refused, 'trial' for the half-open trial call, else True"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if self._trial:
+                if now - self._trial_at < self.reset_timeout:
+                    return False
+            elif now - self.opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            self._trial_at = now
+            return 'trial'
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def release(self):
+        """End a trial call that got no answer either way, so the next call can try"""
+        with self._lock:
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self.opened_at is None and self.failures >= self.threshold):
+                self.opened_at = time.monotonic()
+                self.opens += 1
+            self._trial = False
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0.0
+        return max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0)
+
+
+class SingleFlight:
+    """Runs one call per key at a time; callers arriving meanwhile share its result"""
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def do_async(self, key, fn):
+        """do() for coroutine functions, within one event loop"""
+        future = self._async_calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except BaseException as error:
+            future.set_exception(error)
+            # Retrieved here so an exception nobody else waited for isn't logged
+            future.exception()
+            raise
+        finally:
+            del self._async_calls[key]
+
+
+def _retry_after(response, default=1.0):
+    try:
+        return max(float(response.headers.get('Retry-After', default)), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class SpotifyGateway:
+    """Applies the request policies around send(path, access_token, params)
+
+    Tokens may be plain access token strings or UserToken objects; only the
+    latter are renewed, through refresher(refresh_token), which returns
+    (access_token, expires_in, new refresh token or None). Identical GETs for
+    the same user are coalesced while in flight. Every call takes a token from
+    the shared bucket and waits at most `max_wait` seconds for one.
+    5xx responses and connection errors count towards the circuit breaker.
+    Whenever a call can't be answered live, the last good response to the same
+    request is served if there is one, otherwise SpotifyUnavailable is raised.
+    """
+
+    def __init__(self, send, send_async=None, refresher=None, rate=10, burst=20, max_wait=5, max_retries=2,
+                 breaker_threshold=5, breaker_reset=30, stale_ttl=86400, stale_size=5000):
+        self.send = send
+        self.send_async = send_async
+        self.refresher = refresher
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self.stale = TTLCache(maxsize=stale_size, ttl=stale_ttl)
+        self.flights = SingleFlight()
+        self._refreshes = SingleFlight()
+        self.counts = {'requests': 0, 'throttled': 0, 'refreshes': 0, 'stale_served': 0, 'unavailable': 0}
+
+    @staticmethod
+    def _token(token):
+        return token if isinstance(token, UserToken) else UserToken(token)
+
+    @staticmethod
+    def _key(token, path, params):
+        return (token.user or token.access_token, path, tuple(sorted((params or {}).items())))
+
+    def get(self, path, token, params=None):
+        """GET a Spotify endpoint through the gateway"""
+        token = self._token(token)
+        key = self._key(token, path, params)
+        return self.flights.do(key, lambda: self._get(path, token, params, key))
+
+    async def get_async(self, path, token, params=None):
+        """get() for the async server"""
+        token = self._token(token)
+        key = self._key(token, path, params)
+        return await self.flights.do_async(key, lambda: self._get_async(path, token, params, key))
+
+    def _get(self, path, token, params, key):
+        permit = self.breaker.allow()
+        if not permit:
+            return self._fallback(key, 'circuit open')
+        try:
+            return self._attempt(path, token, params, key)
+        finally:
+            if permit == 'trial':
+                self.breaker.release()
+
+    def _attempt(self, path, token, params, key):
+        refreshed = False
+        response = None
+        for _ in range(self.max_retries + 1):
+            if token.expiring() and not refreshed:
+                self.refresh(token)
+                refreshed = True
+            wait = self._reserve()
+            if wait is None:
+                break
+            if wait:
+                time.sleep(wait)
+            try:
+                self.counts['requests'] += 1
+                response = self.send(path, token.access_token, params)
+            except Exception as error:
+                self.breaker.failure()
+                return self._fallback(key, f'request failed ({error})')
+            action = self._handle(response, key, token, refreshed)
+            if action == 'refresh':
+                self.refresh(token)
+                refreshed = True
+            elif action == 'fallback':
+                return self._fallback(key, f'status {response.status_code}', response)
+            elif action == 'done':
+                return response
+        return self._fallback(key, 'rate limited')
+
+    async def _get_async(self, path, token, params, key):
+        permit = self.breaker.allow()
+        if not permit:
+            return self._fallback(key, 'circuit open')
+        try:
+            return await self._attempt_async(path, token, params, key)
+        finally:
+            if permit == 'trial':
+                self.breaker.release()
+
+    async def _attempt_async(self, path, token, params, key):
+        refreshed = False
+        response = None
+        for _ in range(self.max_retries + 1):
+            if token.expiring() and not refreshed:
+                await asyncio.to_thread(self.refresh, token)
+                refreshed = True
+            wait = self._reserve()
+            if wait is None:
+                break
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                self.counts['requests'] += 1
+                response = await self.send_async(path, token.access_token, params)
+            except Exception as error:
+                self.breaker.failure()
+                return self._fallback(key, f'request failed ({error})')
+            action = self._handle(response, key, token, refreshed)
+            if action == 'refresh':
+                await asyncio.to_thread(self.refresh, token)
+                refreshed = True
+            elif action == 'fallback':
+                return self._fallback(key, f'status {response.status_code}', response)
+            elif action == 'done':
+                return response
+        return self._fallback(key, 'rate limited')
+
+    def _reserve(self):
+        """Seconds to wait for a request token, or None if that would take longer than max_wait"""
+        wait = self.bucket.reserve()
+        if wait > self.max_wait:
+            self.bucket.cancel()
+            return None
+        return wait
+
+    def _handle(self, response, key, token, refreshed):
+        """What to do with a response: 'done', 'retry', 'refresh' or 'fallback'"""
+        status = response.status_code
+        if status >= 500:
+            self.breaker.failure()
+            return 'fallback'
+        # Any other answer, a 401 or 429 included, shows Spotify is up
+        self.breaker.success()
+        if status == 429:
+            self.counts['throttled'] += 1
+            self.bucket.block(_retry_after(response))
+            return 'retry'
+        if status == 401:
+            if token.refresh_token and not refreshed:
+                return 'refresh'
+            raise SpotifyAuthError('Spotify rejected the access token')
+        if status == 200:
+            try:
+                self.stale.set(key, response.json())
+            except ValueError:
+                pass
+        return 'done'
+
+    def _fallback(self, key, reason, response=None):
+        """The last good response to a request, else the failed response, else SpotifyUnavailable"""
+        data = self.stale.get(key)
+        if data is not None:
+            self.counts['stale_served'] += 1
+            print(f'⚠️  Spotify {reason}, serving cached {key[1]}')
+            return CachedResponse(data)
+        if response is not None:
+            return response
+        self.counts['unavailable'] += 1
+        retry_after = max(self.bucket.blocked_for(), self.breaker.retry_after(), 1.0)
+        raise SpotifyUnavailable(f'Spotify {reason}', retry_after=retry_after)
+
+    def refresh(self, token):
+        """Renew a UserToken; concurrent renewals of the same token share one call"""
+        if not token.refresh_token or self.refresher is None:
+            raise SpotifyAuthError('No refresh token to renew the access token with')
+        refresh_token = token.refresh_token
+        try:
+            access_token, expires_in, new_refresh_token = self._refreshes.do(
+                refresh_token, lambda: self.refresher(refresh_token)
+            )
+        except SpotifyError:
+            raise
+        except Exception as error:
+            raise SpotifyAuthError(f'Token refresh failed ({error})') from error
+        token.access_token = access_token
+        token.expires_at = time.time() + expires_in
+        token.refresh_token = new_refresh_token or refresh_token
+        token.renewed = True
+        self.counts['refreshes'] += 1
+        print('🔑 Renewed Spotify access token')
+
+    def stats(self):
+        return {
+            **self.counts,
+            'coalesced': self.flights.coalesced,
+            'circuit_state': self.breaker.state,
+            'circuit_opens': self.breaker.opens,
+        }
@@ -0,0 +1,55 @@
+"""
+SpotiRec - Startup tracking
+Times each startup phase and tracks whether the service is ready to serve
+recommendations
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Startup:
+    """Startup phase timings and readiness state"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.error = None
+        self._ready = threading.Event()
+
+    @contextmanager
+    def phase(self, name):
+        """Time a block of startup work"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.perf_counter() - started, 4)
+
+    def record(self, name, seconds):
+        """Record a phase that was timed elsewhere"""
+        self.phases[name] = round(seconds, 4)
+
+    def mark_ready(self):
+        self.record('total', time.perf_counter() - self.started)
+        self._ready.set()
+
+    def fail(self, error):
+        self.error = str(error)
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def report(self):
+        """Readiness and timing breakdown"""
+        return {'ready': self.ready, 'error': self.error, 'phases': dict(self.phases)}
+
+    def summary(self):
+        """One-line timing breakdown for the log"""
+        return ', '.join(f'{name} {seconds * 1000:.0f}ms' for name, seconds in self.phases.items())
+
+
+# Created on first import, so 'started' is close to process start
+startup = Startup()
@@ -0,0 +1,123 @@
+"""
+SpotiRec - Incremental taste profiles
+Keeps a time-decayed running aggregate of each user's audio features and
+artists, updated from the plays Spotify reports since the last refresh
+"""
+
+import copy
+import threading
+import time
+from datetime import datetime
+
+FEATURES = ('energy', 'danceability', 'valence')
+
+
+def played_at_ms(item):
+    """Milliseconds since the epoch of a recently-played item, as Spotify's `after` cursor takes it"""
+    played_at = datetime.fromisoformat(item['played_at'].replace('Z', '+00:00'))
+    return int(played_at.timestamp() * 1000)
+
+
+class TasteProfiles:
+    """Per-user taste profiles in a key-value store (see result_store)
+
+    A profile holds decayed sums of each play's audio features and a decayed
+    weight per artist. A play counts 1 when it happens and half as much every
+    `half_life` seconds after that; decaying the sums and the total weight
+    together keeps the averages unchanged until new plays arrive. A play's
+    features are the average of its artists' songs in the catalog.
+
+    New profiles are seeded from the user's top tracks, counted as plays at
+    seeding time. After that each update only applies plays newer than the
+    profile's cursor, so Spotify can be asked for just those with `after`.
+    """
+
+    def __init__(self, store, half_life=14 * 86400, max_artists=200):
+        self.store = store
+        self.half_life = half_life
+        self.max_artists = max_artists
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(user_id):
+        return f'taste:{user_id}'
+
+    def get(self, user_id):
+        return self.store.get(self._key(user_id))
+
+    def delete(self, user_id):
+        self.store.delete(self._key(user_id))
+
+    def update(self, user_id, snapshot, plays=(), seed_tracks=(), now=None):
+        """Apply recently-played items (and top tracks, for a new profile) and save the profile
+
+        Returns the profile, or None if the user has no profile and nothing to start one with.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            # Work on a copy; the memory store hands out the stored object
+            profile = copy.deepcopy(self.get(user_id))
+            if profile is None:
+                if not plays and not seed_tracks:
+                    return None
+                profile = {
+                    'sums': [0.0, 0.0, 0.0], 'weight': 0.0, 'artists': {},
+                    'cursor': 0, 'plays': 0, 'updated_at': now,
+                }
+            self._decay(profile, now)
+
+            tracks = [(track, 1.0) for track in seed_tracks]
+            new_plays = [item for item in plays if played_at_ms(item) > profile['cursor']]
+            for item in new_plays:
+                age = max(now - played_at_ms(item) / 1000, 0.0)
+                tracks.append((item['track'], 0.5 ** (age / self.half_life)))
+            self._add(profile, snapshot, tracks)
+
+            if new_plays:
+                profile['cursor'] = max(played_at_ms(item) for item in new_plays)
+                profile['plays'] += len(new_plays)
+            self.store.set(self._key(user_id), profile)
+            return profile
+
+    def _decay(self, profile, now):
+        factor = 0.5 ** (max(now - profile['updated_at'], 0.0) / self.half_life)
+        profile['sums'] = [value * factor for value in profile['sums']]
+        profile['weight'] *= factor
+        for artist in profile['artists'].values():
+            artist['weight'] *= factor
+        profile['updated_at'] = now
+
+    def _add(self, profile, snapshot, tracks):
+        means = {}
+        for track, weight in tracks:
+            names = tuple(artist['name'] for artist in track.get('artists', []) if artist.get('name'))
+            for artist in track.get('artists', []):
+                if not artist.get('id'):
+                    continue
+                entry = profile['artists'].setdefault(artist['id'], {'name': artist.get('name'), 'weight': 0.0})
+                entry['weight'] += weight
+
+            if names not in means:
+                rows = snapshot.artist_rows(list(names)) if names else ()
+                means[names] = snapshot.feature_means(rows) if len(rows) else None
+            features = means[names]
+            # Plays by artists missing from the catalog (or without features) only count towards artists
+            if features is None or None in features:
+                continue
+            profile['sums'] = [total + weight * value for total, value in zip(profile['sums'], features)]
+            profile['weight'] += weight
+
+        if len(profile['artists']) > self.max_artists:
+            kept = sorted(profile['artists'].items(), key=lambda item: -item[1]['weight'])[:self.max_artists]
+            profile['artists'] = dict(kept)
+
+    def vector(self, profile, default=0.6):
+        """Average (energy, danceability, valence) of the profile"""
+        if profile['weight'] <= 0:
+            return [default] * len(FEATURES)
+        return [total / profile['weight'] for total in profile['sums']]
+
+    def top_artists(self, profile, limit=25):
+        """[(artist_id, name, weight)] of the most listened artists, heaviest first"""
+        ranked = sorted(profile['artists'].items(), key=lambda item: -item[1]['weight'])[:limit]
+        return [(key, artist['name'], artist['weight']) for key, artist in ranked]
@@ -0,0 +1,34 @@
+import asyncio
+import json
+
+import app
+import async_app
+from test_pagination import PREFERENCES
+from test_ranking import synthetic_catalog
+
+
+def test_stream_sends_the_same_lines_as_the_flask_app(monkeypatch):
+    catalog = synthetic_catalog(2000)
+    monkeypatch.setattr(app, 'catalog', catalog)
+    monkeypatch.setattr(app, 'ranking_cache', app.TTLCache(maxsize=10, ttl=60))
+    ranking_id, _ = app.rank_preferences('u1', PREFERENCES, catalog)
+    query = f'?cursor={ranking_id}.20&limit=5'
+
+    flask_client = app.app.test_client()
+    with flask_client.session_transaction() as session:
+        session.update({'access_token': 'token', 'user_id': 'u1'})
+    expected = flask_client.get(f'/api/recommendations/stream{query}').get_data(as_text=True)
+
+    async def stream():
+        client = async_app.api.test_client()
+        async with client.session_transaction() as session:
+            session.update({'access_token': 'token', 'user_id': 'u1'})
+        response = await client.get(f'/api/recommendations/stream{query}')
+        return response.status_code, await response.get_data(as_text=True)
+
+    status, body = asyncio.run(stream())
+    assert status == 200
+    assert body == expected
+    lines = [json.loads(line) for line in body.splitlines()]
+    assert [line['type'] for line in lines] == ['preferences'] + ['recommendation'] * 5 + ['end']
+    assert lines[-1]['nextCursor'] == f'{ranking_id}.25'
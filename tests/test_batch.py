@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+import app
+from catalog import Catalog
+
+
+def song(i, rng):
+    energy, danceability, valence = rng.random(3).round(3).tolist()
+    return {'_id': i, 'Artist': f'Artist {i % 40}', 'Track': f'Track {i}',
+            'Energy': energy, 'Danceability': danceability, 'Valence': valence}
+
+
+@pytest.fixture
+def catalog():
+    rng = np.random.default_rng(0)
+    return Catalog([song(i, rng) for i in range(400)])
+
+
+@pytest.fixture
+def client(monkeypatch, catalog):
+    monkeypatch.setattr(app, 'BATCH_API_KEY', 'secret')
+    monkeypatch.setattr(app, 'catalog', catalog)
+    monkeypatch.setattr(app, 'DIVERSITY', False)
+    return app.app.test_client()
+
+
+def post(client, body, authorization='Bearer secret'):
+    headers = {'Authorization': authorization} if authorization is not None else {}
+    return client.post('/api/recommendations/batch', json=body, headers=headers)
+
+
+@pytest.mark.parametrize('candidates', [None, 50])
+def test_recommend_batch_matches_recommend(catalog, candidates):
+    rng = np.random.default_rng(1)
+    profiles = [
+        (catalog.artist_rows([f'Artist {a}' for a in rng.integers(40, size=i % 3)]), *rng.random(3).tolist())
+        for i in range(30)
+    ]
+    # A small chunk size so the profiles are scored over several chunks
+    batch = catalog.recommend_batch(profiles, limit=10, candidates=candidates, chunk_cells=2000)
+    assert batch == [catalog.recommend(*profile, limit=10, candidates=candidates) for profile in profiles]
+
+
+@pytest.mark.parametrize('authorization', [None, 'Bearer wrong', 'secret', 'Bearer sécret'.encode().decode('latin-1')])
+def test_batch_rejects_missing_or_bad_authorization_with_401(client, authorization):
+    assert post(client, {'profiles': []}, authorization).status_code == 401
+
+
+@pytest.mark.parametrize('body', [
+    {},
+    {'profiles': {'id': 1}},
+    {'profiles': ['Artist 1']},
+    {'profiles': [{'artists': 'Artist 1'}]},
+    {'profiles': [{'avgEnergy': 'loud'}]},
+    {'profiles': [{'avgEnergy': 0.5}], 'limit': 'all'},
+])
+def test_batch_rejects_malformed_profiles_with_400(client, body):
+    assert post(client, body).status_code == 400
+
+
+def test_batch_gives_each_profile_its_recommendations(client, catalog):
+    profile = {'id': 'u1', 'artists': ['Artist 3'], 'avgEnergy': 0.2, 'avgDanceability': 0.4, 'avgValence': 0.6}
+    response = post(client, {'profiles': [profile, {'id': 'u2'}], 'limit': 5})
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [r['id'] for r in results] == ['u1', 'u2']
+    expected = catalog.recommend(catalog.artist_rows(['Artist 3']), 0.2, 0.4, 0.6, limit=5,
+                                 candidates=app.RECOMMENDATION_CANDIDATES or None)
+    assert [r['_id'] for r in results[0]['recommendations']] == [str(doc['_id']) for doc in expected]
+    assert len(results[1]['recommendations']) == 5
@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+import catalog as catalog_module
+from catalog import ArtistIndex, Catalog, artist_keys, normalize_artist, primary_artist
+from catalog_snapshot import SnapshotDocuments, load_snapshot, write_snapshot
+
+
+def song(i, artist):
+    return {'_id': i, 'Artist': artist, 'Track': f'Track {i}', 'Energy': 0.5, 'Danceability': 0.5, 'Valence': 0.5}
+
+
+def test_normalize_artist_ignores_case_accents_and_spacing():
+    assert normalize_artist('  Beyoncé ') == 'beyonce'
+    assert normalize_artist('SIGUR  RÓS') == 'sigur ros'
+    assert normalize_artist('Ａｖｉｃｉｉ') == 'avicii'
+
+
+def test_multi_artist_strings_are_indexed_under_each_artist():
+    assert artist_keys('Beyoncé, JAY-Z') == {'beyonce, jay-z', 'beyonce', 'jay-z'}
+    assert artist_keys('A,B') == {'a,b', 'a', 'b'}
+    assert artist_keys(None) == set()
+    assert primary_artist('Beyoncé, JAY-Z') == 'beyonce'
+
+
+def test_names_with_commas_are_not_split():
+    assert artist_keys('Tyler, The Creator') == {'tyler, the creator'}
+    assert artist_keys('Earth, Wind & Fire') == {'earth, wind & fire'}
+    assert artist_keys('Drake, Tyler, The Creator') == {'drake, tyler, the creator', 'drake', 'tyler, the creator'}
+    assert artist_keys('Earth, Wind & Fire, The Emotions') == {
+        'earth, wind & fire, the emotions', 'earth, wind & fire', 'the emotions'}
+    assert primary_artist('Tyler, The Creator') == 'tyler, the creator'
+    assert primary_artist('Earth, Wind & Fire, The Emotions') == 'earth, wind & fire'
+
+
+def test_artist_index_lookup():
+    artists = ['Beyoncé', 'beyonce, Kendrick Lamar', 'Tyler, The Creator', 'Earth, Wind & Fire', 'The Creator']
+    catalog = Catalog([song(i, artist) for i, artist in enumerate(artists)])
+    index = catalog.artist_index
+    assert isinstance(index, ArtistIndex)
+
+    assert index.lookup(['BEYONCÉ']).tolist() == [0, 1]
+    assert index.lookup(['Kendrick Lamar']).tolist() == [1]
+    assert index.lookup(['tyler, the creator']).tolist() == [2]
+    assert index.lookup(['The Creator']).tolist() == [4]
+    assert index.lookup(['Earth']).tolist() == []
+    assert index.lookup(['Nobody']).dtype == np.int32
+
+
+def random_catalog(count=3000, seed=3):
+    rng = np.random.default_rng(seed)
+    return Catalog([
+        {'_id': i, 'Artist': f'Artist {i % 150}', 'Track': f'Track {i}',
+         'Energy': float(e), 'Danceability': float(d), 'Valence': float(v)}
+        for i, (e, d, v) in enumerate(rng.random((count, 3)))
+    ])
+
+
+TARGETS = [(0.2, 0.3, 0.4), (0.5, 0.5, 0.5), (0.9, 0.1, 0.7)]
+ARTISTS = [[], ['Artist 5'], ['Artist 6', 'Artist 7'], ['New Artist']]
+
+
+def view(catalog):
+    """Everything a request can observe, independent of row numbers"""
+    rankings = [
+        [(doc['_id'], doc['score']) for doc in catalog.recommend(catalog.artist_rows(artists), *target, limit=25,
+                                                               candidates=candidates)]
+        for target in TARGETS for artists in ARTISTS for candidates in (None, 40)
+    ]
+    by_artist = [sorted(catalog.documents[row]['_id'] for row in catalog.artist_rows(artists)) for artists in ARTISTS]
+    ids = {song_id: catalog.documents[row]['_id'] for song_id, row in catalog.rows_by_id().items()}
+    return rankings, by_artist, ids
+
+
+def fresh(catalog):
+    return Catalog([doc for doc in catalog.documents if doc is not None])
+
+
+def song_like(catalog, _id, **changes):
+    return {**catalog.documents[catalog.rows_by_id()[str(_id)]], **changes}
+
+
+@pytest.mark.parametrize('change', ['upsert', 'insert', 'delete', 'artist'])
+def test_updated_matches_a_fresh_build_and_leaves_the_previous_snapshot_alone(change):
+    catalog = random_catalog()
+    before = view(catalog)
+    top = catalog.recommend(np.empty(0, dtype=np.int32), *TARGETS[0], limit=1)[0]['_id']
+    upserts, deleted = {
+        'upsert': ([song_like(catalog, 10, Energy=0.5, Danceability=0.5, Valence=0.5)], []),
+        'insert': ([{'_id': 'new', 'Artist': 'New Artist', 'Energy': 0.9, 'Danceability': 0.1, 'Valence': 0.7}], []),
+        'delete': ([], [top]),
+        'artist': ([song_like(catalog, 5, Artist='Artist 6')], []),
+    }[change]
+
+    updated = catalog.updated(upserts, deleted)
+    assert view(updated) == view(fresh(updated))
+    assert view(catalog) == before
+    assert view(updated) != before
+
+
+def test_chained_updates_fold_their_overlays(monkeypatch):
+    monkeypatch.setattr(catalog_module, 'OVERLAY_ROWS', 50)
+    catalog = random_catalog()
+    rng = np.random.default_rng(4)
+    trees = set()
+    for batch in range(12):
+        ids = rng.choice(3000, size=12, replace=False).tolist()
+        upserts = [song_like(catalog, _id, Energy=float(rng.random()), Artist=f'Artist {rng.integers(160)}')
+                   for _id in ids[:8] if str(_id) in catalog.rows_by_id()]
+        upserts.append({'_id': f'new {batch}', 'Artist': 'New Artist', 'Energy': float(rng.random()),
+                        'Danceability': 0.5, 'Valence': 0.5})
+        catalog = catalog.updated(upserts, ids[8:])
+        trees.add(id(catalog.feature_index.tree))
+        assert view(catalog) == view(fresh(catalog))
+        points = np.array(TARGETS, dtype=np.float32)
+        distances, _ = catalog.feature_index.nearest(points, 30)
+        np.testing.assert_allclose(distances, fresh(catalog).feature_index.nearest(points, 30)[0], rtol=1e-6)
+    # The tree is shared between batches and rebuilt once enough rows sit outside it
+    assert 1 < len(trees) < 12
+
+
+def test_updated_snapshot_keeps_documents_mapped(tmp_path):
+    write_snapshot(random_catalog(), str(tmp_path / 'catalog'))
+    catalog = load_snapshot(str(tmp_path / 'catalog'))
+    updated = catalog.updated([song_like(catalog, 7, Artist='Artist 9', Energy=0.1)], [8])
+    assert isinstance(updated.documents.base, SnapshotDocuments)
+    assert view(updated) == view(fresh(updated))
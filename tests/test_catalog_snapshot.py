@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+from catalog import Catalog
+from catalog_snapshot import load_snapshot, write_snapshot
+
+
+def make_catalog():
+    return Catalog([
+        {'_id': i, 'Artist': f'Artist {i % 3}', 'Track': f'Track {i}', 'Energy': 0.1 * i,
+         'Danceability': 0.5, 'Valence': 0.5}
+        for i in range(10)
+    ])
+
+
+def test_back_to_back_exports_keep_only_the_newest(tmp_path):
+    path = str(tmp_path / 'catalog')
+    write_snapshot(make_catalog(), path)
+    second = write_snapshot(make_catalog(), path)
+    assert os.path.realpath(path) == os.path.realpath(second)
+    assert len(load_snapshot(path)) == 10
+    assert sorted(os.listdir(tmp_path)) == sorted(['catalog', os.path.basename(second)])
+
+
+def test_export_refuses_to_replace_a_real_directory(tmp_path):
+    path = tmp_path / 'catalog'
+    path.mkdir()
+    (path / 'keep.txt').write_text('user data')
+    with pytest.raises(FileExistsError):
+        write_snapshot(make_catalog(), str(path))
+    assert (path / 'keep.txt').read_text() == 'user data'
+    assert os.listdir(tmp_path) == ['catalog']
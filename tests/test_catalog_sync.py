@@ -0,0 +1,130 @@
+import os
+from datetime import datetime
+
+from bson.timestamp import Timestamp
+from pymongo.errors import OperationFailure
+
+from catalog import Catalog
+from catalog_snapshot import load_snapshot, read_manifest, sync_point, write_snapshot
+from catalog_sync import CatalogSync
+
+EXPORTED_AT = datetime(2026, 3, 1, 12, 0)
+
+
+def song(i, updated_at):
+    return {'_id': i, 'Artist': f'Artist {i}', 'Track': f'Track {i}', 'Energy': 0.5, 'Danceability': 0.5,
+            'Valence': 0.5, 'updated_at': updated_at}
+
+
+class FakeStream:
+    resume_token = {'_data': 'after-export'}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def try_next(self):
+        return None
+
+
+class FakeCursor(list):
+    def sort(self, field, direction):
+        return FakeCursor(sorted(self, key=lambda doc: doc[field], reverse=direction < 0))
+
+
+class FakeCollection:
+    """Just enough of a songs collection for sync; `oplog` is the oldest token still resumable"""
+
+    def __init__(self, documents, change_streams=True, oplog=None):
+        self.documents = documents
+        self.change_streams = change_streams
+        self.oplog = oplog
+        self.watches = []
+        self.database = self
+
+    def command(self, name):
+        return {'ok': 1, 'operationTime': Timestamp(1772366400, 1)}
+
+    def watch(self, pipeline=None, **kwargs):
+        if not self.change_streams:
+            raise OperationFailure('The $changeStream stage is only supported on replica sets')
+        if kwargs.get('resume_after') not in (None, self.oplog):
+            raise OperationFailure('Resume of change stream was not possible')
+        self.watches.append({key: value for key, value in kwargs.items() if key in (
+            'resume_after', 'start_at_operation_time')})
+        return FakeStream()
+
+    def find(self, query=None, projection=None):
+        (field, condition), = query.items() if query else [(None, None)]
+        if field is None:
+            return FakeCursor(self.documents)
+        return FakeCursor(doc for doc in self.documents if field in doc and (
+            '$gt' not in condition or doc[field] > condition['$gt']))
+
+    def find_one(self, query, projection, sort):
+        docs = self.find(query).sort(*sort[0])
+        return docs[0] if docs else None
+
+
+def export(tmp_path, collection):
+    since = sync_point(collection, 'updated_at')
+    write_snapshot(Catalog.from_collection(collection), str(tmp_path / 'catalog'), since=since)
+    return os.path.realpath(tmp_path / 'catalog')
+
+
+def start(collection, path):
+    catalog = load_snapshot(path)
+    published = []
+    sync = CatalogSync(collection, lambda: published[-1] if published else catalog, published.append)
+    sync.open(since=read_manifest(path).get('since', {}))
+    return sync, published
+
+
+def test_snapshot_records_where_the_export_read_from(tmp_path):
+    path = export(tmp_path, FakeCollection([song(1, datetime(2026, 1, 1)), song(2, EXPORTED_AT)]))
+    assert read_manifest(path)['since'] == {
+        'resume_token': {'_data': 'after-export'},
+        'cluster_time': Timestamp(1772366400, 1),
+        'watermark_field': 'updated_at',
+        'watermark': EXPORTED_AT,
+    }
+
+
+def test_change_stream_resumes_from_the_export():
+    collection = FakeCollection([song(1, EXPORTED_AT)], oplog={'_data': 'after-export'})
+    catalog = Catalog.from_collection(collection)
+    sync = CatalogSync(collection, lambda: catalog, None)
+    sync.open(since=sync_point(collection, 'updated_at'))
+    assert collection.watches[-1] == {'resume_after': {'_data': 'after-export'}}
+    assert sync.mode == 'change_stream' and not sync.catch_up
+
+
+def test_change_stream_falls_back_to_cluster_time_then_a_full_reload(tmp_path):
+    collection = FakeCollection([song(1, EXPORTED_AT)], oplog={'_data': 'newer'})
+    sync, _ = start(collection, export(tmp_path, collection))
+    assert collection.watches[-1] == {'start_at_operation_time': Timestamp(1772366400, 1)}
+    assert not sync.catch_up
+
+    sync, _ = start(collection, export(tmp_path, FakeCollection([], change_streams=False)))
+    assert collection.watches[-1] == {}
+    assert sync.catch_up
+
+
+def test_polling_applies_only_changes_since_the_export(tmp_path):
+    collection = FakeCollection([song(1, datetime(2026, 1, 1)), song(2, EXPORTED_AT)], change_streams=False)
+    sync, published = start(collection, export(tmp_path, collection))
+    assert sync.mode == 'watermark' and sync.watermark == EXPORTED_AT
+
+    collection.documents.append(song(3, datetime(2026, 3, 2)))
+    sync.poll()
+    assert sync.changes['upsert'] == 1
+    assert [doc['_id'] for doc in published[-1].documents] == [1, 2, 3]
+
+
+def test_polling_catches_up_without_a_watermark(tmp_path):
+    collection = FakeCollection([song(1, EXPORTED_AT)], change_streams=False)
+    write_snapshot(Catalog.from_collection(collection), str(tmp_path / 'catalog'))
+    sync, _ = start(collection, os.path.realpath(tmp_path / 'catalog'))
+    assert sync.mode == 'watermark' and sync.watermark is None and sync.catch_up
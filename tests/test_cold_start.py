@@ -0,0 +1,37 @@
+import numpy as np
+
+from catalog import Catalog
+from cold_start import ColdStartPool
+
+
+def make_catalog(count, missing_every=0):
+    rng = np.random.default_rng(0)
+    documents = []
+    for i in range(count):
+        energy, danceability, valence = rng.random(3).tolist()
+        if missing_every and i % missing_every == 0:
+            energy = None
+        documents.append({'_id': i, 'Artist': f'Artist {i % 7}', 'Energy': energy,
+                          'Danceability': danceability, 'Valence': valence})
+    return Catalog(documents)
+
+
+def test_songs_missing_features_can_be_drawn():
+    catalog = make_catalog(2000, missing_every=10)
+    pool = ColdStartPool(size=500).rebuild(catalog)
+    rows = pool._state[1]
+    missing = np.isnan(catalog.energy[rows]).sum()
+    assert 30 <= missing <= 70
+
+
+def test_pool_never_exceeds_its_size():
+    catalog = make_catalog(5000, missing_every=50)
+    for size in (5, 20, 64, 100):
+        assert len(ColdStartPool(size=size).rebuild(catalog)) == size
+
+
+def test_deleted_songs_are_left_out():
+    catalog = make_catalog(200).updated(deleted_ids=range(0, 200, 2))
+    pool = ColdStartPool(size=150).rebuild(catalog)
+    assert len(pool) == 100
+    assert all(doc['_id'] % 2 for doc in pool.draw(50))
@@ -0,0 +1,38 @@
+import collections
+
+import numpy as np
+
+from catalog import Catalog
+from diversity import diversify, mmr
+
+
+def song(i, artist, energy):
+    return {'_id': i, 'Artist': artist, 'Track': f'Track {i}', 'Energy': energy, 'Danceability': 0.5, 'Valence': 0.5}
+
+
+def test_artist_cap_counts_collaborations_and_spelling_variants_as_one_artist():
+    variants = ['Beyoncé', 'beyonce', 'BEYONCÉ', 'Beyoncé, Jay-Z', 'Beyonce,Kendrick Lamar']
+    documents = [song(i, variants[i % len(variants)], 0.5 + 0.001 * i) for i in range(20)]
+    documents += [song(20 + i, f'Other {i}', 0.1 * (i % 10)) for i in range(20)]
+    catalog = Catalog(documents)
+    rows = np.arange(len(documents))
+    # Every Beyoncé song outscores every other song
+    scores = np.where(rows < 20, 20.0 + rows * 0.01, 10.0).astype(np.float32)
+
+    ranked, _ = diversify(catalog, rows, scores, 10, relevance_weight=0.7, artist_cap=3)
+    first = collections.Counter(catalog.primary_artists(ranked))
+    assert first['beyonce'] == 3
+    assert len(ranked) == 10
+
+
+def test_mmr_without_cap_or_diversity_keeps_score_order():
+    relevance = np.array([1.0, 3.0, np.nan, 2.0], dtype=np.float32)
+    points = np.random.default_rng(0).random((4, 3))
+    assert mmr(relevance, points, np.zeros(4, dtype=np.intp), 4, 1.0, 0).tolist() == [1, 3, 0, 2]
+
+
+def test_capped_artists_fill_the_ranking_once_others_run_out():
+    relevance = np.array([5.0, 4.0, 3.0, 1.0], dtype=np.float32)
+    points = np.zeros((4, 3))
+    order = mmr(relevance, points, np.array([0, 0, 0, 1]), 4, 0.7, 1)
+    assert order.tolist() == [0, 3, 1, 2]
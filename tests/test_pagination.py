@@ -0,0 +1,83 @@
+import pytest
+
+import app
+from test_ranking import synthetic_catalog
+
+PREFERENCES = {
+    'top_artists': ['Artist 1', 'Artist 2'], 'top_genres': [],
+    'avg_energy': 0.5, 'avg_danceability': 0.5, 'avg_valence': 0.5,
+}
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    catalog = synthetic_catalog(2000)
+    monkeypatch.setattr(app, 'catalog', catalog)
+    monkeypatch.setattr(app, 'ranking_cache', app.TTLCache(maxsize=10, ttl=60))
+    monkeypatch.setattr(app, 'RECOMMENDATION_DEPTH', 50)
+    return catalog
+
+
+def client_for(user_id):
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session['access_token'] = 'token'
+        session['user_id'] = user_id
+    return client
+
+
+def page(client, cursor, limit=20):
+    return client.get('/api/recommendations', query_string={'cursor': cursor, 'limit': limit})
+
+
+def test_cursor_round_trip():
+    ranking = {'rows': list(range(50))}
+    cursor = app.next_cursor('abc.def', ranking, 20, 20)
+    assert app.parse_cursor(cursor) == ('abc.def', 40)
+    assert app.next_cursor('abc', ranking, 40, 20) is None
+    assert app.next_cursor('abc', ranking, 30, 20) is None
+    for malformed in ['abc', 'abc.', '.20', 'abc.-1', 'abc.x']:
+        with pytest.raises(ValueError):
+            app.parse_cursor(malformed)
+
+
+def test_pages_cover_the_ranking_once(catalog):
+    ranking_id, ranking = app.rank_preferences('u1', PREFERENCES, catalog)
+    assert 'snapshot' not in app.ranking_cache.get(('u1', ranking_id))
+    client = client_for('u1')
+    seen, cursor = [], app.next_cursor(ranking_id, ranking, 0, 0)
+    while cursor:
+        body = page(client, cursor, limit=15).get_json()
+        seen += [rec['_id'] for rec in body['recommendations']]
+        cursor = body['nextCursor']
+    assert seen == [str(catalog.documents[row]['_id']) for row in ranking['rows']]
+    assert len(seen) == 50
+    # The last page is short and has no next page
+    assert len(page(client, f'{ranking_id}.45', limit=15).get_json()['recommendations']) == 5
+
+
+def test_cursor_of_another_user_is_gone(catalog):
+    ranking_id, _ = app.rank_preferences('u1', PREFERENCES, catalog)
+    assert page(client_for('u1'), f'{ranking_id}.20').status_code == 200
+    assert page(client_for('u2'), f'{ranking_id}.20').status_code == 410
+
+
+def test_expired_or_malformed_cursor(catalog):
+    ranking_id, _ = app.rank_preferences('u1', PREFERENCES, catalog)
+    client = client_for('u1')
+    app.ranking_cache.invalidate(('u1', ranking_id))
+    assert page(client, f'{ranking_id}.20').status_code == 410
+    assert page(client, 'not-a-cursor').status_code == 400
+
+
+def test_cursor_survives_sync_but_not_a_rebuild(monkeypatch, catalog):
+    ranking_id, ranking = app.rank_preferences('u1', PREFERENCES, catalog)
+    client = client_for('u1')
+    deleted = catalog.documents[ranking['rows'][25]]['_id']
+    monkeypatch.setattr(app, 'catalog', catalog.updated(deleted_ids=[deleted]))
+    body = page(client, f'{ranking_id}.20', limit=10).get_json()
+    assert len(body['recommendations']) == 9
+    assert str(deleted) not in [rec['_id'] for rec in body['recommendations']]
+
+    monkeypatch.setattr(app, 'catalog', app.catalog.compact())
+    assert page(client, f'{ranking_id}.20').status_code == 410
@@ -0,0 +1,34 @@
+from precompute import Precomputer
+
+
+def make_precomputer():
+    used = []
+
+    def refresh(refresh_token):
+        used.append(refresh_token)
+        if refresh_token.startswith('rotated'):
+            return 'access', 3600, None
+        return 'access', 0, f'rotated-{len(used)}'
+
+    precomputer = Precomputer(lambda access_token, user_id: {'ok': True}, refresh)
+    return precomputer, used
+
+
+def test_touch_keeps_a_token_rotated_by_the_background_refresh():
+    precomputer, used = make_precomputer()
+    precomputer.touch('u', 'login')
+    precomputer._refresh_user('u')
+    # The session cookie still holds the login token
+    precomputer.touch('u', 'login')
+    precomputer._refresh_user('u')
+    assert used == ['login', 'rotated-1']
+
+
+def test_touch_takes_a_new_token_from_the_session():
+    precomputer, used = make_precomputer()
+    precomputer.touch('u', 'login')
+    precomputer._refresh_user('u')
+    precomputer.touch('u', 'login-again')
+    precomputer._users['u']['access_token'] = None
+    precomputer._refresh_user('u')
+    assert used == ['login', 'login-again']
@@ -0,0 +1,72 @@
+import math
+
+import numpy as np
+
+from catalog import FEATURE_RANGE, Catalog
+
+PROFILES = 200
+
+
+def synthetic_catalog(count, seed=0):
+    rng = np.random.default_rng(seed)
+    features = rng.random((count, 3)).round(3)
+    # Some songs are missing a feature, like in the real collection
+    features[rng.random((count, 3)) < 0.01] = np.nan
+    documents = []
+    for i in range(count):
+        doc = {'_id': i, 'Artist': f'Artist {rng.integers(count // 5)}', 'Track': f'Track {i}'}
+        for field, value in zip(('Energy', 'Danceability', 'Valence'), features[i]):
+            if not math.isnan(value):
+                doc[field] = float(value)
+        documents.append(doc)
+    return Catalog(documents)
+
+
+def profiles(catalog, seed=1):
+    rng = np.random.default_rng(seed)
+    for _ in range(PROFILES):
+        artists = [f'Artist {a}' for a in rng.integers(len(catalog) // 5, size=rng.integers(3))]
+        yield (catalog.artist_rows(artists), *rng.random(3).round(3).tolist())
+
+
+def pipeline_scores(catalog, artist_rows, energy, danceability, valence, limit):
+    """Scores of the top songs as the original MongoDB aggregation ranked them"""
+    artist_rows = set(artist_rows.tolist())
+    ranked = []
+    for row, doc in enumerate(catalog.documents):
+        e, d, v = (doc.get(field) for field in ('Energy', 'Danceability', 'Valence'))
+        is_artist = row in artist_rows
+        if not (is_artist
+                or (e is not None and d is not None
+                    and abs(e - energy) <= FEATURE_RANGE and abs(d - danceability) <= FEATURE_RANGE)
+                or (v is not None and abs(v - valence) <= FEATURE_RANGE)):
+            continue
+        if None in (e, d, v):
+            score = None
+        else:
+            score = (10 * is_artist + 5 * (1 - abs(e - energy)) + 5 * (1 - abs(d - danceability))
+                     + 3 * (1 - abs(v - valence)))
+        ranked.append(score)
+    ranked.sort(key=lambda score: -math.inf if score is None else score, reverse=True)
+    return [math.nan if score is None else score for score in ranked[:limit]]
+
+
+def test_full_scan_ranks_like_the_aggregation_pipeline():
+    catalog = synthetic_catalog(2000)
+    for artist_rows, energy, danceability, valence in profiles(catalog):
+        _, scores = catalog.rank(artist_rows, energy, danceability, valence, limit=20)
+        expected = pipeline_scores(catalog, artist_rows, energy, danceability, valence, 20)
+        np.testing.assert_allclose(scores, expected, rtol=1e-5, equal_nan=True)
+
+
+def test_feature_index_candidates_rank_like_the_full_scan():
+    catalog = synthetic_catalog(20000)
+    mismatches = 0
+    for artist_rows, energy, danceability, valence in profiles(catalog):
+        rows, scores = catalog.rank(artist_rows, energy, danceability, valence, limit=20)
+        knn_rows, knn_scores = catalog.rank(artist_rows, energy, danceability, valence, limit=20, candidates=200)
+        # Songs with the same score may come in either order
+        if not np.array_equal(knn_scores, scores) or set(knn_rows[knn_scores > scores[-1]]) != set(
+                rows[scores > scores[-1]]):
+            mismatches += 1
+    assert mismatches == 0
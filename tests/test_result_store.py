@@ -0,0 +1,23 @@
+import time
+
+from result_store import create_result_store
+
+
+def test_sqlite_store_round_trip_and_expiry(tmp_path):
+    store = create_result_store(f'sqlite:///{tmp_path / "results.db"}', ttl=60)
+    store.set('a', {'ids': ['1']})
+    assert store.get('a') == {'ids': ['1']}
+    store.delete('a')
+    assert store.get('a') is None
+
+    store.ttl = -1
+    store.set('b', {'ids': ['2']})
+    assert store.get('b') is None
+
+
+def test_sqlite_purge_uses_the_expiry_index(tmp_path):
+    store = create_result_store(f'sqlite:///{tmp_path / "results.db"}')
+    plan = store._connection().execute(
+        'EXPLAIN QUERY PLAN DELETE FROM results WHERE expires_at <= ?', (time.time(),)
+    ).fetchall()
+    assert any('results_expires_at' in row[-1] for row in plan)
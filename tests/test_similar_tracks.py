@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+import app
+from catalog import FeatureIndex
+from catalog_snapshot import load_snapshot, write_snapshot
+from similar_tracks import ARTIST_BONUS, FEATURE_SCORE, SimilarTracks, build, similar_rows
+from test_ranking import synthetic_catalog
+
+NEIGHBOURS = 10
+
+
+@pytest.fixture(scope='module')
+def catalog():
+    return synthetic_catalog(3000, seed=2)
+
+
+def brute_force(catalog, row):
+    """Similarity of a row to every song, NaN for itself and songs that can't be compared"""
+    points = np.column_stack([catalog.energy, catalog.danceability, catalog.valence]).astype(np.float64)
+    scores = FEATURE_SCORE - (np.abs(points - points[row]) * FeatureIndex.WEIGHTS).sum(axis=1)
+    scores += ARTIST_BONUS * (catalog.artist_codes == catalog.artist_codes[row])
+    scores[row] = np.nan
+    return scores
+
+
+def test_index_and_on_demand_neighbours_match_brute_force(catalog):
+    neighbours, scores = build(catalog, NEIGHBOURS, block_rows=700, chunk_cells=5000)
+    index = SimilarTracks(neighbours, scores, [str(doc['_id']) for doc in catalog.documents])
+    for row in range(len(catalog)):
+        everything = brute_force(catalog, row)
+        expected = np.sort(everything[~np.isnan(everything)])[::-1][:NEIGHBOURS]
+        for rows, found, rtol in [(*index.similar(catalog, row, NEIGHBOURS), 1e-3),
+                                  (*similar_rows(catalog, row, NEIGHBOURS), 1e-5)]:
+            np.testing.assert_allclose(found, expected, rtol=rtol)
+            np.testing.assert_allclose(everything[np.asarray(rows, dtype=np.intp)], expected, rtol=rtol)
+    assert index.stats()['hits'] == len(catalog)
+
+
+def test_find_looks_songs_up_by_client_id(catalog, tmp_path):
+    index = SimilarTracks()
+    assert index.find(catalog, '17') == 17
+    assert index.find(catalog, 'missing') is None
+    assert index.find(catalog.updated(deleted_ids=[17]), '17') is None
+
+    write_snapshot(catalog, str(tmp_path / 'catalog'))
+    assert index.find(load_snapshot(str(tmp_path / 'catalog')), '17') == 17
+
+
+def test_unknown_song_is_404(monkeypatch, catalog):
+    monkeypatch.setattr(app, 'catalog', catalog)
+    monkeypatch.setattr(app, 'similar_tracks', SimilarTracks())
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session['access_token'] = 'token'
+    assert client.get('/api/similar?id=missing').status_code == 404
+    response = client.get('/api/similar?id=17&limit=5')
+    assert response.status_code == 200
+    assert response.get_json()['track']['_id'] == '17'
+    assert len(response.get_json()['similar']) == 5
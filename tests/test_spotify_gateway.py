@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from spotify_gateway import SpotifyAuthError, SpotifyGateway, SpotifyUnavailable
+
+
+class Response:
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.data = data if data is not None else {}
+        self.headers = headers or {}
+
+    def json(self):
+        return self.data
+
+
+class Spotify:
+    """send() that answers with the queued responses, then 200s"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def __call__(self, path, access_token, params=None):
+        self.calls += 1
+        return self.responses.pop(0) if self.responses else Response(200, {'ok': True})
+
+    async def send_async(self, path, access_token, params=None):
+        return self(path, access_token, params)
+
+
+def open_breaker(gateway, spotify):
+    spotify.responses[:0] = [Response(500)] * gateway.breaker.threshold
+    for _ in range(gateway.breaker.threshold):
+        assert gateway.get('/me', 'token').status_code == 500
+    assert gateway.breaker.state == 'open'
+    gateway.breaker.opened_at -= gateway.breaker.reset_timeout
+
+
+def make_gateway(spotify, **kwargs):
+    return SpotifyGateway(spotify, spotify.send_async, breaker_threshold=2, breaker_reset=30, **kwargs)
+
+
+def test_half_open_trial_answered_with_401_closes_the_circuit():
+    spotify = Spotify()
+    gateway = make_gateway(spotify)
+    open_breaker(gateway, spotify)
+    spotify.responses.append(Response(401))
+    with pytest.raises(SpotifyAuthError):
+        gateway.get('/me', 'token')
+    assert gateway.breaker.state == 'closed'
+    assert gateway.get('/me', 'token').status_code == 200
+
+
+def test_half_open_trial_answered_with_429_closes_the_circuit():
+    spotify = Spotify()
+    gateway = make_gateway(spotify, max_retries=0)
+    open_breaker(gateway, spotify)
+    spotify.responses.append(Response(429, headers={'Retry-After': '0'}))
+    with pytest.raises(SpotifyUnavailable):
+        gateway.get('/me', 'token')
+    assert gateway.breaker.state == 'closed'
+    assert gateway.get('/me', 'token').status_code == 200
+
+
+def test_half_open_trial_without_an_answer_is_released():
+    spotify = Spotify()
+    gateway = make_gateway(spotify)
+    open_breaker(gateway, spotify)
+    gateway.bucket.block(gateway.max_wait + 10)
+    calls = spotify.calls
+    with pytest.raises(SpotifyUnavailable):
+        gateway.get('/me', 'token')
+    assert spotify.calls == calls
+    assert gateway.breaker.state == 'open'
+    # The next call gets the trial
+    gateway.bucket.blocked_until = 0.0
+    assert gateway.get('/me', 'token').status_code == 200
+    assert gateway.breaker.state == 'closed'
+
+
+def test_pending_trial_is_granted_again_after_reset_timeout():
+    spotify = Spotify()
+    gateway = make_gateway(spotify)
+    open_breaker(gateway, spotify)
+    assert gateway.breaker.allow() == 'trial'
+    assert not gateway.breaker.allow()
+    gateway.breaker._trial_at -= gateway.breaker.reset_timeout
+    assert gateway.breaker.allow() == 'trial'
+
+
+def test_async_half_open_trial_answered_with_401_closes_the_circuit():
+    spotify = Spotify()
+    gateway = make_gateway(spotify)
+    open_breaker(gateway, spotify)
+    spotify.responses.append(Response(401))
+
+    async def main():
+        with pytest.raises(SpotifyAuthError):
+            await gateway.get_async('/me', 'token')
+        return await gateway.get_async('/me', 'token')
+
+    assert asyncio.run(main()).status_code == 200
+    assert gateway.breaker.state == 'closed'
@@ -0,0 +1,71 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from catalog import Catalog
+from result_store import MemoryResultStore
+from taste_profile import TasteProfiles, played_at_ms
+
+HALF_LIFE = 86400
+START = 1_700_000_000
+
+
+@pytest.fixture
+def catalog():
+    return Catalog([
+        {'_id': 1, 'Artist': 'Loud', 'Track': 'A', 'Energy': 0.8, 'Danceability': 0.8, 'Valence': 0.8},
+        {'_id': 2, 'Artist': 'Quiet', 'Track': 'B', 'Energy': 0.2, 'Danceability': 0.2, 'Valence': 0.2},
+    ])
+
+
+@pytest.fixture
+def profiles():
+    return TasteProfiles(MemoryResultStore(), half_life=HALF_LIFE)
+
+
+def track(artist):
+    return {'artists': [{'id': artist.lower(), 'name': artist}]}
+
+
+def play(artist, at):
+    played_at = datetime.fromtimestamp(at, timezone.utc).isoformat().replace('+00:00', 'Z')
+    return {'played_at': played_at, 'track': track(artist)}
+
+
+def test_weights_halve_after_one_half_life(profiles, catalog):
+    profiles.update('u', catalog, seed_tracks=[track('Loud')], now=START)
+    profile = profiles.update('u', catalog, now=START + HALF_LIFE)
+    assert profile['weight'] == pytest.approx(0.5)
+    assert profile['artists']['loud']['weight'] == pytest.approx(0.5)
+    # Decay alone leaves the averages alone
+    assert profiles.vector(profile) == pytest.approx([0.8, 0.8, 0.8])
+
+
+def test_plays_are_weighted_by_age(profiles, catalog):
+    profile = profiles.update('u', catalog, plays=[play('Quiet', START - HALF_LIFE)], now=START)
+    assert profile['weight'] == pytest.approx(0.5)
+    assert profile['artists']['quiet']['weight'] == pytest.approx(0.5)
+
+
+def test_plays_up_to_the_cursor_are_not_counted_twice(profiles, catalog):
+    first = [play('Loud', START - 60), play('Quiet', START - 30)]
+    profile = profiles.update('u', catalog, plays=first, now=START)
+    assert profile['plays'] == 2
+    assert profile['cursor'] == played_at_ms(first[1])
+
+    # Spotify may report the same plays again, plus one at the cursor's own timestamp
+    again = first + [play('Quiet', START - 30), play('Loud', START + 30)]
+    profile = profiles.update('u', catalog, plays=again, now=START + 60)
+    assert profile['plays'] == 3
+    assert profile['cursor'] == played_at_ms(again[-1])
+    assert profile['artists']['quiet']['weight'] < 1
+    assert profile['artists']['loud']['weight'] == pytest.approx(
+        0.5 ** (120 / HALF_LIFE) + 0.5 ** (30 / HALF_LIFE))
+
+
+def test_stored_profile_is_only_changed_by_update(profiles, catalog):
+    profiles.update('u', catalog, seed_tracks=[track('Loud')], now=START)
+    stored = profiles.get('u')
+    profiles.update('u', catalog, plays=[play('Quiet', START + 10)], now=START + 20)
+    assert stored['weight'] == 1.0
+    assert profiles.get('u') is not stored